@@ -0,0 +1,144 @@
+"""
+    Microbenchmarks for Packet/PacketFactory encode-decode throughput.
+
+    For every packet type and body size it measures four operations:
+
+        1. build:    PacketFactory.new_###_packet(...) followed by Packet.get_buf().
+        2. validate: Packet.validate_buffer(buffer), the header check that runs before parsing.
+        3. parse:    PacketFactory.parse_buffer(buffer) of an encoded packet.
+        4. forward:  parse, rebuild with our own address and encode again; what a Peer does for every broadcast hop.
+
+    It reports ops/sec and the bytes allocated per packet (tracemalloc peak of a single operation), so changes
+    to the codec can be compared against a saved baseline:
+
+        python -m benchmarks.codec > before.txt
+        python -m benchmarks.codec > after.txt
+"""
+import argparse
+import time
+import tracemalloc
+
+from src.Packet import Packet, PacketFactory
+
+SOURCE_ADDRESS = ('192.168.001.001', '05335')
+FORWARD_ADDRESS = ('192.168.001.002', '05336')
+PATH_ENTRY = ('192.168.001.003', '05337')
+
+
+def packet_builders(size, fixed_size_packets):
+    """
+    :param size: Body size for the variable sized packets (Message, Message Chunk, Reunion and Shortcut).
+    :param fixed_size_packets: Include Register, Advertise and Join packets, whose size does not depend on 'size'.
+    :type size: int
+    :type fixed_size_packets: bool
+
+    :return: List of (name, function that builds the packet, function that rebuilds it at the next hop).
+    :rtype: list
+    """
+    message = 'x' * size
+    entries = max(1, (size - len(Packet.BODY_REQ) - Packet.NUMBER_OF_ENTRIES_SIZE) //
+                  (Packet.IP_SIZE + Packet.PORT_SIZE))
+    entries = min(entries, 99)
+    path = [PATH_ENTRY] * entries
+    message_id = '0' * Packet.MESSAGE_ID_SIZE
+
+    def forward_message(packet):
+        return PacketFactory.new_message_packet(packet.get_body(), FORWARD_ADDRESS)
+
+    def forward_message_chunk(packet):
+        body_str = packet.get_body()
+        chunk_index = int(body_str[Packet.MESSAGE_ID_SIZE:Packet.MESSAGE_ID_SIZE + Packet.CHUNK_INDEX_SIZE])
+        chunk_count = int(body_str[Packet.MESSAGE_ID_SIZE + Packet.CHUNK_INDEX_SIZE:Packet.CHUNK_HEADER_SIZE])
+        return PacketFactory.new_message_chunk_packet(body_str[:Packet.MESSAGE_ID_SIZE], chunk_index, chunk_count,
+                                                      body_str[Packet.CHUNK_HEADER_SIZE:], FORWARD_ADDRESS)
+
+    def forward_reunion(packet):
+        return PacketFactory.new_reunion_packet(Packet.BODY_REQ, packet.get_source_server_address(),
+                                                path + [FORWARD_ADDRESS])
+
+    def forward_shortcut(packet):
+        # Shortcut packets are not broadcast; The root sends them again to every peer it assigns the shortcuts to.
+        return PacketFactory.new_shortcut_packet(FORWARD_ADDRESS, path)
+
+    def forward_same(packet):
+        return packet
+
+    builders = [
+        ('message', lambda: PacketFactory.new_message_packet(message, SOURCE_ADDRESS), forward_message),
+        ('chunk', lambda: PacketFactory.new_message_chunk_packet(message_id, 0, 1, message, SOURCE_ADDRESS),
+         forward_message_chunk),
+        ('reunion', lambda: PacketFactory.new_reunion_packet(Packet.BODY_REQ, SOURCE_ADDRESS, path), forward_reunion),
+        ('shortcut', lambda: PacketFactory.new_shortcut_packet(SOURCE_ADDRESS, path), forward_shortcut),
+    ]
+    if not fixed_size_packets:
+        return builders
+
+    return [
+        ('register', lambda: PacketFactory.new_register_packet(Packet.BODY_REQ, SOURCE_ADDRESS, SOURCE_ADDRESS),
+         forward_same),
+        ('advertise', lambda: PacketFactory.new_advertise_packet(Packet.BODY_RES, SOURCE_ADDRESS, PATH_ENTRY),
+         forward_same),
+        ('join', lambda: PacketFactory.new_join_packet(SOURCE_ADDRESS), forward_same),
+    ] + builders
+
+
+def measure(operation, duration):
+    """
+    Run 'operation' repeatedly for about 'duration' seconds.
+
+    :return: Operations per second.
+    :rtype: float
+    """
+    iterations = 0
+    batch = 64
+    started = time.perf_counter()
+    deadline = started + duration
+    while True:
+        for _ in range(batch):
+            operation()
+        iterations += batch
+        now = time.perf_counter()
+        if now >= deadline:
+            return iterations / (now - started)
+
+
+def allocated_bytes(operation):
+    """
+    :return: Peak bytes allocated during one run of 'operation'.
+    :rtype: int
+    """
+    operation()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        operation()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks for the packet codec.')
+    parser.add_argument('--sizes', default='16,256,1024,4096', help='comma separated body sizes')
+    parser.add_argument('--duration', type=float, default=0.5, help='seconds for every measurement')
+    args = parser.parse_args()
+
+    print('%-10s %6s %-8s %12s %12s' % ('type', 'size', 'op', 'ops/sec', 'bytes/pkt'))
+    for index, size in enumerate(int(size) for size in args.sizes.split(',')):
+        for name, build, forward in packet_builders(size, fixed_size_packets=index == 0):
+            buffer = bytes(build().get_buf())
+            operations = [
+                ('build', lambda: build().get_buf()),
+                ('validate', lambda: Packet.validate_buffer(buffer)),
+                ('parse', lambda: PacketFactory.parse_buffer(buffer)),
+                ('forward', lambda: forward(PacketFactory.parse_buffer(buffer)).get_buf()),
+            ]
+            for op_name, operation in operations:
+                ops_per_sec = measure(operation, args.duration)
+                print('%-10s %6d %-8s %12.0f %12d' % (name, len(buffer) - Packet.HEADER_SIZE, op_name, ops_per_sec,
+                                                     allocated_bytes(operation)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""
+    Benchmark harness for the overlay on localhost.
+
+    A root and N peers are started in this process on separate loopback addresses (127.1.x.y) and are driven
+    through the thread-safe Peer API ('join_network' and 'send') instead of the UserInterface. For every tree size
+    it reports:
+
+        1. Join convergence time: from the first 'join_network' until every peer is attached to its parent.
+        2. Broadcast end-to-end latency percentiles: from sendMessage on the deepest peer to delivery on every peer.
+        3. Packets/sec per hop: broadcast packets carried by every tree edge per second.
+        4. Reunion failure-detection time: from stopping a leaf until the root removes it from its NetworkGraph.
+
+    Usage (from the repository root):
+
+        python -m benchmarks.overlay --sizes 3,7,15 --messages 20
+
+    With --workers N all of the peers run on a PeerHost with N worker threads instead of a thread per peer, which is
+    how overlays of thousands of peers fit in one process.
+
+    Timers are scaled with --loop-wait and --reunion-scale so a run takes seconds instead of minutes; the reported
+    numbers are meaningful relative to each other for the same settings.
+"""
+from concurrent import futures
+import argparse
+import logging
+import os
+import threading
+import time
+
+from src.Peer import Peer
+from src.PeerHost import PeerHost
+from src.tools import Log
+
+
+class OverlayBenchmark:
+    def __init__(self, size, base_ip, port, messages, timeout, shortcuts=0, workers=0):
+        """
+
+        :param size: Number of non-root peers.
+        :param base_ip: First two octets of the loopback addresses used by this run, like '127.1'.
+        :param port: TCPServer port of every Peer in this run.
+        :param messages: Number of broadcast messages for the latency and throughput measurements.
+        :param timeout: Maximum seconds to wait for every measured event.
+        :param shortcuts: Number of shortcut links the root assigns to every peer.
+        :param workers: If more than 0, run the peers on a PeerHost with this number of worker threads.
+
+        :type size: int
+        :type base_ip: str
+        :type port: int
+        :type messages: int
+        :type timeout: float
+        :type shortcuts: int
+        :type workers: int
+        """
+        self.size = size
+        self.base_ip = base_ip
+        self.port = port
+        self.messages = messages
+        self.timeout = timeout
+        self.shortcuts = shortcuts
+        self.host = PeerHost(workers) if workers > 0 else None
+
+        self.root = None
+        self.peers = []
+        self.threads = []
+
+        self.sent_times = dict()
+        self.delivery_times = dict()
+        self.lock = threading.Lock()
+
+    def peer_address(self, index):
+        return '%s.%d.%d' % (self.base_ip, index // 250, index % 250 + 1), self.port
+
+    def start(self):
+        root_address = ('%s.255.1' % self.base_ip, self.port)
+        self.root = self.__new_peer(root_address[0], root_address[1], is_root=True, shortcuts=self.shortcuts)
+
+        for index in range(self.size):
+            ip, port = self.peer_address(index)
+            peer = self.__new_peer(ip, port, is_root=False, root_address=root_address)
+            peer.add_message_listener(self.__on_message)
+            self.peers.append(peer)
+        if self.host is not None:
+            self.host.start()
+
+    def stop(self):
+        if self.host is not None:
+            self.host.stop()
+        for peer in self.peers + [self.root]:
+            peer.stop()
+
+    def __new_peer(self, ip, port, **kwargs):
+        if self.host is not None:
+            return self.host.add_peer(ip, port, **kwargs)
+        peer = Peer(ip, port, interactive=False, **kwargs)
+        thread = threading.Thread(target=peer.run)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+        return peer
+
+    def __on_message(self, source_address, message):
+        now = time.perf_counter()
+        with self.lock:
+            self.delivery_times.setdefault(message, []).append(now)
+
+    def __wait_for(self, condition):
+        deadline = time.perf_counter() + self.timeout
+        while not condition():
+            if time.perf_counter() > deadline:
+                raise TimeoutError('benchmark condition was not reached in %s seconds' % self.timeout)
+            time.sleep(0.001)
+        return time.perf_counter()
+
+    def __wait_for_futures(self, pending):
+        done, not_done = futures.wait(pending, timeout=self.timeout)
+        if not_done:
+            raise TimeoutError('%d futures were not resolved in %s seconds' % (len(not_done), self.timeout))
+        for future in done:
+            # Raise the error of a failed command.
+            future.result()
+        return time.perf_counter()
+
+    def __is_attached(self, peer):
+        if peer.parent_address is None:
+            return False
+        if peer.parent_address == self.root.address:
+            parent = self.root
+        else:
+            parent = next((p for p in self.peers if p.address == peer.parent_address), None)
+        return parent is not None and peer.address in parent.children
+
+    def measure_join(self):
+        started = time.perf_counter()
+        self.__wait_for_futures([peer.join_network() for peer in self.peers])
+        finished = self.__wait_for(lambda: all(self.__is_attached(peer) for peer in self.peers))
+        return finished - started
+
+    def tree_depth(self):
+        depths = [self.root.network_graph.find_node(*peer.address).depth for peer in self.peers]
+        return max(depths) if depths else 0
+
+    def deepest_peer(self):
+        return max(self.peers, key=lambda peer: self.root.network_graph.find_node(*peer.address).depth)
+
+    def measure_broadcast(self):
+        sender = self.deepest_peer()
+        receivers = self.size - 1
+        started = time.perf_counter()
+        sent = []
+        for index in range(self.messages):
+            message = 'bench-%d' % index
+            self.sent_times[message] = time.perf_counter()
+            sent.append(sender.send(message))
+        self.__wait_for_futures(sent)
+        finished = self.__wait_for(lambda: all(len(self.delivery_times.get(message, [])) >= receivers
+                                               for message in self.sent_times))
+
+        latencies = []
+        for message, sent_time in self.sent_times.items():
+            latencies.extend(delivered - sent_time for delivered in self.delivery_times[message])
+        packets_per_hop = self.messages / (finished - started)
+        return latencies, packets_per_hop
+
+    def measure_failure_detection(self):
+        leaf = self.deepest_peer()
+        leaf.stop()
+        started = time.perf_counter()
+        finished = self.__wait_for(lambda: self.root.network_graph.find_node(*leaf.address) is None)
+        return finished - started
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the p2p overlay on localhost.')
+    parser.add_argument('--sizes', default='3,7,15', help='comma separated numbers of non-root peers')
+    parser.add_argument('--messages', type=int, default=20, help='broadcast messages per tree size')
+    parser.add_argument('--loop-wait', type=float, default=0.01, help='Peer main loop sleep time in seconds')
+    parser.add_argument('--reunion-scale', type=float, default=0.25,
+                        help='multiplier for the reunion daemon interval and timeout')
+    parser.add_argument('--port', type=int, default=20000 + os.getpid() % 20000,
+                        help='TCPServer port of every peer; a fresh port avoids TIME_WAIT sockets of older runs')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for every measured event')
+    parser.add_argument('--shortcuts', type=int, default=0, help='shortcut links the root assigns to every peer')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='run the peers on a PeerHost with this number of worker threads; 0 runs a thread per peer')
+    parser.add_argument('--verbose', action='store_true', help='log the Peer output to stdout')
+    args = parser.parse_args()
+
+    Log.configure(level=logging.DEBUG if args.verbose else logging.CRITICAL)
+    Peer.LOOP_WAIT_TIME = args.loop_wait
+    Peer.DAEMON_THREAD_WAIT_TIME *= args.reunion_scale
+    Peer.MAXIMUM_WAIT_TIME *= args.reunion_scale
+
+    print('%6s %6s %10s %10s %10s %10s %12s %12s' % ('size', 'depth', 'join(s)', 'p50(ms)', 'p90(ms)', 'p99(ms)',
+                                                    'pkt/s/hop', 'detect(s)'))
+    for run, size in enumerate(int(size) for size in args.sizes.split(',')):
+        benchmark = OverlayBenchmark(size, '127.%d' % (run + 1), args.port, args.messages, args.timeout,
+                                      args.shortcuts, args.workers)
+        benchmark.start()
+        join_time = benchmark.measure_join()
+        depth = benchmark.tree_depth()
+        latencies, packets_per_hop = benchmark.measure_broadcast()
+        detection_time = benchmark.measure_failure_detection()
+        benchmark.stop()
+
+        print('%6d %6d %10.3f %10.2f %10.2f %10.2f %12.1f %12.3f' % (
+            size, depth, join_time, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+            percentile(latencies, 0.99) * 1000, packets_per_hop, detection_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+    Cost of the Reunion Hellos on the root, with and without root shards.
+
+    A root Peer is driven iteration by iteration in this process; Its Stream gets Reunion Hellos of --peers distinct
+    peers, --batch of them per main loop iteration, as if they had been read from the sockets. Every Hello Back goes to
+    a peer the root has no connection to, so it is dropped right after it has been made; The time of the sockets is
+    left out for both modes. For every number of shards (0 handles the Hellos in the main loop) it reports:
+
+        1. Coordinator CPU: CPU microseconds of the root process per Hello, shard processes excluded; The main loop
+           of the root is single threaded, so this bounds the Hellos per second it can serve.
+        2. Hellos/sec: wall time throughput from the first Hello until the last Hello Back has been made.
+
+    Usage (from the repository root):
+
+        python -m benchmarks.root --shards 0,1,2,4 --hellos 100000
+"""
+import argparse
+import logging
+import os
+import time
+
+from src.Packet import Packet, PacketFactory
+from src.Peer import Peer
+from src.tools import Log
+
+
+def make_hellos(peers, depth):
+    """
+    :param peers: Number of distinct senders.
+    :param depth: Number of entries in the path of every Hello, the sender included.
+
+    :type peers: int
+    :type depth: int
+
+    :return: The encoded Reunion Hellos.
+    :rtype: list
+    """
+    hellos = []
+    for index in range(peers):
+        source_address = ('010.%03d.%03d.%03d' % (index // 62500, index // 250 % 250, index % 250 + 1), '05000')
+        path = [source_address] + [('010.255.000.%03d' % hop, '05000') for hop in range(1, depth)]
+        hellos.append(bytes(PacketFactory.new_reunion_packet(Packet.BODY_REQ, source_address, path).get_buf()))
+    return hellos
+
+
+def run(shards, hellos, batch, port, timeout):
+    """
+    :return: Coordinator CPU seconds and wall seconds for all of the Hellos.
+    :rtype: tuple
+    """
+    root = Peer('127.0.0.1', port, is_root=True, interactive=False, root_shards=shards)
+    dropped = root.stream.dropped_messages
+    try:
+        expected = dropped.get() + len(hellos)
+        started, cpu_started = time.perf_counter(), time.process_time()
+        for offset in range(0, len(hellos), batch):
+            for hello in hellos[offset:offset + batch]:
+                root.stream.receive(hello)
+            root.run_iteration()
+        deadline = started + timeout
+        while dropped.get() < expected:
+            if time.perf_counter() > deadline:
+                raise TimeoutError('%d Hello Backs were not made in %s seconds' % (expected - dropped.get(), timeout))
+            root.wakeup.wait(Peer.LOOP_WAIT_TIME)
+            root.wakeup.clear()
+            root.run_iteration()
+        return time.process_time() - cpu_started, time.perf_counter() - started
+    finally:
+        root.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cost of the Reunion Hellos on the root.')
+    parser.add_argument('--shards', default='0,1,2,4', help='comma separated numbers of root shards')
+    parser.add_argument('--hellos', type=int, default=100000, help='Hellos for every number of shards')
+    parser.add_argument('--peers', type=int, default=10000, help='distinct senders of the Hellos')
+    parser.add_argument('--depth', type=int, default=8, help='entries in the path of every Hello')
+    parser.add_argument('--batch', type=int, default=256, help='Hellos read in every main loop iteration')
+    parser.add_argument('--port', type=int, default=20000 + os.getpid() % 20000, help='first TCPServer port')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for the Hello Backs')
+    args = parser.parse_args()
+
+    Log.configure(level=logging.CRITICAL)
+    distinct = make_hellos(args.peers, args.depth)
+    hellos = [distinct[index % len(distinct)] for index in range(args.hellos)]
+
+    print('%6s %10s %16s %12s' % ('shards', 'hellos', 'coordinator(us)', 'hellos/sec'))
+    for run_index, shards in enumerate(int(shards) for shards in args.shards.split(',')):
+        cpu_time, wall_time = run(shards, hellos, args.batch, args.port + run_index, args.timeout)
+        print('%6d %10d %16.2f %12.0f' % (shards, len(hellos), cpu_time / len(hellos) * 1e6, len(hellos) / wall_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+    Join/fail/heartbeat schedules for big overlays on the Simulator.
+
+    A root and N peers run on a VirtualClock with an in-memory network, so no socket, thread or sleep is involved and
+    every run with the same arguments gives the same numbers. For every overlay size it reports:
+
+        1. Join convergence time: virtual seconds from the first join until every peer is in the NetworkGraph.
+        2. Placement quality: the maximum and mean depth of the tree against a complete binary tree of the same size.
+        3. Failure detection time: virtual seconds from crashing --failures random peers until the root has removed
+           all of them from its NetworkGraph.
+        4. Recovery time: virtual seconds from the crash until every live peer is back in the NetworkGraph.
+        5. Events and wall seconds the simulation took.
+
+    Usage (from the repository root):
+
+        python -m benchmarks.simulation --sizes 1000,10000 --failures 10
+"""
+import argparse
+import logging
+import random
+import time
+
+from src.Simulator import Simulator
+from src.tools import Log
+
+
+def peer_ip(index):
+    return '10.%d.%d.%d' % (index // 62500, index // 250 % 250, index % 250 + 1)
+
+
+def optimal_depths(size):
+    """
+    :param size: Number of nodes, the root included.
+    :type size: int
+
+    :return: The maximum and mean depth of a complete binary tree with 'size' nodes.
+    :rtype: tuple
+    """
+    total, depth, remaining = 0, 0, size
+    while remaining > 0:
+        level = min(remaining, 2 ** depth)
+        total += level * depth
+        remaining -= level
+        depth += 1
+    return depth - 1, total / size
+
+
+def simulate(size, failures, join_rate, heartbeat_time, latency, seed):
+    wall_start = time.perf_counter()
+    simulator = Simulator(latency=latency, seed=seed)
+    root = simulator.add_peer('10.255.255.1', 5000, is_root=True)
+    peers = [simulator.add_peer(peer_ip(index), 5000, root_address=root.address) for index in range(size)]
+    graph = root.network_graph
+
+    for index, peer in enumerate(peers):
+        simulator.call_at(index / join_rate, peer.join_network)
+    join_time = simulator.run_until(lambda: graph.get_size() == size + 1)
+
+    depths = [node.depth for node in graph.nodes.values()]
+    max_depth, mean_depth = max(depths), sum(depths) / len(depths)
+
+    simulator.run(until=simulator.clock.time() + heartbeat_time)
+
+    failed = random.Random(seed).sample(peers, min(failures, size))
+    crash_time = simulator.clock.time()
+    for peer in failed:
+        simulator.fail_peer(peer)
+    detection_time = simulator.run_until(lambda: all(graph.find_node(*peer.address) is None for peer in failed),
+                                         step=0.5)
+    recovery_time = simulator.run_until(lambda: graph.get_size() == size + 1 - len(failed), step=0.5)
+
+    return {
+        'join': join_time,
+        'depth': max_depth,
+        'mean_depth': mean_depth,
+        'optimal': optimal_depths(size + 1),
+        'detect': None if detection_time is None else detection_time - crash_time,
+        'recover': None if recovery_time is None else recovery_time - crash_time,
+        'events': simulator.processed_events,
+        'wall': time.perf_counter() - wall_start,
+    }
+
+
+def format_time(value):
+    return '%10s' % 'timeout' if value is None else '%10.2f' % value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate join/fail/heartbeat schedules of the p2p overlay.')
+    parser.add_argument('--sizes', default='100,1000', help='comma separated numbers of non-root peers')
+    parser.add_argument('--failures', type=int, default=5, help='peers crashed at once after the heartbeats')
+    parser.add_argument('--join-rate', type=float, default=1000, help='joins per virtual second')
+    parser.add_argument('--heartbeats', type=float, default=10,
+                        help='virtual seconds of Reunion Hellos between joining and the crash')
+    parser.add_argument('--latency', type=float, default=0.001, help='virtual seconds every packet spends on a link')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the crashed peers choice')
+    parser.add_argument('--verbose', action='store_true', help='log the Peer output to stdout')
+    args = parser.parse_args()
+
+    Log.configure(level=logging.DEBUG if args.verbose else logging.CRITICAL)
+
+    print('%7s %10s %7s %7s %9s %9s %10s %10s %10s %9s' % ('size', 'join(s)', 'depth', 'best', 'mean', 'best',
+                                                           'detect(s)', 'recover(s)', 'events', 'wall(s)'))
+    for size in (int(size) for size in args.sizes.split(',')):
+        result = simulate(size, args.failures, args.join_rate, args.heartbeats, args.latency, args.seed)
+        optimal_max, optimal_mean = result['optimal']
+        print('%7d %s %7d %7d %9.2f %9.2f %s %s %10d %9.1f' % (
+            size, format_time(result['join']), result['depth'], optimal_max, result['mean_depth'], optimal_mean,
+            format_time(result['detect']), format_time(result['recover']), result['events'], result['wall']))
+
+
+if __name__ == '__main__':
+    main()
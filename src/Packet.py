@@ -26,13 +26,38 @@
         3: Join
         4: Message
         5: Reunion
+        6: Message Chunk
+        7: Shortcut
                 e.g: type = '2' => Advertise packet.
+        If the TRACE_FLAG bit (0x8000) of the type is set, the body starts with a Trace section (see below).
     Length:
         This field shows the character numbers for Body of the packet.
 
     Server IP/Port:
         We need this field for response packet in non-blocking mode.
 
+    Trace:
+        Message, Message Chunk and Reunion packets may carry an optional trace of the peers they passed through.
+        The Length field covers the Trace section too.
+
+                                ** Trace Format **
+                 ________________________________________________
+                |           Number of Entries (2 Chars)          |
+                |------------------------------------------------|
+                |                 IP0 (15 Chars)                 |
+                |------------------------------------------------|
+                |                Port0 (5 Chars)                 |
+                |------------------------------------------------|
+                |       Receive Time0 (16 Chars, microseconds)   |
+                |------------------------------------------------|
+                |       Forward Time0 (16 Chars, microseconds)   |
+                |------------------------------------------------|
+                |                     ...                        |
+                |________________________________________________|
+
+        Every peer that forwards the packet appends an entry with the time its Stream received the packet; The
+        Forward Time of the entry is written just before the packet is sent on the socket.
+
 
 
     ***** For example: ******
@@ -120,6 +145,39 @@
                 |________________________________________________|
 
             The message that want to broadcast to whole network. Right now this type only includes a plain text.
+
+        Message Chunk:
+                                ** Body Format **
+                 ________________________________________________
+                |              Message ID (8 Chars)              |
+                |------------------------------------------------|
+                |             Chunk Index (4 Chars)              |
+                |------------------------------------------------|
+                |             Chunk Count (4 Chars)              |
+                |------------------------------------------------|
+                |          Chunk Data (<= CHUNK_SIZE Chars)      |
+                |________________________________________________|
+
+            Messages longer than CHUNK_SIZE are split into chunks, so every packet fits in a single socket read.
+            Peers forward each chunk to their neighbours as soon as it arrives and only reassemble the chunks
+            (by Message ID) for their own delivery.
+
+        Shortcut:
+                                ** Body Format **
+                 ________________________________________________
+                |           Number of Entries (2 Chars)          |
+                |------------------------------------------------|
+                |                 IP0 (15 Chars)                 |
+                |------------------------------------------------|
+                |                Port0 (5 Chars)                 |
+                |------------------------------------------------|
+                |                     ...                        |
+                |________________________________________________|
+
+            The root sends this packet to a peer it has just placed with the peers it should keep extra long-range
+            links to. The peer connects to every entry and sends each of them a Shortcut packet with its own address,
+            so the link works in both directions. Only Message Chunk packets go through shortcuts, because their
+            Message ID lets peers drop the copies that arrive through more than one path.
         
         Reunion:
             Hello:
@@ -177,7 +235,12 @@
             
     
 """
+from src.tools.Address import Address
 from struct import *
+import os
+
+# Version, Type, Length, the 4 parts of the Source Server IP and the Source Server Port.
+HEADER_STRUCT = Struct('!2HL4HL')
 
 
 class Packet:
@@ -191,6 +254,13 @@ class Packet:
     JOIN = 3
     MESSAGE = 4
     REUNION = 5
+    MESSAGE_CHUNK = 6
+    SHORTCUT = 7
+    TRACE_FLAG = 0x8000
+    TYPE_NAMES = {REGISTER: 'register', ADVERTISE: 'advertise', JOIN: 'join', MESSAGE: 'message', REUNION: 'reunion',
+                  MESSAGE_CHUNK: 'message_chunk', SHORTCUT: 'shortcut'}
+    # The bulk traffic; Every other type is control traffic that keeps the overlay alive and goes first.
+    DATA_TYPES = (MESSAGE, MESSAGE_CHUNK)
 
     # body general info
     NUMBER_OF_ENTRIES_SIZE = 2
@@ -201,6 +271,20 @@ class Packet:
     BODY_JOIN = 'JOIN'
     BODY_ACK = 'ACK'
 
+    # message chunk info; a chunk packet must fit in one 2048 Bytes socket read even with 4 Bytes UTF-8 chars.
+    MESSAGE_ID_SIZE = 8
+    CHUNK_INDEX_SIZE = 4
+    CHUNK_COUNT_SIZE = 4
+    CHUNK_HEADER_SIZE = MESSAGE_ID_SIZE + CHUNK_INDEX_SIZE + CHUNK_COUNT_SIZE
+    CHUNK_SIZE = 500
+    # The Chunk Count must fit in CHUNK_COUNT_SIZE digits.
+    MAX_CHUNK_COUNT = 10 ** CHUNK_COUNT_SIZE - 1
+
+    # trace info
+    TRACE_COUNT_SIZE = 2
+    TRACE_TIME_SIZE = 16
+    TRACE_ENTRY_SIZE = IP_SIZE + PORT_SIZE + 2 * TRACE_TIME_SIZE
+
     def __init__(self, buf):
         """
         The decoded buffer should convert to a new packet.
@@ -208,11 +292,186 @@ class Packet:
         :param buf: Input buffer was just decoded.
         :type buf: str
         """
-        version_str, type_str, length_str, self.source_server_ip, self.source_server_port, self.body = buf.split('|')
-        self.version = int(version_str)
-        self.type = int(type_str)
-        self.length = int(length_str)
-        self.header = version_str + '|' + type_str + '|' + self.source_server_ip + '|' + self.source_server_port
+        # The body may contain '|' itself.
+        version_str, type_str, length_str, source_server_ip, source_server_port, body = buf.split('|', 5)
+        self.__set_fields(int(version_str), int(type_str), int(length_str), source_server_ip, source_server_port, body)
+
+    @staticmethod
+    def from_fields(version, packet_type, length, source_server_ip, source_server_port, body):
+        """
+        Make a packet from its decoded fields, without joining them to a string buffer and splitting it again.
+
+        :param version: Version field.
+        :param packet_type: Type field; It may have the TRACE_FLAG.
+        :param length: Length field.
+        :param source_server_ip: Like '192.168.001.001'.
+        :param source_server_port: Like '05335'.
+        :param body: The body; With the Trace section if 'packet_type' has the TRACE_FLAG.
+
+        :type version: int
+        :type packet_type: int
+        :type length: int
+        :type source_server_ip: str
+        :type source_server_port: str
+        :type body: str
+
+        :return: New packet.
+        :rtype: Packet
+        """
+        packet = Packet.__new__(Packet)
+        packet.__set_fields(version, packet_type, length, source_server_ip, source_server_port, body)
+        return packet
+
+    def __set_fields(self, version, packet_type, length, source_server_ip, source_server_port, body):
+        self.version = version
+        self.type = packet_type
+        self.length = length
+        self.source_server_ip = source_server_ip
+        self.source_server_port = source_server_port
+        self.body = body
+        self.trace = None
+        self.receive_time = None
+        if packet_type & Packet.TRACE_FLAG:
+            self.type &= ~Packet.TRACE_FLAG
+            self.__parse_trace()
+        self.header = str(version) + '|' + str(self.type) + '|' + source_server_ip + '|' + source_server_port
+
+    def __parse_trace(self):
+        """
+        Move the Trace section from the start of the body to 'self.trace'.
+        An invalid trace makes the length inconsistent, so the packet will be dropped by the length validation.
+
+        :return:
+        """
+        self.trace = []
+        try:
+            number_of_entries = int(self.body[:Packet.TRACE_COUNT_SIZE])
+            trace_size = Packet.TRACE_COUNT_SIZE + number_of_entries * Packet.TRACE_ENTRY_SIZE
+            for offset in range(Packet.TRACE_COUNT_SIZE, trace_size, Packet.TRACE_ENTRY_SIZE):
+                entry = self.body[offset:offset + Packet.TRACE_ENTRY_SIZE]
+                ip = entry[:Packet.IP_SIZE]
+                port = entry[Packet.IP_SIZE:Packet.IP_SIZE + Packet.PORT_SIZE]
+                receive_time = int(entry[Packet.IP_SIZE + Packet.PORT_SIZE:-Packet.TRACE_TIME_SIZE]) / 1e6
+                forward_time = int(entry[-Packet.TRACE_TIME_SIZE:]) / 1e6 or None
+                self.trace.append(((ip, port), receive_time, forward_time))
+        except ValueError:
+            self.length = -1
+            return
+        self.body = self.body[trace_size:]
+        self.length -= trace_size
+
+    def add_trace_entry(self, address, receive_time):
+        """
+        Append our entry to the trace; Its Forward Time is written by Node when the packet is sent.
+
+        :param address: Our server address.
+        :param receive_time: The time our Stream received the packet (or the packet creation time).
+
+        :type address: tuple
+        :type receive_time: float
+
+        :return:
+        """
+        if self.trace is None:
+            self.trace = []
+        self.trace.append((address, receive_time, None))
+
+    def set_trace(self, trace):
+        """
+        :param trace: [((ip, port), receive time, forward time), ...] or None for an untraced packet.
+        :type trace: list
+
+        :return:
+        """
+        self.trace = trace
+
+    def get_trace(self):
+        """
+
+        :return: [((ip, port), receive time, forward time), ...] or None if the packet is not traced.
+        :rtype: list
+        """
+        return self.trace
+
+    @staticmethod
+    def __format_trace_time(value):
+        return str(int(value * 1e6)).zfill(Packet.TRACE_TIME_SIZE) if value else '0' * Packet.TRACE_TIME_SIZE
+
+    def __get_trace_string(self):
+        entries = [str(len(self.trace)).zfill(Packet.TRACE_COUNT_SIZE)]
+        for (ip, port), receive_time, forward_time in self.trace:
+            entries.append(ip + port + Packet.__format_trace_time(receive_time) +
+                           Packet.__format_trace_time(forward_time))
+        return ''.join(entries)
+
+    @staticmethod
+    def validate_buffer(buf):
+        """
+        Check the header of an encoded packet before it is parsed, without decoding anything.
+
+        The Length field counts the characters of the body and a UTF-8 character takes 1 to 4 Bytes, so a valid
+        packet has a body of Length to 4 * Length Bytes; The exact character count is checked after decoding.
+
+        :param buf: The encoded packet.
+        :type buf: bytes
+
+        :return: Why the packet is invalid ('header', 'version', 'type' or 'length'), or None if it may be valid.
+        :rtype: str
+        """
+        if len(buf) < Packet.HEADER_SIZE:
+            return 'header'
+        version, packet_type, length = HEADER_STRUCT.unpack_from(buf)[:3]
+        if version != Packet.VERSION:
+            return 'version'
+        if packet_type & ~Packet.TRACE_FLAG not in Packet.TYPE_NAMES:
+            return 'type'
+        body_size = len(buf) - Packet.HEADER_SIZE
+        if not length <= body_size <= 4 * length:
+            return 'length'
+        return None
+
+    @staticmethod
+    def get_buffer_type(buf):
+        """
+        Read the type of an encoded packet without decoding it.
+
+        :param buf: The encoded packet.
+        :type buf: bytes
+
+        :return: The packet type without the TRACE_FLAG.
+        :rtype: int
+        """
+        return int.from_bytes(buf[2:4], 'big') & ~Packet.TRACE_FLAG
+
+    @staticmethod
+    def stamp_forward_time(buf, forward_time):
+        """
+        Write the Forward Time of the last trace entry in an encoded packet, if it is traced and not stamped yet.
+        The trace is at the start of the body and only has ASCII chars, so its offsets are the same in bytes.
+
+        :param buf: The encoded packet.
+        :param forward_time: The time the packet is sent.
+
+        :type buf: bytes
+        :type forward_time: float
+
+        :return: The encoded packet with the stamp.
+        :rtype: bytes
+        """
+        if len(buf) < Packet.HEADER_SIZE + Packet.TRACE_COUNT_SIZE or not buf[2] & (Packet.TRACE_FLAG >> 8):
+            return buf
+        try:
+            number_of_entries = int(buf[Packet.HEADER_SIZE:Packet.HEADER_SIZE + Packet.TRACE_COUNT_SIZE])
+        except ValueError:
+            return buf
+        if number_of_entries == 0:
+            return buf
+        offset = Packet.HEADER_SIZE + Packet.TRACE_COUNT_SIZE + number_of_entries * Packet.TRACE_ENTRY_SIZE - \
+            Packet.TRACE_TIME_SIZE
+        if buf[offset:offset + Packet.TRACE_TIME_SIZE] != b'0' * Packet.TRACE_TIME_SIZE:
+            return buf
+        return buf[:offset] + Packet.__format_trace_time(forward_time).encode('ascii') + \
+            buf[offset + Packet.TRACE_TIME_SIZE:]
 
     def get_header(self):
         """
@@ -259,15 +518,20 @@ class Packet:
         In this function, we will make our final buffer that represents the Packet with the Struct class methods.
 
         :return The parsed packet to the network format.
-        :rtype: bytearray
+        :rtype: bytes
         """
-
         ip_part1_str, ip_part2_str, ip_part3_str, ip_part4_str = self.source_server_ip.split('.')
 
-        header_bytearray = pack('!2HL4HL', self.version, self.type, self.length, int(ip_part1_str),
-                                int(ip_part2_str), int(ip_part3_str), int(ip_part4_str), int(self.source_server_port))
-        body_bytearray = bytearray(self.get_body(), 'utf-8')
-        return header_bytearray + body_bytearray
+        packet_type, length, body = self.type, self.length, self.get_body()
+        if self.trace is not None:
+            trace_string = self.__get_trace_string()
+            packet_type |= Packet.TRACE_FLAG
+            length += len(trace_string)
+            body = trace_string + body
+
+        return HEADER_STRUCT.pack(self.version, packet_type, length, int(ip_part1_str), int(ip_part2_str),
+                                  int(ip_part3_str), int(ip_part4_str), int(self.source_server_port)) + \
+            body.encode('utf-8')
 
     def get_source_server_ip(self):
         """
@@ -289,9 +553,9 @@ class Packet:
         """
 
         :return: Server address; The format is like ('192.168.001.001', '05335').
-        :rtype: tuple
+        :rtype: Address
         """
-        return self.source_server_ip, self.source_server_port
+        return Address.parse((self.source_server_ip, self.source_server_port))
 
 
 class PacketFactory:
@@ -309,20 +573,16 @@ class PacketFactory:
         :return new packet
         :rtype: Packet
 
+        :raises UnicodeDecodeError: If the body is not UTF-8 text.
         """
-        raw_header, raw_body = unpack('!' + str(Packet.HEADER_SIZE) + 's' + str(len(buffer) - Packet.HEADER_SIZE) + 's',
-                                      buffer)
-        version, packet_type, length, raw_source_server_ip, source_server_port = unpack('!2HL8sL', raw_header)
-        ip_part1, ip_part2, ip_part3, ip_part4 = unpack('!4H', raw_source_server_ip)
-        source_server_ip = '.'.join([str(ip_part1).zfill(3), str(ip_part2).zfill(3), str(ip_part3).zfill(3),
-                                     str(ip_part4).zfill(3)])
-
-        body = raw_body.decode('utf-8')
+        view = memoryview(buffer)
+        version, packet_type, length, ip_part1, ip_part2, ip_part3, ip_part4, source_server_port = \
+            HEADER_STRUCT.unpack_from(view)
+        source_server_ip = '%03d.%03d.%03d.%03d' % (ip_part1, ip_part2, ip_part3, ip_part4)
 
-        string_buffer = '|'.join(
-            [str(version), str(packet_type), str(length), source_server_ip, str(source_server_port).zfill(5), body])
+        body = str(view[Packet.HEADER_SIZE:], 'utf-8')
 
-        return Packet(string_buffer)
+        return Packet.from_fields(version, packet_type, length, source_server_ip, '%05d' % source_server_port, body)
 
     @staticmethod
     def new_reunion_packet(type, source_address, nodes_array):
@@ -447,7 +707,82 @@ class PacketFactory:
 
         source_ip, source_port = source_server_address[0], source_server_address[1]
         packet_length = len(message)
-        header = '|'.join([str(Packet.VERSION), str(Packet.MESSAGE), str(packet_length), source_ip, source_port])
-        body = message
+        return Packet.from_fields(Packet.VERSION, Packet.MESSAGE, packet_length, source_ip, source_port, message)
+
+    @staticmethod
+    def new_message_chunk_packet(message_id, chunk_index, chunk_count, chunk, source_server_address):
+        """
+        Packet for sending one chunk of a large broadcast message.
+
+        :param message_id: Unique ID of the chunked message (Packet.MESSAGE_ID_SIZE chars).
+        :param chunk_index: Position of this chunk in the message.
+        :param chunk_count: Number of chunks in the message.
+        :param chunk: The chunk data.
+        :param source_server_address: Server address of the packet sender.
+
+        :type message_id: str
+        :type chunk_index: int
+        :type chunk_count: int
+        :type chunk: str
+        :type source_server_address: tuple
+
+        :return: New Message Chunk packet.
+        :rtype: Packet
+        """
+
+        source_ip, source_port = source_server_address[0], source_server_address[1]
+        body = message_id + str(chunk_index).zfill(Packet.CHUNK_INDEX_SIZE) + \
+            str(chunk_count).zfill(Packet.CHUNK_COUNT_SIZE) + chunk
+        return Packet.from_fields(Packet.VERSION, Packet.MESSAGE_CHUNK, len(body), source_ip, source_port, body)
+
+    @staticmethod
+    def new_shortcut_packet(source_server_address, addresses):
+        """
+        :param source_server_address: Server address of the packet sender.
+        :param addresses: [(ip0, port0), (ip1, port1), ...] The peers to make shortcut links with.
+
+        :type source_server_address: tuple
+        :type addresses: list
+
+        :return: New Shortcut packet.
+        :rtype: Packet
+        """
+
+        source_ip, source_port = source_server_address[0], source_server_address[1]
+        body = str(len(addresses)).zfill(Packet.NUMBER_OF_ENTRIES_SIZE) + ''.join(ip + port for ip, port in addresses)
+        header = '|'.join([str(Packet.VERSION), str(Packet.SHORTCUT), str(len(body)), source_ip, source_port])
         string_buffer = '|'.join([header, body])
         return Packet(string_buffer)
+
+    @staticmethod
+    def new_message_chunk_packets(message, source_server_address, chunk_size=Packet.CHUNK_SIZE):
+        """
+        Split a large broadcast message into Message Chunk packets.
+        The packets are made lazily; Peer.feed_broadcast_messages takes a few of them in every main loop iteration,
+        so a long message is not held whole in the out_buff of every neighbour.
+
+        :param message: Our message
+        :param source_server_address: Server address of the packet sender.
+        :param chunk_size: Maximum number of message chars in every chunk.
+
+        :type message: str
+        :type source_server_address: tuple
+        :type chunk_size: int
+
+        :return: Generator of the new Message Chunk packets.
+        :rtype: generator
+
+        :raises ValueError: If the message needs more than Packet.MAX_CHUNK_COUNT chunks.
+        """
+        chunk_count = (len(message) + chunk_size - 1) // chunk_size
+        if chunk_count > Packet.MAX_CHUNK_COUNT:
+            raise ValueError('message needs %d chunks; at most %d are allowed' % (chunk_count, Packet.MAX_CHUNK_COUNT))
+        return PacketFactory.__make_message_chunk_packets(message, source_server_address, chunk_size, chunk_count)
+
+    @staticmethod
+    def __make_message_chunk_packets(message, source_server_address, chunk_size, chunk_count):
+        message_id = os.urandom(Packet.MESSAGE_ID_SIZE // 2).hex()
+        for chunk_index in range(chunk_count):
+            chunk = message[chunk_index * chunk_size:(chunk_index + 1) * chunk_size]
+            yield PacketFactory.new_message_chunk_packet(message_id, chunk_index, chunk_count, chunk,
+                                                         source_server_address)
@@ -1,10 +1,24 @@
 from src.tools.Node import Node
 from src.Stream import Stream
 from src.Packet import Packet, PacketFactory
-from src.UserInterface import UserInterface
+from src.UserInterface import UserInterface, Command
 from src.tools.NetworkGraph import NetworkGraph, GraphNode
+from src.tools.Metrics import MetricsRegistry, MetricsServer
+from src.tools.Trace import TraceRecorder
+from src.tools.Profiler import LoopProfiler
+from src.tools.ShardedRoot import ShardedRegistry
+from src.tools.DeadlineHeap import DeadlineHeap
+from src.tools.Address import Address
+from src.tools.Subscription import Subscription
+from src.tools.Clock import Clock
+from src.tools import Log
+from concurrent.futures import Future
+from collections import deque
+import logging
+import queue
 import time
 import threading
+import zlib
 
 """
     Peer is our main object in this project.
@@ -13,12 +27,30 @@ import threading
     
 """
 
+logger = logging.getLogger('p2p.peer')
+packet_logger = logging.getLogger(Log.PACKET_LOGGER_NAME)
+
 
 class Peer:
     DAEMON_THREAD_WAIT_TIME = 4
     MAXIMUM_WAIT_TIME = 2 * 2 * 8 + 4
-
-    def __init__(self, server_ip, server_port, is_root=False, root_address=None):
+    MAX_PENDING_CHUNKED_MESSAGES = 16
+    # Message chars of the incomplete chunked messages we keep; Enough for the largest message on its own.
+    MAX_PENDING_CHUNK_CHARS = Packet.MAX_CHUNK_COUNT * Packet.CHUNK_SIZE
+    # Enough to deduplicate every chunk of the largest message while the chunks of another one arrive.
+    MAX_SEEN_CHUNKS = 2 * Packet.MAX_CHUNK_COUNT
+    LOOP_WAIT_TIME = 2
+    # Data packets handled in one main loop iteration; The rest wait for the next one, which starts at once, so the
+    # iterations stay short and the control packets that arrive meanwhile are not held up by a flood.
+    MAX_DATA_PACKETS_PER_ITERATION = 256
+    # Commands handled in one main loop iteration, for the same reason; A long message is many Message Chunks.
+    MAX_COMMANDS_PER_ITERATION = 32
+    # Packets of every message we broadcast that are made and queued in one main loop iteration; The rest of a long
+    # message waits in its generator instead of in the out_buff of every neighbour.
+    BROADCAST_PACKETS_PER_ITERATION = 16
+
+    def __init__(self, server_ip, server_port, is_root=False, root_address=None, interactive=True,
+                 metrics_port=None, root_shards=0, replicas=None, shortcuts=0, host=None, clock=None):
         """
         The Peer object constructor.
 
@@ -38,43 +70,144 @@ class Peer:
         :param server_ip: Server IP address for this Peer that should be pass to Stream.
         :param server_port: Server Port address for this Peer that should be pass to Stream.
         :param is_root: Specify that is this Peer root or not.
-        :param root_address: Root IP/Port address if we are a client.
+        :param root_address: Root IP/Port address if we are a client; A list of replicated roots is also accepted, we
+                             register at the one picked by a hash of our address and fail over to the next one when
+                             its register_connection dies. For a root Peer it makes a replicated root: We place and
+                             watch the peers that register at us in our own sub-tree, which we attach to the overlay
+                             through this (primary) root like any other peer.
+        :param interactive: Start the UserInterface thread; Disable it when the Peer is driven by code.
+        :param metrics_port: If given, our metrics are served over HTTP on http://server_ip:metrics_port/metrics.
+        :param root_shards: For the root Peer; If it is more than 0, registration, Reunion Hello deadlines and the
+                            Hello Backs run in this number of worker processes (see ShardedRegistry). The shards time
+                            the Hellos with the system monotonic clock, so it needs our default Clock.
+        :param replicas: For the primary root Peer; Addresses of our replicated roots. We never place other peers in
+                         their sub-trees, because they place their own peers there.
+        :param shortcuts: For the root Peer; Number of long-range shortcut links assigned to every peer we place.
+                          Message Chunk packets are also broadcast through shortcuts and deduplicated by Message ID.
+        :param host: The PeerHost (or Simulator) that runs us; Our main loop, reunion daemon and TCPServer then run on
+                     its shared threads, so we start none of our own. It also makes our Stream and gives our Clock.
+        :param clock: Our time source; Every Reunion timer and Hello deadline uses its monotonic time, so a step of the
+                      wall clock can not expire the peers at once. Our Stream uses it too, e.g. for the ingress limits.
+                      The system clocks by default; Not used with a host.
 
         :type server_ip: str
         :type server_port: int
         :type is_root: bool
-        :type root_address: tuple
+        :type root_address: tuple | list
+        :type interactive: bool
+        :type metrics_port: int
+        :type root_shards: int
+        :type replicas: list
+        :type shortcuts: int
+        :type host: PeerHost
+        :type clock: Clock
+
+        :raises ValueError: If root shards are asked for with a Clock that is not the system one.
         """
-        self.address = (Node.parse_ip(server_ip), Node.parse_port(str(server_port)))
-        self.root_address = None if root_address is None else Node.parse_address(root_address)
-        self.stream = Stream(server_ip, server_port, root_address)
+        if host is not None:
+            clock = host.clock
+        if root_shards > 0 and clock is not None and type(clock) is not Clock:
+            raise ValueError('root shards need the system clock; %s is not supported' % type(clock).__name__)
+        self.address = Address.parse((server_ip, server_port))
+        if root_address is None:
+            self.root_addresses = []
+        elif isinstance(root_address, list):
+            self.root_addresses = [Node.parse_address(address) for address in root_address]
+        else:
+            self.root_addresses = [Node.parse_address(root_address)]
+        self.root_address = self.__choose_root()
+        self.metrics = MetricsRegistry()
+        self.host = host
+        if host is None:
+            self.clock = Clock() if clock is None else clock
+            self.stream = Stream(server_ip, server_port, self.root_address, metrics=self.metrics, is_root=is_root,
+                                 clock=self.clock)
+        else:
+            self.clock = host.clock
+            self.stream = host.new_stream(server_ip, server_port, self.root_address, self.metrics, is_root)
         self.packet_factory = PacketFactory()
-        self.ui = UserInterface()
+        self.ui = UserInterface(self.submit)
         self.ui.daemon = True
         self.is_root = is_root
         self.parent_address = None
+        # The parent we lost in a Reunion failure; Its unacknowledged broadcasts go to the next parent.
+        self.lost_parent_address = None
         self.children = []
+        self.shortcut_count = shortcuts
+        self.shortcuts = []
 
         self.network_graph = None
         self.registered_peers = None
+        self.shard_registry = None
+
+        self.pending_chunked_messages = dict()
+        self.pending_chunk_chars = 0
+        # The messages we broadcast that still have packets to queue; [(packets, future), ...]
+        self.outgoing_messages = deque()
+        self.seen_chunks = dict()
+        self.message_listeners = []
+        self.commands = queue.SimpleQueue()
+        self.wakeup = threading.Event()
+        self.join_futures = []
+        self.main_thread = None
+        self.running = True
 
         self.waiting_for_hello_back = False
         self.last_sent_hello_time = None
         self.reunion_daemon = threading.Thread(target=self.run_reunion_daemon)
         self.reunion_daemon.daemon = True
 
+        self.packets_received = {packet_type: self.metrics.counter('packets_received_total',
+                                                                   'Valid packets received by type.', type=type_name)
+                                 for packet_type, type_name in Packet.TYPE_NAMES.items()}
+        self.packet_handlers = {Packet.REGISTER: self.__handle_register_packet,
+                                Packet.ADVERTISE: self.__handle_advertise_packet,
+                                Packet.JOIN: self.__handle_join_packet,
+                                Packet.MESSAGE: self.__handle_message_packet,
+                                Packet.REUNION: self.__handle_reunion_packet,
+                                Packet.MESSAGE_CHUNK: self.__handle_message_chunk_packet,
+                                Packet.SHORTCUT: self.__handle_shortcut_packet}
+        self.duplicate_chunks = self.metrics.counter('broadcast_duplicates_total',
+                                                     'Message Chunk packets dropped because they arrived before.')
+        self.retransmitted_messages = self.metrics.counter('broadcast_retransmitted_total',
+                                                           'Broadcast packets sent again to a new parent.')
+        self.reunion_rtt = self.metrics.histogram('reunion_rtt_seconds',
+                                                  'Time between sending Reunion Hello and receiving its Hello Back.')
+        self.tracing = False
+        self.trace_recorder = TraceRecorder(self.metrics)
+        self.profiler = LoopProfiler(self.metrics)
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, Node.get_socket_ip(self.address[0]), metrics_port)
+
         if is_root:
             root_graph_node = GraphNode(self.address)
             root_graph_node.depth = 0
             self.network_graph = NetworkGraph(root_graph_node)
+            self.metrics.gauge('network_graph_size', 'Nodes in our NetworkGraph.').set_function(
+                self.network_graph.get_size)
+            self.metrics.gauge('network_graph_depth', 'Depth of our NetworkGraph.').set_function(
+                self.network_graph.get_depth)
+            for replica_address in replicas or []:
+                self.network_graph.reserve_subtree(Node.parse_address(replica_address))
             self.registered_peers = dict()
-            self.last_received_hello_times = dict()
-            self.reunion_daemon.start()
-        elif root_address is not None:
-            self.stream.add_node(root_address, set_register_connection=True)
+            self.hello_deadlines = DeadlineHeap()
+            if root_shards > 0:
+                # 'wakeup' is looked up on every call, because a PeerHost replaces it.
+                self.shard_registry = ShardedRegistry(root_shards, self.address, self.MAXIMUM_WAIT_TIME,
+                                                      self.DAEMON_THREAD_WAIT_TIME,
+                                                      on_results=lambda: self.wakeup.set())
+            if host is None:
+                self.reunion_daemon.start()
+        if self.root_address is not None:
+            self.stream.add_node(self.root_address, set_register_connection=True)
+            if is_root:
+                self.send_register_request()
+                self.send_advertise_request()
 
-        self.start_user_interface()
-        print('Peer initialized.')
+        if interactive:
+            self.start_user_interface()
+        logger.info('peer %s initialized', self.address)
 
     def start_user_interface(self):
         """
@@ -85,46 +218,311 @@ class Peer:
 
         self.ui.start()
 
-    def handle_user_interface_buffer(self):
+    def handle_commands(self):
         """
-        In every interval, we should parse user command that buffered from our UserInterface.
-        All of the valid commands a re listed below:
-            1. Register:  With this command, the client send a Register Request packet to the root of the network.
-            2. Advertise: Send an Advertise Request to the root of the network for finding first hope.
-            3. SendMessage: The following string will be added to a new Message packet and broadcast through the network.
+        In every iteration, we handle the commands queued by our UserInterface, 'submit_command' and 'send'.
+        All of the valid commands are listed below:
+            1. register: Send a Register Request packet to the root of the network.
+            2. advertise: Send an Advertise Request to the root of the network for finding our parent.
+            3. joinNetwork: Both of them; Its future is resolved with our parent address when the Advertise Response
+               arrives.
+            4. sendMessage text: The text will be broadcast through the network; Its future is resolved when the
+               last of its packets is sent to our neighbours (see 'feed_broadcast_messages').
+            5. trace on/off: Start or stop tracing the Message and Reunion packets we send.
+            6. showTraces: Log (and return) the mean queueing and wire time of every hop in the recorded traces.
+            7. profile N: Log the cProfile stats of the next N main loop iterations.
+            8. profileTo N path: Save the cProfile stats of the next N main loop iterations to 'path'.
+            9. dumpMetrics path: Write our metrics to 'path' in the Prometheus text format.
 
         Warnings:
-            1. Ignore irregular commands from the user.
-            2. Don't forget to clear our UserInterface buffer.
+            1. Irregular commands are ignored; Their future gets a ValueError.
+
+        At most Peer.MAX_COMMANDS_PER_ITERATION commands are handled; The rest wait for the next iteration.
+
+        :return:
+        """
+        for _ in range(self.MAX_COMMANDS_PER_ITERATION):
+            try:
+                command = self.commands.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = self.__handle_command(command.name, command.arguments, command.future)
+            except Exception as error:
+                logger.warning('command %s %s failed: %s', command.name, command.arguments, error)
+                if command.future is not None:
+                    self.__resolve_future(command.future, error=error)
+                continue
+            if command.future is None or command.name == 'sendMessage':
+                continue
+            if command.name == 'joinNetwork':
+                self.join_futures.append(command.future)
+            else:
+                self.__resolve_future(command.future, result)
+        # Start the next iteration at once for the commands that are left.
+        self.wakeup.set()
+
+    def __handle_command(self, name, arguments, future=None):
+        """
+        :param name: Command name.
+        :param arguments: Command arguments.
+        :param future: Future of the command; 'sendMessage' keeps it until the message is sent.
+
+        :type name: str
+        :type arguments: tuple
+        :type future: Future
+
+        :return: The result of the command, if it has one.
+
+        :raises ValueError: If the command or its arguments are not valid.
+        """
+        if name == 'sendMessage' and len(arguments) == 1:
+            self.send_broadcast_message(arguments[0], future)
+        elif name in ('register', 'advertise', 'joinNetwork') and not arguments and self.root_address is not None:
+            if name != 'advertise':
+                self.send_register_request()
+            if name != 'register':
+                self.send_advertise_request()
+        elif name == 'trace' and arguments in (('on',), ('off',)):
+            self.tracing = arguments[0] == 'on'
+        elif name == 'showTraces' and not arguments:
+            summary = self.trace_recorder.summary()
+            for peer_address, (queueing, wire, count) in summary.items():
+                logger.info('hop %s: queueing %.6fs, wire %.6fs over %d packets', peer_address, queueing, wire, count)
+            return summary
+        elif name == 'profile' and len(arguments) == 1 and str(arguments[0]).isdigit():
+            self.profiler.start_capture(int(arguments[0]))
+        elif name == 'profileTo' and len(arguments) == 2 and str(arguments[0]).isdigit():
+            self.profiler.start_capture(int(arguments[0]), arguments[1])
+        elif name == 'dumpMetrics' and len(arguments) == 1:
+            self.metrics.dump(arguments[0])
+        elif name == 'suicide' and not self.is_root:
+            exit(1)
+        else:
+            raise ValueError('invalid command')
+
+    def submit_command(self, name, *arguments):
+        """
+        Queue a command (see 'handle_commands') for our main loop and wake it up; It can be called from any thread.
+
+        :param name: Command name like 'sendMessage'.
+        :param arguments: Command arguments.
+
+        :type name: str
+        :type arguments: str
+
+        :return: Resolved with the result of the command; RuntimeError if the Peer is stopped before that.
+        :rtype: Future
+        """
+        future = Future()
+        self.submit(Command(name, arguments, future))
+        return future
+
+    def submit(self, command):
+        """
+        Queue a Command for our main loop and wake it up; It can be called from any thread.
+
+        :param command: The command.
+        :type command: Command
+
         :return:
         """
-        i = 0
-        ui_buffer_snapshot_size = len(self.ui.buffer)
-        while i < ui_buffer_snapshot_size:
-            cmd = self.ui.buffer[i]
-            if cmd == 'sendMessage':
-                msg = self.ui.buffer[i + 1]
-                broadcast_packet = self.packet_factory.new_message_packet(msg, self.address)
-                self.send_broadcast_packet(broadcast_packet)
-                i += 2
+        if not self.running and command.future is not None:
+            self.__resolve_future(command.future, error=RuntimeError('peer is stopped'))
+            return
+        self.commands.put(command)
+        self.wakeup.set()
+
+    def send_register_request(self):
+        """
+        Send a Register Request packet to the root of the network through our register_connection.
 
-            if self.is_root:
+        :return:
+        """
+        register_packet = self.packet_factory.new_register_packet(Packet.BODY_REQ, self.address, self.address)
+        logger.debug('sending register request %s', register_packet.get_buf())
+        self.stream.add_message_to_out_buff(self.root_address, register_packet.get_buf(), is_register_node=True)
+
+    def send_advertise_request(self):
+        """
+        Send an Advertise Request packet to the root of the network for finding our parent.
+
+        :return:
+        """
+        advertise_packet = self.packet_factory.new_advertise_packet(Packet.BODY_REQ, self.address)
+        logger.debug('sending advertise request %s', advertise_packet.get_buf())
+        self.stream.add_message_to_out_buff(self.root_address, advertise_packet.get_buf(), is_register_node=True)
+
+    def __choose_root(self):
+        """
+        Pick our root from the replicated roots by a hash of our address, so the peers are spread between them.
+
+        :return: The chosen root address, or None if we do not have any.
+        :rtype: Address
+        """
+        if not self.root_addresses:
+            return None
+        index = zlib.crc32((self.address[0] + self.address[1]).encode('ascii')) % len(self.root_addresses)
+        return self.root_addresses[index]
+
+    def __fail_over_root(self):
+        """
+        Move our register_connection to the next replicated root that accepts a connection and register there.
+        With a single root it only reconnects to it.
+
+        :return:
+        """
+        index = self.root_addresses.index(self.root_address)
+        for offset in range(1, len(self.root_addresses) + 1):
+            root_address = self.root_addresses[(index + offset) % len(self.root_addresses)]
+            try:
+                self.stream.set_root_address(root_address)
+            except ConnectionError:
+                logger.warning('root %s is not reachable', root_address)
                 continue
-            if cmd == 'register':
-                register_packet = self.packet_factory.new_register_packet(Packet.BODY_REQ, self.address, self.address)
-                print(register_packet.get_buf())
-                self.stream.add_message_to_out_buff(self.root_address, register_packet.get_buf(), is_register_node=True)
-                # print('register packet created')
-            elif cmd == 'advertise':
-                advertise_packet = self.packet_factory.new_advertise_packet(Packet.BODY_REQ, self.address)
-                print('sending', advertise_packet.get_buf())
-                self.stream.add_message_to_out_buff(self.root_address, advertise_packet.get_buf(),
-                                                    is_register_node=True)
-            elif cmd == 'suicide':
-                exit(1)
-            i += 1
-
-        self.ui.buffer = self.ui.buffer[ui_buffer_snapshot_size:]
+            logger.info('failing over to root %s', root_address)
+            self.root_address = root_address
+            self.send_register_request()
+            return
+        logger.error('no root is reachable')
+
+    def add_message_listener(self, listener):
+        """
+        Register a function that will be called for every broadcast message delivered to this Peer.
+        Listeners run on the main loop thread, so they should return quickly.
+
+        :param listener: Function that takes the sender neighbour address and the message.
+        :type listener: function
+
+        :return:
+        """
+        # Copy on write; The main loop iterates the old list without a lock.
+        self.message_listeners = self.message_listeners + [listener]
+
+    def remove_message_listener(self, listener):
+        """
+        :param listener: A function given to 'add_message_listener' before; Nothing happens for unknown functions.
+        :type listener: function
+
+        :return:
+        """
+        self.message_listeners = [function for function in self.message_listeners if function != listener]
+
+    def subscribe(self):
+        """
+        Receive the broadcast messages delivered to this Peer from now on, in a thread or in asyncio code:
+
+            for source_address, message in peer.subscribe(): ...
+            async for source_address, message in peer.subscribe(): ...
+
+        :return: New subscription; Close it when it is not needed anymore.
+        :rtype: Subscription
+        """
+        subscription = Subscription(on_close=lambda closed: self.remove_message_listener(closed.deliver))
+        self.add_message_listener(subscription.deliver)
+        return subscription
+
+    def send(self, data):
+        """
+        Broadcast a message through the network; It can be called from any thread.
+        The main loop makes the packets in its next iteration, so a high message rate never waits for the sockets.
+
+        :param data: The message; Bytes must be UTF-8 text, because packet bodies are text.
+        :type data: bytes | str
+
+        :return: Resolved with None when the packets have been sent to our neighbours; A ValueError if the data is
+                 not UTF-8 text or a RuntimeError if the Peer is stopped before that.
+        :rtype: Future
+        """
+        if isinstance(data, bytes):
+            try:
+                data = data.decode('utf-8')
+            except UnicodeDecodeError as error:
+                future = Future()
+                future.set_exception(ValueError('message is not UTF-8 text: %s' % error))
+                return future
+        return self.submit_command('sendMessage', data)
+
+    def join_network(self):
+        """
+        Register at our root and ask it for a parent; It can be called from any thread.
+
+        :return: Resolved with our parent address when the Advertise Response arrives; Right away for the root.
+        :rtype: Future
+        """
+        if self.root_address is None:
+            future = Future()
+            future.set_result(None)
+            return future
+        return self.submit_command('joinNetwork')
+
+    def is_joined(self):
+        """
+        :return: Whether we are attached to the overlay; The root always is.
+        :rtype: bool
+        """
+        return self.root_address is None or self.parent_address is not None
+
+    def get_wait_time(self):
+        """
+        :return: Seconds our main loop may sleep after an iteration; Not long while our Stream holds back data for a
+                 full window, because the ACKs that free it do not wake us up, and none while the window is free
+                 for the rest of the messages we broadcast.
+        :rtype: float
+        """
+        if self.stream.is_window_full():
+            return Stream.WINDOW_POLL_INTERVAL
+        return 0 if self.outgoing_messages else self.LOOP_WAIT_TIME
+
+    def is_running(self):
+        """
+        :return: Whether our main loop is running.
+        :rtype: bool
+        """
+        if self.host is not None:
+            return self.running and self.host.is_running()
+        return self.running and self.main_thread is not None and self.main_thread.is_alive()
+
+    def start(self):
+        """
+        Run our main loop in a daemon thread, so the Peer can be embedded in another program.
+
+        :return: This Peer.
+        :rtype: Peer
+        """
+        # A hosted Peer runs on the threads of its PeerHost.
+        if self.host is None and self.main_thread is None:
+            self.main_thread = threading.Thread(target=self.run)
+            self.main_thread.daemon = True
+            self.main_thread.start()
+        return self
+
+    def join(self, timeout=None):
+        """
+        Wait until the main loop thread started by 'start' exits.
+
+        :param timeout: Maximum seconds to wait; None waits forever.
+        :type timeout: float
+
+        :return: Whether the main loop has exited.
+        :rtype: bool
+        """
+        if self.main_thread is None:
+            return True
+        self.main_thread.join(timeout)
+        return not self.main_thread.is_alive()
+
+    def stop(self):
+        """
+        Stop the main loop and the reunion daemon after their current iteration.
+        Our TCPServer keeps accepting connections until the process exits.
+
+        :return:
+        """
+        self.running = False
+        self.wakeup.set()
+        if self.shard_registry is not None:
+            self.shard_registry.close()
 
     def run(self):
         """
@@ -146,20 +544,155 @@ class Peer:
         """
         # TODO warnings handling
 
+        while self.running:
+            self.run_iteration()
+            # Sleep, unless a command arrives in the meantime.
+            self.wakeup.wait(self.get_wait_time())
+            self.wakeup.clear()
+        self.fail_pending_futures()
+
+    def fail_pending_futures(self):
+        """
+        Fail the futures of the commands that are still queued, of the messages that are not sent yet and of
+        'join_network', once our main loop has exited.
+
+        :return:
+        """
+        stopped = RuntimeError('peer is stopped')
         while True:
-            self.handle_user_interface_buffer()
-            stream_in_buff_snapshot = self.stream.read_in_buf()
-            snapshot_size = len(stream_in_buff_snapshot)
-            if snapshot_size != 0:
-                print(stream_in_buff_snapshot)
-            for message in stream_in_buff_snapshot:
-                packet = self.packet_factory.parse_buffer(message)
-                # print('packet:', packet.get_buf())
-                self.handle_packet(packet)
-
-            self.stream.clear_in_buff(snapshot_size)
-            self.stream.send_out_buf_messages()
-            time.sleep(2)
+            try:
+                command = self.commands.get_nowait()
+            except queue.Empty:
+                break
+            if command.future is not None:
+                self.__resolve_future(command.future, error=stopped)
+        outgoing_messages, self.outgoing_messages = self.outgoing_messages, deque()
+        for _, future in outgoing_messages:
+            if future is not None:
+                self.__resolve_future(future, error=stopped)
+        join_futures, self.join_futures = self.join_futures, []
+        for future in join_futures:
+            self.__resolve_future(future, error=stopped)
+
+    @staticmethod
+    def __resolve_future(future, result=None, error=None):
+        """
+        Resolve the future of a command, unless its caller has cancelled it.
+
+        :param future: The future.
+        :param result: Its result.
+        :param error: Its exception; None for a result.
+
+        :type future: Future
+        :type error: Exception
+
+        :return:
+        """
+        # After this, 'cancel' fails, so the caller can not cancel it between our check and our result.
+        if not future.set_running_or_notify_cancel():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def run_iteration(self):
+        """
+        One iteration of the main loop; The wall time of every phase is given to our LoopProfiler.
+
+        :return:
+        """
+        profiler = self.profiler
+        profiler.begin_iteration()
+        iteration_start = phase_start = time.perf_counter()
+
+        self.handle_commands()
+        sent_futures = self.feed_broadcast_messages()
+        now = time.perf_counter()
+        profiler.observe('handle_commands', now - phase_start)
+
+        stream_in_buff_snapshot = list(self.stream.read_in_buf())
+        snapshot_size = len(stream_in_buff_snapshot)
+        if snapshot_size != 0:
+            packet_logger.debug('read %d buffers from stream', snapshot_size)
+        # Under a flood, control packets are handled and passed on first, so the data can not hold up the Reunion.
+        control_buffers, data_buffers, deferred_buffers = [], stream_in_buff_snapshot, []
+        if snapshot_size > self.MAX_DATA_PACKETS_PER_ITERATION:
+            data_buffers = []
+            for entry in stream_in_buff_snapshot:
+                if Packet.get_buffer_type(entry[0]) in Packet.DATA_TYPES:
+                    data_buffers.append(entry)
+                else:
+                    control_buffers.append(entry)
+            deferred_buffers = data_buffers[self.MAX_DATA_PACKETS_PER_ITERATION:]
+            del data_buffers[self.MAX_DATA_PACKETS_PER_ITERATION:]
+
+        parse_time, handle_time = self.__handle_buffers(control_buffers)
+        send_time = 0
+        if control_buffers and data_buffers:
+            phase_start = time.perf_counter()
+            self.stream.send_out_buf_messages(only_control=True)
+            send_time = time.perf_counter() - phase_start
+        data_parse_time, data_handle_time = self.__handle_buffers(data_buffers)
+        profiler.observe('parse_buffer', parse_time + data_parse_time)
+        profiler.observe('handle_packet', handle_time + data_handle_time)
+
+        self.stream.clear_in_buff(snapshot_size, deferred_buffers)
+        if deferred_buffers:
+            self.wakeup.set()
+        if self.shard_registry is not None:
+            self.shard_registry.flush()
+            self.__handle_shard_results()
+        phase_start = time.perf_counter()
+        self.stream.send_out_buf_messages()
+        for future in sent_futures:
+            self.__resolve_future(future)
+        now = time.perf_counter()
+        profiler.observe('send_out_buf_messages', now - phase_start + send_time)
+        profiler.observe('iteration', now - iteration_start)
+        profiler.end_iteration()
+
+    def __handle_buffers(self, buffers):
+        """
+        Parse and handle buffers of our Stream.
+
+        :param buffers: [(data, receive time), ...]
+        :type buffers: list
+
+        :return: Seconds spent parsing and handling them.
+        :rtype: tuple
+        """
+        parse_time = handle_time = 0
+        for message, receive_time in buffers:
+            phase_start = time.perf_counter()
+            # Malformed packets are dropped on their header alone, before anything is decoded.
+            reason = Packet.validate_buffer(message)
+            if reason is None and self.shard_registry is not None and \
+                    Packet.get_buffer_type(message) == Packet.REUNION:
+                # The shard of the sender parses it and makes the Hello Back.
+                self.shard_registry.hello(message, receive_time)
+                self.packets_received[Packet.REUNION].inc()
+                parse_time += time.perf_counter() - phase_start
+                continue
+            if reason is None:
+                try:
+                    packet = self.packet_factory.parse_buffer(message)
+                except UnicodeDecodeError:
+                    reason = 'encoding'
+            if reason is not None:
+                parse_time += time.perf_counter() - phase_start
+                logger.warning('invalid packet of %d Bytes dropped: %s', len(message), reason)
+                self.__count_dropped_packet(reason)
+                continue
+            packet.receive_time = receive_time
+            now = time.perf_counter()
+            parse_time += now - phase_start
+
+            self.handle_packet(packet)
+            packet_time = time.perf_counter() - now
+            handle_time += packet_time
+            self.profiler.observe_packet(Packet.TYPE_NAMES.get(packet.get_type(), 'unknown'), packet_time)
+        return parse_time, handle_time
 
     def run_reunion_daemon(self):
         """
@@ -187,33 +720,108 @@ class Peer:
         :return:
         """
 
-        while True:
-            if self.is_root:
-                for peer_address, last_time in list(self.last_received_hello_times.items()):
-                    elapsed_time = time.time() - last_time
-                    if elapsed_time > self.MAXIMUM_WAIT_TIME:
-                        self.network_graph.remove_node(peer_address)
-            elif self.parent_address is not None:
-                if not self.waiting_for_hello_back:
-                    hello_packet = self.packet_factory.new_reunion_packet(Packet.BODY_REQ, self.address, [self.address])
-                    self.stream.add_message_to_out_buff(self.parent_address, hello_packet.get_buf())
-                    self.last_sent_hello_time = time.time()
-                    self.waiting_for_hello_back = True
-                else:
-                    elapsed_time = time.time() - self.last_sent_hello_time
-                    if elapsed_time > self.MAXIMUM_WAIT_TIME:
-                        advertise_packet = self.packet_factory.new_advertise_packet(Packet.BODY_REQ, self.address,
-                                                                                    self.address)
-                        self.stream.add_message_to_out_buff(self.root_address, advertise_packet.get_buf(),
-                                                            is_register_node=True)
-                        self.stream.remove_node(
-                            self.stream.get_node_by_server(self.parent_address[0], self.parent_address[1]))
-                        self.parent_address = None
+        while self.running:
+            self.clock.sleep(self.run_reunion_iteration())
+
+    def run_reunion_iteration(self):
+        """
+        One iteration of the reunion daemon.
+
+        :return: Seconds until the next iteration is due.
+        :rtype: float
+        """
+        wait_time = self.DAEMON_THREAD_WAIT_TIME
+        if self.is_root:
+            # With a ShardedRegistry the shard processes track their own peers.
+            if self.shard_registry is None:
+                self.network_graph.remove_nodes(self.hello_deadlines.pop_expired(self.clock.monotonic()))
+                next_deadline = self.hello_deadlines.get_next_deadline()
+                if next_deadline is not None:
+                    wait_time = max(0, min(wait_time, next_deadline - self.clock.monotonic()))
+        if self.parent_address is not None:
+            if not self.waiting_for_hello_back:
+                hello_packet = self.packet_factory.new_reunion_packet(Packet.BODY_REQ, self.address, [self.address])
+                if self.tracing:
+                    hello_packet.add_trace_entry(self.address, self.clock.time())
+                self.stream.add_message_to_out_buff(self.parent_address, hello_packet.get_buf())
+                self.last_sent_hello_time = self.clock.monotonic()
+                self.waiting_for_hello_back = True
+            else:
+                elapsed_time = self.clock.monotonic() - self.last_sent_hello_time
+                if elapsed_time > self.MAXIMUM_WAIT_TIME:
+                    register_node = self.stream.register_node
+                    if register_node is None or not register_node.healthy:
+                        self.__fail_over_root()
+                    advertise_packet = self.packet_factory.new_advertise_packet(Packet.BODY_REQ, self.address,
+                                                                                self.address)
+                    self.stream.add_message_to_out_buff(self.root_address, advertise_packet.get_buf(),
+                                                        is_register_node=True)
+                    self.stream.remove_node(
+                        self.stream.get_node_by_server(self.parent_address[0], self.parent_address[1]))
+                    self.lost_parent_address = self.parent_address
+                    self.parent_address = None
+                    # The sub-tree of a replicated root still gets its Hello Backs from us, so it stays attached.
+                    if not self.is_root:
                         for child in self.children:
                             self.stream.remove_node(self.stream.get_node_by_server(child[0], child[1]))
-                        self.waiting_for_hello_back = False
+                        self.children = []
+                    self.waiting_for_hello_back = False
 
-            time.sleep(self.DAEMON_THREAD_WAIT_TIME)
+        return wait_time
+
+    def send_broadcast_message(self, message, future=None):
+        """
+        Make Message packets for the 'message' and queue them for broadcasting through the network; They are made and
+        sent by 'feed_broadcast_messages'.
+        Messages longer than Packet.CHUNK_SIZE are sent as a sequence of Message Chunk packets.
+
+        :param message: The message that should be broadcast.
+        :param future: Resolved when the last packet of the message is sent.
+
+        :type message: str
+        :type future: Future
+
+        :return:
+
+        :raises ValueError: If the message needs more than Packet.MAX_CHUNK_COUNT chunks.
+        """
+        # Only Message Chunk packets can be deduplicated, so they are the only ones that go through shortcuts.
+        if not message or (len(message) <= Packet.CHUNK_SIZE and not self.shortcuts):
+            packets = iter([self.packet_factory.new_message_packet(message, self.address)])
+        else:
+            packets = self.packet_factory.new_message_chunk_packets(message, self.address)
+        self.outgoing_messages.append((packets, future))
+
+    def feed_broadcast_messages(self):
+        """
+        Broadcast the next Peer.BROADCAST_PACKETS_PER_ITERATION packets of every message we send, so a long message is
+        made and queued in the out_buffs over several iterations and a short one does not wait behind it.
+        Nothing is queued while our Stream holds back data for a full window; The messages wait for the ACKs.
+        If tracing is on, the packets carry a trace that starts with our own entry.
+
+        :return: The futures of the messages whose last packet has been queued, to resolve once they are sent.
+        :rtype: list
+        """
+        sent_futures = []
+        if self.stream.is_window_full():
+            return sent_futures
+        for _ in range(len(self.outgoing_messages)):
+            packets, future = self.outgoing_messages.popleft()
+            packet = None
+            for _ in range(self.BROADCAST_PACKETS_PER_ITERATION):
+                packet = next(packets, None)
+                if packet is None:
+                    break
+                if self.tracing:
+                    packet.add_trace_entry(self.address, self.clock.time())
+                self.send_broadcast_packet(packet)
+            if packet is not None:
+                self.outgoing_messages.append((packets, future))
+            elif future is not None:
+                sent_futures.append(future)
+        if self.outgoing_messages:
+            self.wakeup.set()
+        return sent_futures
 
     def send_broadcast_packet(self, broadcast_packet):
         """
@@ -229,11 +837,11 @@ class Peer:
         :return:
         """
 
-        print('Sending new broadcast message: ', broadcast_packet.get_body())
-        for child in self.children:
-            self.stream.add_message_to_out_buff(child, broadcast_packet.get_buf())
-        if not self.is_root:
-            self.stream.add_message_to_out_buff(self.parent_address, broadcast_packet.get_buf())
+        packet_logger.debug('sending broadcast packet with %d chars body', broadcast_packet.get_length())
+        if broadcast_packet.get_type() == Packet.MESSAGE_CHUNK:
+            # Our own chunks may come back to us through a shortcut.
+            self.__mark_chunk_seen(broadcast_packet.get_body())
+        self.__forward_broadcast_packet(broadcast_packet, None)
 
     def handle_packet(self, packet):
         """
@@ -249,34 +857,33 @@ class Peer:
         """
         packet_type = packet.get_type()
         if packet.get_version() != Packet.VERSION:
-            print('Error in packet: incorrect version')
+            logger.warning('invalid packet from %s: incorrect version %d', packet.get_source_server_address(),
+                           packet.get_version())
+            self.__count_dropped_packet('version')
             return
-        if packet_type not in [Packet.REGISTER, Packet.ADVERTISE, Packet.JOIN, Packet.MESSAGE, Packet.REUNION]:
-            print('Error in packet: Unknown type')
+        handler = self.packet_handlers.get(packet_type)
+        if handler is None:
+            logger.warning('invalid packet from %s: unknown type %d', packet.get_source_server_address(), packet_type)
+            self.__count_dropped_packet('type')
             return
         if packet.get_length() != len(packet.get_body()):
-            print('Error in packet: inconsistent body length')
-            print('body length in header:', packet.get_length())
-            print('real body length:', len(packet.get_body()))
+            logger.warning('invalid packet from %s: body length in header is %d but real body length is %d',
+                           packet.get_source_server_address(), packet.get_length(), len(packet.get_body()))
+            self.__count_dropped_packet('length')
             return
-        print(time.time(), end=' ')
-        if packet_type == Packet.REGISTER:
-            print('register packet received')
-            self.__handle_register_packet(packet)
-        elif packet_type == Packet.ADVERTISE:
-            print('advertise packet received')
-            self.__handle_advertise_packet(packet)
-        elif packet_type == Packet.JOIN:
-            print('join packet received')
-            self.__handle_join_packet(packet)
-        elif packet_type == Packet.MESSAGE:
-            print('message packet received')
-            self.__handle_message_packet(packet)
-        elif packet_type == Packet.REUNION:
-            print('reunion packet received')
-            self.__handle_reunion_packet(packet)
-        else:
-            print('unknown packet type')
+        self.packets_received[packet_type].inc()
+        packet_logger.debug('%s packet received from %s', Packet.TYPE_NAMES[packet_type],
+                            packet.get_source_server_address())
+        handler(packet)
+
+    def __count_dropped_packet(self, reason):
+        """
+        :param reason: Why the packet was dropped.
+        :type reason: str
+
+        :return:
+        """
+        self.metrics.counter('packets_dropped_total', 'Invalid packets dropped by reason.', reason=reason).inc()
 
     def __check_registered(self, source_address):
         """
@@ -288,7 +895,7 @@ class Peer:
         :return:
         """
         if self.registered_peers is not None:
-            if str((Node.parse_ip(source_address[0]), Node.parse_port(source_address[1]))) in self.registered_peers:
+            if Address.parse(source_address) in self.registered_peers:
                 return True
             return False
 
@@ -322,40 +929,136 @@ class Peer:
         :return:
         """
         body_str = packet.get_body()
-        if self.is_root:
+        # A replicated root is also a client of its primary root, so it handles Advertise Responses below.
+        if self.is_root and (self.root_address is None or body_str[:3] == Packet.BODY_REQ):
             if len(body_str) != 3 or body_str != Packet.BODY_REQ:
                 return
+            if self.shard_registry is not None:
+                self.shard_registry.advertise(packet.get_source_server_address())
+                return
             if not self.__check_registered(packet.get_source_server_address()):
-                print('Peer that has sent request advertise has not registered before.')
+                logger.warning('advertise request from %s that has not registered before',
+                               packet.get_source_server_address())
                 return
-            neighbour_address = self.__get_neighbour(packet.get_source_server_address())
-            print('neighbour for', packet.get_source_server_address(), 'is', neighbour_address)
-            response_packet = self.packet_factory.new_advertise_packet(Packet.BODY_RES,
-                                                                       packet.get_source_server_address(),
-                                                                       Node.parse_address(neighbour_address))
-            message = response_packet.get_buf()
-            self.stream.add_message_to_out_buff(packet.get_source_server_address(), message, is_register_node=True)
-            self.network_graph.add_node(packet.get_source_server_ip(), packet.get_source_server_port(),
-                                        neighbour_address)
-            self.network_graph.turn_on_node(packet.get_source_server_address())
-
-            self.last_received_hello_times[packet.get_source_server_address()] = time.time()
+            if self.__advertise_neighbour(packet.get_source_server_address()):
+                self.hello_deadlines.schedule(packet.get_source_server_address(),
+                                              self.clock.monotonic() + self.MAXIMUM_WAIT_TIME)
 
         else:
             if len(body_str) != 23 or body_str[:3] != Packet.BODY_RES:
                 return
             parent_ip = body_str[3:18]
             parent_port = body_str[18:23]
-            self.parent_address = (parent_ip, parent_port)
+            self.parent_address = Address.parse((parent_ip, parent_port))
             self.stream.add_node(self.parent_address)
             join_packet = self.packet_factory.new_join_packet(self.address)
             message = join_packet.get_buf()
             self.stream.add_message_to_out_buff(self.parent_address, message)
+            if self.lost_parent_address is not None:
+                self.__retransmit_to_parent(self.lost_parent_address)
+                self.lost_parent_address = None
 
             self.waiting_for_hello_back = False
-            if not self.reunion_daemon.is_alive():
+            if self.host is not None:
+                self.host.schedule_reunion(self)
+            elif not self.reunion_daemon.is_alive():
                 self.reunion_daemon.start()
 
+            join_futures, self.join_futures = self.join_futures, []
+            for future in join_futures:
+                self.__resolve_future(future, self.parent_address)
+
+    def __retransmit_to_parent(self, lost_parent_address):
+        """
+        Send the broadcast packets our lost parent may not have received to the new parent, after the Join packet.
+        Other packets are not sent again; The Reunion and the Advertise make their own.
+
+        :param lost_parent_address: Address of the parent we lost.
+        :type lost_parent_address: tuple
+
+        :return:
+        """
+        for message in self.stream.take_unsent_messages(lost_parent_address):
+            if Packet.get_buffer_type(message) in Packet.DATA_TYPES:
+                self.stream.add_message_to_out_buff(self.parent_address, message)
+                self.retransmitted_messages.inc()
+
+    def __advertise_neighbour(self, source_address):
+        """
+        Place a registered peer in our NetworkGraph and send it an Advertise Response with its new parent.
+
+        :param source_address: Address of the peer that sent the Advertise Request.
+        :type source_address: tuple
+
+        :return: Whether a neighbour was found or not.
+        :rtype: bool
+        """
+        # A registered peer advertises again after a Reunion failure; its old place and sub-tree are stale.
+        self.network_graph.remove_node(source_address)
+        neighbour_address = self.__get_neighbour(source_address)
+        if neighbour_address is None:
+            logger.warning('no neighbour found for %s', source_address)
+            return False
+        logger.info('neighbour for %s is %s', source_address, neighbour_address)
+        response_packet = self.packet_factory.new_advertise_packet(Packet.BODY_RES, source_address,
+                                                                   Node.parse_address(neighbour_address))
+        message = response_packet.get_buf()
+        self.stream.add_message_to_out_buff(source_address, message, is_register_node=True)
+        self.network_graph.add_node(source_address[0], source_address[1], neighbour_address)
+        self.network_graph.turn_on_node(source_address)
+
+        shortcut_addresses = self.network_graph.find_shortcuts(source_address, self.shortcut_count)
+        if shortcut_addresses:
+            shortcut_packet = self.packet_factory.new_shortcut_packet(self.address, shortcut_addresses)
+            self.stream.add_message_to_out_buff(source_address, shortcut_packet.get_buf(), is_register_node=True)
+        return True
+
+    def __handle_shard_results(self):
+        """
+        Finish the registrations, advertisements, Reunion Hellos and Reunion timeouts our shard processes have answered.
+
+        :return:
+        """
+        expired = []
+        for result in self.shard_registry.get_results():
+            if result[0] == 'send':
+                _, address, message = result
+                self.stream.add_message_to_out_buff(Address.parse(address), message)
+                continue
+            if result[0] == 'registered':
+                _, source_address, is_new = result
+                if is_new:
+                    self.__accept_registration(source_address)
+                else:
+                    logger.info('peer %s is already registered', source_address)
+            elif result[0] == 'advertise':
+                _, source_address, accepted = result
+                if accepted:
+                    self.__advertise_neighbour(source_address)
+                else:
+                    logger.warning('advertise request from %s that has not registered before', source_address)
+            elif result[0] == 'expired':
+                expired.append(result[1])
+            elif result[0] == 'dropped':
+                logger.warning('invalid reunion packet dropped by our shard: %s', result[1])
+                self.__count_dropped_packet(result[1])
+        self.network_graph.remove_nodes(expired)
+
+    def __accept_registration(self, source_address):
+        """
+        Make the register_connection for a newly registered peer and send it a Register Response.
+
+        :param source_address: Address of the new peer.
+        :type source_address: tuple
+
+        :return:
+        """
+        self.metrics.counter('registrations_total', 'Peers registered by the root.').inc()
+        self.stream.add_node(source_address, set_register_connection=True)
+        response_packet = self.packet_factory.new_register_packet(Packet.BODY_RES, source_address)
+        message = response_packet.get_buf()
+        self.stream.add_message_to_out_buff(source_address, message, is_register_node=True)
+
     def __handle_register_packet(self, packet):
         """
         For registration a new node to the network at first we should make a Node with stream.add_node for'sender' and
@@ -371,29 +1074,30 @@ class Peer:
         :type packet Packet
         :return:
         """
-        if not self.is_root:
+        body_str = packet.get_body()
+        # A replicated root receives the Register Response of its primary root; There is nothing to do with it.
+        if not self.is_root or body_str[:3] == Packet.BODY_RES:
             return
 
-        body_str = packet.get_body()
         if len(body_str) != 23:
-            print('register request packet length is not 23')
+            logger.warning('register packet body length from %s is not 23', packet.get_source_server_address())
 
         body_type = body_str[:3]
         if body_type == Packet.BODY_REQ:
             source_ip = body_str[3:18]
             source_port = body_str[18:23]
-            source_address = (source_ip, source_port)
+            source_address = Address.parse((source_ip, source_port))
+            if self.shard_registry is not None:
+                self.shard_registry.register(source_address)
+                return
             if self.__check_registered(source_address):
-                print('peer is already been registered!')
+                logger.info('peer %s is already registered', source_address)
                 return
-            self.registered_peers[str(source_address)] = True
-            self.stream.add_node(source_address, set_register_connection=True)
-            response_packet = self.packet_factory.new_register_packet(Packet.BODY_RES, source_address)
-            message = response_packet.get_buf()
-            self.stream.add_message_to_out_buff(source_address, message, is_register_node=True)
-            print('registered peers', self.registered_peers)
+            self.registered_peers[source_address] = True
+            self.__accept_registration(source_address)
+            logger.info('peer %s registered; %d registered peers', source_address, len(self.registered_peers))
         else:
-            print('register body type is not REQ')
+            logger.warning('register body type from %s is not REQ', packet.get_source_server_address())
 
     def __check_neighbour(self, address):
         """
@@ -406,7 +1110,7 @@ class Peer:
         :return: Whether is address in our neighbours or not.
         :rtype: bool
         """
-        return address == self.parent_address or address in self.children
+        return address == self.parent_address or address in self.children or address in self.shortcuts
 
     def __handle_message_packet(self, packet):
         """
@@ -424,22 +1128,239 @@ class Peer:
 
         """
 
-        if not self.__check_neighbour(packet.get_source_server_address()):
-            print('received message from unknown source, not found in neighbours')
+        if not self.__check_message_source(packet):
             return
+        message = packet.get_body()
+        logger.info('new message received from %s: %s', packet.get_source_server_address(), message)
+        self.__deliver_message(packet.get_source_server_address(), message)
+        self.__record_trace(packet)
+        message_packet = self.packet_factory.new_message_packet(message, self.address)
+        self.__extend_trace(message_packet, packet)
+        self.__forward_broadcast_packet(message_packet, packet.get_source_server_address())
+
+    def __handle_message_chunk_packet(self, packet):
+        """
+        Forward the chunk to the other neighbours right away (cut-through) and keep it for our own reassembly.
+        When every chunk of a message has arrived, the whole message is delivered.
+
+        Warnings:
+            1. Only the last Peer.MAX_PENDING_CHUNKED_MESSAGES incomplete messages, with at most
+               Peer.MAX_PENDING_CHUNK_CHARS message chars, are kept; the oldest ones will be dropped, so lost chunks
+               can not grow our memory without bound.
+
+        :param packet: Arrived message chunk packet
+
+        :type packet Packet
+
+        :return:
+        """
+        if not self.__check_message_source(packet):
+            return
+
+        body_str = packet.get_body()
+        if len(body_str) <= Packet.CHUNK_HEADER_SIZE:
+            return
+        message_id = body_str[:Packet.MESSAGE_ID_SIZE]
+        try:
+            chunk_index = int(body_str[Packet.MESSAGE_ID_SIZE:Packet.MESSAGE_ID_SIZE + Packet.CHUNK_INDEX_SIZE])
+            chunk_count = int(body_str[Packet.MESSAGE_ID_SIZE + Packet.CHUNK_INDEX_SIZE:Packet.CHUNK_HEADER_SIZE])
+        except ValueError:
+            logger.warning('message chunk packet from %s with invalid index or count',
+                           packet.get_source_server_address())
+            return
+        if not 0 <= chunk_index < chunk_count:
+            return
+        if not self.__mark_chunk_seen(body_str):
+            self.duplicate_chunks.inc()
+            return
+        chunk = body_str[Packet.CHUNK_HEADER_SIZE:]
+
+        self.__record_trace(packet)
+        chunk_packet = self.packet_factory.new_message_chunk_packet(message_id, chunk_index, chunk_count, chunk,
+                                                                   self.address)
+        self.__extend_trace(chunk_packet, packet)
+        self.__forward_broadcast_packet(chunk_packet, packet.get_source_server_address())
+
+        chunks = self.pending_chunked_messages.get(message_id)
+        if chunks is None:
+            if len(self.pending_chunked_messages) >= self.MAX_PENDING_CHUNKED_MESSAGES:
+                self.__drop_pending_chunked_message(next(iter(self.pending_chunked_messages)))
+            chunks = [None] * chunk_count
+            self.pending_chunked_messages[message_id] = chunks
+        if len(chunks) != chunk_count or chunks[chunk_index] is not None:
+            return
+        while self.pending_chunk_chars + len(chunk) > self.MAX_PENDING_CHUNK_CHARS:
+            oldest_message_id = next(iter(self.pending_chunked_messages))
+            self.__drop_pending_chunked_message(oldest_message_id)
+            if oldest_message_id == message_id:
+                return
+        chunks[chunk_index] = chunk
+        self.pending_chunk_chars += len(chunk)
+
+        if None not in chunks:
+            self.pending_chunked_messages.pop(message_id)
+            message = ''.join(chunks)
+            self.pending_chunk_chars -= len(message)
+            logger.info('new message received from %s: %s', packet.get_source_server_address(), message)
+            self.__deliver_message(packet.get_source_server_address(), message)
+
+    def __drop_pending_chunked_message(self, message_id):
+        """
+        :param message_id: Message ID of an incomplete chunked message we keep.
+        :type message_id: str
+
+        :return:
+        """
+        logger.warning('dropping incomplete chunked message %s', message_id)
+        chunks = self.pending_chunked_messages.pop(message_id)
+        self.pending_chunk_chars -= sum(len(chunk) for chunk in chunks if chunk is not None)
+
+    def __mark_chunk_seen(self, body_str):
+        """
+        Remember a Message Chunk by its Message ID and Chunk Index; Only the last Peer.MAX_SEEN_CHUNKS are kept.
+
+        :param body_str: Body of the Message Chunk packet.
+        :type body_str: str
+
+        :return: False if we have seen the chunk before.
+        :rtype: bool
+        """
+        key = body_str[:Packet.MESSAGE_ID_SIZE + Packet.CHUNK_INDEX_SIZE]
+        if key in self.seen_chunks:
+            return False
+        if len(self.seen_chunks) >= self.MAX_SEEN_CHUNKS:
+            self.seen_chunks.pop(next(iter(self.seen_chunks)))
+        self.seen_chunks[key] = True
+        return True
+
+    def __handle_shortcut_packet(self, packet):
+        """
+        Make shortcut links with the listed peers.
+        A list from our root is our assignment, so we also send every listed peer a Shortcut packet with our address;
+        A list from another peer only asks us to link back to it.
+
+        :param packet: Arrived shortcut packet
+        :type packet Packet
+
+        :return:
+        """
+        body_str = packet.get_body()
+        entries_str = body_str[Packet.NUMBER_OF_ENTRIES_SIZE:]
+        entry_size = Packet.IP_SIZE + Packet.PORT_SIZE
+        if not body_str[:Packet.NUMBER_OF_ENTRIES_SIZE].isdigit() or \
+                int(body_str[:Packet.NUMBER_OF_ENTRIES_SIZE]) * entry_size != len(entries_str):
+            logger.warning('invalid shortcut packet from %s', packet.get_source_server_address())
+            return
+        is_assignment = packet.get_source_server_address() == self.root_address
+
+        for i in range(0, len(entries_str), entry_size):
+            shortcut_address = Address.parse((entries_str[i:i + Packet.IP_SIZE],
+                                               entries_str[i + Packet.IP_SIZE:i + entry_size]))
+            if shortcut_address == self.address or shortcut_address in self.shortcuts:
+                continue
+            try:
+                self.stream.add_node(shortcut_address)
+            except ConnectionError:
+                logger.warning('could not make a shortcut to %s', shortcut_address)
+                continue
+            self.shortcuts.append(shortcut_address)
+            logger.info('shortcut to %s', shortcut_address)
+            if is_assignment:
+                shortcut_packet = self.packet_factory.new_shortcut_packet(self.address, [self.address])
+                self.stream.add_message_to_out_buff(shortcut_address, shortcut_packet.get_buf())
+
+    def __deliver_message(self, source_address, message):
+        """
+        Hand a received broadcast message to every registered message listener.
+
+        :param source_address: Address of the neighbour that sent us the message.
+        :param message: The delivered message.
+
+        :type source_address: tuple
+        :type message: str
+
+        :return:
+        """
+        for listener in self.message_listeners:
+            listener(source_address, message)
+
+    def __extend_trace(self, new_packet, packet):
+        """
+        If the arrived packet is traced, the packet we forward instead of it carries the same trace plus our entry.
+
+        :param new_packet: The packet we are going to forward.
+        :param packet: The arrived packet.
+
+        :type new_packet: Packet
+        :type packet: Packet
+
+        :return:
+        """
+        if packet.get_trace() is None:
+            return
+        new_packet.set_trace(list(packet.get_trace()))
+        new_packet.add_trace_entry(self.address, packet.receive_time)
+
+    def __record_trace(self, packet):
+        """
+        Give the trace of a packet delivered to us to our TraceRecorder.
+
+        :param packet: The arrived packet.
+        :type packet: Packet
+
+        :return:
+        """
+        if packet.get_trace() is not None:
+            self.trace_recorder.record(packet.get_type(), packet.get_trace(), self.address, packet.receive_time)
+
+    def __check_message_source(self, packet):
+        """
+        Message and Message Chunk packets are only accepted from our neighbours.
+
+        :param packet: Arrived broadcast packet
+
+        :type packet Packet
+
+        :return: Whether the packet source is a known neighbour or not.
+        :rtype: bool
+        """
+        if not self.__check_neighbour(packet.get_source_server_address()):
+            logger.warning('message from %s that is not one of our neighbours', packet.get_source_server_address())
+            return False
 
         if self.stream.get_node_by_server(packet.get_source_server_ip(),
                                           packet.get_source_server_port()) not in self.stream.nodes.values():
-            print('source not found in stream nodes')
-            return
-        message = packet.get_body()
-        print('New message received from', packet.get_source_server_address(), ':', message)
-        message_packet = self.packet_factory.new_message_packet(message, self.address)
-        for child in self.children:
-            if child != packet.get_source_server_address():
-                self.stream.add_message_to_out_buff(child, message_packet.get_buf())
-        if not self.is_root and self.parent_address != packet.get_source_server_address():
-            self.stream.add_message_to_out_buff(self.parent_address, message_packet.get_buf())
+            logger.warning('message source %s not found in stream nodes', packet.get_source_server_address())
+            return False
+        return True
+
+    def __forward_broadcast_packet(self, broadcast_packet, source_address):
+        """
+        Send an arrived broadcast packet to all of our neighbours except the one it came from.
+
+        Message Chunk packets also go through our shortcuts. Every neighbour it came from is a flow of its own in the
+        out_buff of the others, so a flooding sub-tree can only take its fair share of our links.
+
+        :param broadcast_packet: The packet rebuilt with our own address.
+        :param source_address: Address of the neighbour that sent us the packet; None if the packet is ours.
+
+        :type broadcast_packet: Packet
+        :type source_address: tuple
+
+        :return:
+        """
+        neighbours = list(self.children)
+        if self.parent_address is not None:
+            neighbours.append(self.parent_address)
+        if self.shortcuts and broadcast_packet.get_type() == Packet.MESSAGE_CHUNK:
+            # The Stream drops the connections of dead peers; Their shortcuts go with them.
+            self.shortcuts = [address for address in self.shortcuts if address in self.stream.nodes]
+            neighbours += [address for address in self.shortcuts if address not in neighbours]
+
+        buf = broadcast_packet.get_buf()
+        for neighbour in neighbours:
+            if neighbour != source_address:
+                self.stream.add_message_to_out_buff(neighbour, buf, flow=source_address)
 
     def __handle_reunion_packet(self, packet):
         """
@@ -465,6 +1386,9 @@ class Peer:
         :return:
         """
         body_str = packet.get_body()
+        if self.shard_registry is not None:
+            self.shard_registry.hello(packet.get_buf(), packet.receive_time)
+            return
         num_of_entries = int(body_str[3:5])
 
         if num_of_entries != len(body_str[5:]) // 20:
@@ -476,30 +1400,35 @@ class Peer:
         for i in range(0, len(path_peers_str), 20):
             ip = path_peers_str[i:i + 15]
             port = path_peers_str[i + 15:i + 20]
-            path_peers.append((ip, port))
+            path_peers.append(Address.parse((ip, port)))
 
-        if self.is_root:
-            if body_str[0:3] != Packet.BODY_REQ:
-                return
-
-            self.last_received_hello_times[packet.get_source_server_address()] = time.time()
+        if self.is_root and body_str[0:3] == Packet.BODY_REQ:
+            self.hello_deadlines.schedule(packet.get_source_server_address(),
+                                          self.clock.monotonic() + self.MAXIMUM_WAIT_TIME)
 
             path_peers.reverse()
             hello_back_packet = self.packet_factory.new_reunion_packet(Packet.BODY_RES, self.address, path_peers)
+            self.__extend_trace(hello_back_packet, packet)
             message = hello_back_packet.get_buf()
             self.stream.add_message_to_out_buff(path_peers[0], message)
 
         else:
             if body_str[0:3] == Packet.BODY_REQ:
+                if self.parent_address is None:
+                    return
                 path_peers.append(self.address)
                 hello_packet = self.packet_factory.new_reunion_packet(Packet.BODY_REQ,
                                                                       packet.get_source_server_address(), path_peers)
+                self.__extend_trace(hello_packet, packet)
                 message = hello_packet.get_buf()
                 self.stream.add_message_to_out_buff(self.parent_address, message)
             elif body_str[0:3] == Packet.BODY_RES:
                 if path_peers[0] != self.address:
                     return
-                if len(path_peers) == 1 and self.waiting_for_hello_back:
+                if len(path_peers) == 1:
+                    self.__record_trace(packet)
+                    if self.waiting_for_hello_back:
+                        self.reunion_rtt.observe(self.clock.monotonic() - self.last_sent_hello_time)
                     self.waiting_for_hello_back = False
                     return
 
@@ -507,6 +1436,7 @@ class Peer:
                 hello_back_packet = self.packet_factory.new_reunion_packet(Packet.BODY_RES,
                                                                            packet.get_source_server_address(),
                                                                            path_peers)
+                self.__extend_trace(hello_back_packet, packet)
                 message = hello_back_packet.get_buf()
                 self.stream.add_message_to_out_buff(path_peers[0], message)
 
@@ -540,4 +1470,7 @@ class Peer:
         :param sender: Sender of the packet
         :return: The specified neighbour for the sender; The format is like ('192.168.001.001', '05335').
         """
-        return self.network_graph.find_live_node(sender).address
+        neighbour = self.network_graph.find_live_node(sender)
+        if neighbour is None:
+            return None
+        return neighbour.address
@@ -0,0 +1,213 @@
+from src.Peer import Peer
+from src.Stream import Stream
+from src.tools.Clock import Clock
+from src.tools.DeadlineHeap import DeadlineHeap
+from src.tools.simpletcp.socketloop import SocketLoop
+import logging
+import threading
+
+"""
+    PeerHost runs many Peers in one process, e.g. for simulating an overlay of thousands of peers on one machine.
+    The Peers share a few threads instead of starting a TCPServer, a UserInterface, a main loop and a reunion daemon
+    thread each.
+
+"""
+
+logger = logging.getLogger('p2p.host')
+
+
+class PeerHost:
+    def __init__(self, workers=4, clock=None):
+        """
+        The PeerHost constructor.
+
+        Threads of a started PeerHost:
+            1. One SocketLoop thread serves the TCPServers of all of our Peers; It runs from the constructor on, because
+               the Peers connect to their root as soon as they are added.
+            2. Every worker thread runs the main loop iterations of its share of the Peers; A worker wakes up after
+               Peer.LOOP_WAIT_TIME (less while a Peer holds back data, see Peer.get_wait_time), or as soon as one of
+               its Peers gets a command.
+            3. One timer thread runs the reunion daemon iteration of every Peer when it is due, and the Stream
+               health checks every Stream.HEALTH_CHECK_INTERVAL seconds.
+
+        :param workers: Number of worker threads.
+        :param clock: The Clock of all of our Peers and of our timer thread; The system clocks by default.
+
+        :type workers: int
+        :type clock: Clock
+        """
+        self.clock = Clock() if clock is None else clock
+        self.socket_loop = SocketLoop()
+        self.socket_loop.start()
+        self.peers = []
+        self.worker_peers = [[] for _ in range(workers)]
+        self.worker_wakeups = [threading.Event() for _ in range(workers)]
+        self.threads = []
+        self.reunion_deadlines = DeadlineHeap()
+        self.timer_wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.running = False
+
+    def add_peer(self, server_ip, server_port, **kwargs):
+        """
+        Make a Peer that runs on our threads; It can be added before or after 'start'.
+
+        :param server_ip: Server IP address of the Peer.
+        :param server_port: Server Port of the Peer.
+        :param kwargs: The other arguments of the Peer constructor, except 'interactive' and 'host'.
+
+        :type server_ip: str
+        :type server_port: int
+
+        :return: The new Peer.
+        :rtype: Peer
+        """
+        peer = Peer(server_ip, server_port, interactive=False, host=self, **kwargs)
+        with self.lock:
+            worker = len(self.peers) % len(self.worker_peers)
+            # The worker sleeps on this Event, so 'submit' and 'stop' of the Peer wake up the whole worker.
+            peer.wakeup = self.worker_wakeups[worker]
+            self.worker_peers[worker] = self.worker_peers[worker] + [peer]
+            self.peers = self.peers + [peer]
+        self.schedule_reunion(peer)
+        return peer
+
+    def new_stream(self, server_ip, server_port, root_address, metrics, is_root):
+        """
+        Make the Stream of one of our Peers; Its TCPServer is served by our SocketLoop.
+
+        :return: The new Stream.
+        :rtype: Stream
+        """
+        return Stream(server_ip, server_port, root_address, metrics=metrics, is_root=is_root,
+                      socket_loop=self.socket_loop, clock=self.clock)
+
+    def schedule_reunion(self, peer, delay=0):
+        """
+        Run the reunion daemon iteration of the Peer after 'delay' seconds.
+
+        :param peer: One of our Peers.
+        :param delay: Seconds to wait.
+
+        :type peer: Peer
+        :type delay: float
+
+        :return:
+        """
+        self.reunion_deadlines.schedule(peer, self.clock.monotonic() + delay)
+        self.timer_wakeup.set()
+
+    def is_running(self):
+        """
+        :return: Whether our threads are running.
+        :rtype: bool
+        """
+        return self.running
+
+    def start(self):
+        """
+        Start our threads; They are daemon threads, like the threads of a single Peer.
+
+        :return: This PeerHost.
+        :rtype: PeerHost
+        """
+        if self.running:
+            return self
+        self.running = True
+        targets = [(self.run_worker, (worker,)) for worker in range(len(self.worker_peers))]
+        targets.append((self.run_timers, ()))
+        for target, args in targets:
+            thread = threading.Thread(target=target, args=args)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        logger.info('host started with %d peers on %d workers', len(self.peers), len(self.worker_peers))
+        return self
+
+    def stop(self):
+        """
+        Stop all of our Peers and our threads after their current iteration.
+
+        :return:
+        """
+        self.running = False
+        for peer in self.peers:
+            peer.stop()
+        self.timer_wakeup.set()
+        self.socket_loop.stop()
+
+    def join(self, timeout=None):
+        """
+        Wait until the threads started by 'start' exit.
+
+        :param timeout: Maximum seconds to wait for every thread; None waits forever.
+        :type timeout: float
+
+        :return: Whether all of the threads have exited.
+        :rtype: bool
+        """
+        for thread in self.threads:
+            thread.join(timeout)
+        return not any(thread.is_alive() for thread in self.threads)
+
+    def run_worker(self, worker):
+        """
+        The main loop of all of the Peers of a worker.
+        A Peer that raises is stopped, so it can not take down the other Peers of the worker.
+
+        :param worker: Index of the worker.
+        :type worker: int
+
+        :return:
+        """
+        wakeup = self.worker_wakeups[worker]
+        while self.running:
+            for peer in self.worker_peers[worker]:
+                if not peer.running:
+                    continue
+                try:
+                    peer.run_iteration()
+                except Exception:
+                    logger.exception('peer %s crashed', peer.address)
+                    peer.stop()
+            wakeup.wait(min((peer.get_wait_time() for peer in self.worker_peers[worker] if peer.running),
+                            default=Peer.LOOP_WAIT_TIME))
+            wakeup.clear()
+
+        for peer in self.worker_peers[worker]:
+            peer.fail_pending_futures()
+
+    def run_timers(self):
+        """
+        Run the due reunion daemon iterations and health checks, then sleep until the next one is due.
+        A Peer that raises is stopped, like in 'run_worker', so it can not stop the timers of the other Peers.
+
+        :return:
+        """
+        next_health_check = self.clock.monotonic()
+        while self.running:
+            now = self.clock.monotonic()
+            for peer in self.reunion_deadlines.pop_expired(now):
+                if not peer.running:
+                    continue
+                try:
+                    self.schedule_reunion(peer, peer.run_reunion_iteration())
+                except Exception:
+                    logger.exception('reunion of peer %s crashed', peer.address)
+                    peer.stop()
+            if now >= next_health_check:
+                for peer in self.peers:
+                    if not peer.running:
+                        continue
+                    try:
+                        peer.stream.check_health()
+                    except Exception:
+                        logger.exception('health check of peer %s crashed', peer.address)
+                        peer.stop()
+                next_health_check = now + Stream.HEALTH_CHECK_INTERVAL
+
+            self.timer_wakeup.clear()
+            next_deadline = self.reunion_deadlines.get_next_deadline()
+            if next_deadline is None:
+                next_deadline = next_health_check
+            self.timer_wakeup.wait(max(0, min(next_deadline, next_health_check) - self.clock.monotonic()))
@@ -0,0 +1,128 @@
+from src.Stream import Stream
+from src.Packet import Packet
+from src.tools.Address import Address
+from src.tools.OutBuffer import OutBuffer
+
+"""
+    An in-memory stand-in for Stream, used by the Simulator.
+    It keeps the whole Stream interface, but its node connections are SimulatedNodes that hand the packets to the
+    Simulator network instead of sockets; No socket or thread is made.
+
+"""
+
+
+class SimulatedNode:
+    def __init__(self, network, source_address, server_address, set_register=False, flow_weights=None):
+        """
+        A connection to the Stream of another simulated Peer; It has the interface of Node.
+
+        :param network: The Simulator that carries the packets.
+        :param source_address: Address of the Stream that owns this node.
+        :param server_address: Address of the Stream we are connected to.
+        :param set_register: Whether it is a register_connection.
+        :param flow_weights: Weights of the data flows in our out_buff (see OutBuffer).
+
+        :type network: Simulator
+        :type source_address: Address
+        :type server_address: tuple
+        :type set_register: bool
+        :type flow_weights: dict
+
+        :raises ConnectionError: If there is no live Peer at 'server_address'.
+        """
+        self.network = network
+        self.source_address = source_address
+        self.server_address = Address.parse(server_address)
+        self.server_ip, self.server_port = self.server_address
+        self.is_register_node = set_register
+        self.out_buff = OutBuffer(flow_weights)
+        self.healthy = True
+        self.out_buff_depth = None
+        self.bytes_sent = None
+
+        if not network.is_alive(self.server_address):
+            raise ConnectionError('Client socket cannot be initialized')
+        network.connect(source_address, self.server_address)
+
+    def send_message(self, ack_latency=None, only_control=False):
+        """
+        Hand the out_buff, or only its control packets, to the network; There is no ACK, so 'ack_latency' is ignored.
+
+        :raises ConnectionError: If the Peer we are connected to has failed.
+
+        :return: The messages sent.
+        :rtype: list
+        """
+        sent = []
+        while self.out_buff.has_control() if only_control else self.out_buff:
+            if not self.network.is_alive(self.server_address):
+                raise ConnectionError('connection closed by %s' % (self.server_address,))
+            data = Packet.stamp_forward_time(self.out_buff.popleft(), self.network.clock.time())
+            self.network.send(self.source_address, self.server_address, data)
+            sent.append(data)
+        return sent
+
+    def add_message_to_out_buff(self, message, flow=None):
+        self.out_buff.append(message, flow)
+
+    def has_unacked(self):
+        # The network loses nothing between live Peers, so nothing waits for an ACK.
+        return False
+
+    def is_window_full(self):
+        return False
+
+    def take_unsent(self):
+        return self.out_buff.take_all()
+
+    def check_health(self):
+        # Like the health monitor of a Stream, we notice a failed Peer only when we check.
+        if self.healthy and not self.network.is_alive(self.server_address):
+            self.healthy = False
+        return self.healthy
+
+    def close(self):
+        pass
+
+    def get_server_address(self):
+        return self.server_address
+
+
+class SimulatedStream(Stream):
+    def __init__(self, network, ip, port, root_address=None, metrics=None, is_root=None, clock=None):
+        """
+        A Stream whose node connections go through a Simulator network.
+
+        :param network: The Simulator that carries the packets.
+        :type network: Simulator
+
+        The other parameters are the same as Stream.
+        """
+        self.network = network
+        self.address = None
+        # Incoming connections with a scheduled 'drain_ingress'.
+        self.paused_connections = set()
+        super().__init__(ip, port, root_address, metrics=metrics, is_root=is_root, clock=clock)
+
+    def start_server(self, ip, port, socket_loop):
+        # Instead of a TCPServer, the network calls 'receive_from' for every packet sent to our address.
+        self.address = Address.parse((ip, port))
+        self.network.attach(self.address, self)
+
+    def make_node(self, server_address, set_register_connection):
+        return SimulatedNode(self.network, self.address, server_address, set_register_connection, self.flow_weights)
+
+    def get_server_address(self):
+        return self.address
+
+    def pause_connection(self, address, seconds):
+        # The packets the network delivers meanwhile join the backlog, so only its drain has to be scheduled.
+        if address not in self.paused_connections:
+            self.paused_connections.add(address)
+            self.paused_seconds.inc(seconds)
+            self.network.call_later(seconds, self.__resume_connection, address)
+
+    def __resume_connection(self, address):
+        self.paused_connections.discard(address)
+        self.drain_ingress(address)
+        self.network.wake(self.network.peers[self.address])
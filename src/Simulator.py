@@ -0,0 +1,296 @@
+from src.Peer import Peer
+from src.SimulatedStream import SimulatedStream
+from src.Stream import Stream
+from src.tools.Clock import VirtualClock
+import heapq
+import itertools
+import logging
+import random
+
+"""
+    Simulator runs Peers in a deterministic discrete-event simulation: A VirtualClock, one event heap and an
+    in-memory network take the place of wall-clock time, threads and sockets.
+
+    The Peers are the real Peer objects with a SimulatedStream, so the NetworkGraph placement, the Reunion timers and
+    the packet handlers under test are the production code. A Peer runs a main loop iteration as soon as a packet or
+    a command arrives for it and its reunion daemon iteration when it is due; Nothing runs in between, so a schedule of
+    joins, failures and heartbeats for a big overlay replays in a fraction of its virtual time and gives the same
+    results on every run with the same seed.
+
+    Root shards (ShardedRegistry) are not supported; They time the Hellos with the system clock in other processes, so
+    a Peer with root_shards rejects our VirtualClock.
+
+"""
+
+logger = logging.getLogger('p2p.simulator')
+
+
+class SimulatedWakeup:
+    def __init__(self, simulator, peer):
+        """
+        Stands in for the wakeup Event of a simulated Peer; Setting it schedules an iteration of the Peer.
+
+        :type simulator: Simulator
+        :type peer: Peer
+        """
+        self.simulator = simulator
+        self.peer = peer
+
+    def set(self):
+        self.simulator.wake(self.peer)
+
+
+class Simulator:
+    def __init__(self, latency=0.001, jitter=0.0, seed=0):
+        """
+        The Simulator constructor.
+
+        :param latency: Seconds every packet spends on a link.
+        :param jitter: Maximum random seconds added to the latency of a packet; Links stay FIFO like TCP connections.
+        :param seed: Seed of the jitter.
+
+        :type latency: float
+        :type jitter: float
+        :type seed: int
+        """
+        self.clock = VirtualClock()
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+        self.events = []
+        self.counter = itertools.count()
+        self.streams = dict()
+        self.alive = set()
+        # Addresses of the Streams that have made a node to every address; Only they check their health when it fails.
+        self.connections = dict()
+        self.link_times = dict()
+        self.peers = dict()
+        self.pending_iterations = set()
+        self.reunion_tokens = dict()
+
+        self.processed_events = 0
+        self.delivered_packets = 0
+        self.dropped_packets = 0
+
+    def add_peer(self, server_ip, server_port, **kwargs):
+        """
+        Make a simulated Peer; A non-root Peer connects to its root here, so add the root first.
+
+        :param server_ip: Server IP address of the Peer.
+        :param server_port: Server Port of the Peer.
+        :param kwargs: The other arguments of the Peer constructor, except 'interactive' and 'host'.
+
+        :type server_ip: str
+        :type server_port: int
+
+        :return: The new Peer.
+        :rtype: Peer
+        """
+        peer = Peer(server_ip, server_port, interactive=False, host=self, **kwargs)
+        peer.wakeup = SimulatedWakeup(self, peer)
+        self.peers[peer.address] = peer
+        # The other Peers start their reunion daemon on their first Advertise Response.
+        if peer.is_root:
+            self.schedule_reunion(peer)
+        self.wake(peer)
+        return peer
+
+    def fail_peer(self, peer):
+        """
+        Crash the Peer now: It stops, its connections close and the packets sent to it are lost.
+        The other Peers find its connections dead in a health check Stream.HEALTH_CHECK_INTERVAL seconds later.
+
+        :type peer: Peer
+
+        :return:
+        """
+        peer.stop()
+        self.alive.discard(peer.address)
+        self.reunion_tokens.pop(peer, None)
+        self.call_later(Stream.HEALTH_CHECK_INTERVAL, self.__check_health, peer.address)
+
+    def __check_health(self, failed_address):
+        # A node can not be made to a failed address, so every Stream that may have one to it is known by now.
+        for address in self.connections.pop(failed_address, ()):
+            if address in self.alive:
+                stream = self.streams[address]
+                stream.check_health()
+                if stream.flagged_nodes:
+                    self.wake(self.peers[address])
+
+    def call_at(self, when, function, *args):
+        """
+        Call function(*args) at the virtual time 'when'; Events at the same time run in the order they were made.
+
+        :type when: float
+        :type function: function
+
+        :return:
+        """
+        heapq.heappush(self.events, (max(when, self.clock.time()), next(self.counter), function, args))
+
+    def call_later(self, delay, function, *args):
+        """
+        Call function(*args) 'delay' virtual seconds from now.
+
+        :type delay: float
+        :type function: function
+
+        :return:
+        """
+        self.call_at(self.clock.time() + delay, function, *args)
+
+    def run(self, until=None):
+        """
+        Process the events in time order.
+
+        :param until: Stop before the first event after this virtual time and move the clock to it; None runs until
+                      no event is left, which never happens while a Peer is joined.
+        :type until: float
+
+        :return: Number of processed events.
+        :rtype: int
+        """
+        processed = 0
+        events = self.events
+        while events and (until is None or events[0][0] <= until):
+            when, _, function, args = heapq.heappop(events)
+            self.clock.advance_to(when)
+            function(*args)
+            processed += 1
+        if until is not None:
+            self.clock.advance_to(until)
+        self.processed_events += processed
+        return processed
+
+    def run_until(self, condition, step=0.1, timeout=3600):
+        """
+        Run 'step' virtual seconds at a time until the condition holds.
+
+        :param condition: Function without arguments; It is checked after every step.
+        :param step: Virtual seconds between the checks.
+        :param timeout: Maximum virtual seconds to run.
+
+        :type condition: function
+        :type step: float
+        :type timeout: float
+
+        :return: The virtual time the condition held at (within 'step'), or None if it did not hold in time.
+        :rtype: float
+        """
+        deadline = self.clock.time() + timeout
+        while not condition():
+            if self.clock.time() >= deadline:
+                return None
+            self.run(until=min(deadline, self.clock.time() + step))
+        return self.clock.time()
+
+    def wake(self, peer):
+        """
+        Run a main loop iteration of the Peer now, unless one is already scheduled.
+
+        :type peer: Peer
+
+        :return:
+        """
+        if peer not in self.pending_iterations:
+            self.pending_iterations.add(peer)
+            self.call_at(self.clock.time(), self.__run_iteration, peer)
+
+    def __run_iteration(self, peer):
+        self.pending_iterations.discard(peer)
+        if peer.running:
+            peer.run_iteration()
+
+    def schedule_reunion(self, peer, delay=0):
+        """
+        Run the reunion daemon iteration of the Peer after 'delay' virtual seconds; It replaces the scheduled one.
+
+        :type peer: Peer
+        :type delay: float
+
+        :return:
+        """
+        token = object()
+        self.reunion_tokens[peer] = token
+        self.call_later(delay, self.__run_reunion, peer, token)
+
+    def __run_reunion(self, peer, token):
+        if self.reunion_tokens.get(peer) is not token or not peer.running:
+            return
+        delay = peer.run_reunion_iteration()
+        # Send the Reunion Hello it may have queued.
+        self.wake(peer)
+        self.schedule_reunion(peer, delay)
+
+    def is_running(self):
+        return True
+
+    def new_stream(self, server_ip, server_port, root_address, metrics, is_root):
+        """
+        Make the SimulatedStream of one of our Peers.
+
+        :rtype: SimulatedStream
+        """
+        return SimulatedStream(self, server_ip, server_port, root_address, metrics=metrics, is_root=is_root,
+                               clock=self.clock)
+
+    def attach(self, address, stream):
+        """
+        Deliver the packets sent to 'address' to the stream.
+
+        :type address: Address
+        :type stream: SimulatedStream
+
+        :return:
+        """
+        self.streams[address] = stream
+        self.alive.add(address)
+
+    def connect(self, source_address, server_address):
+        """
+        Remember that the Stream at 'source_address' has made a node to 'server_address', so it checks its health
+        when that Peer fails.
+
+        :type source_address: Address
+        :type server_address: Address
+
+        :return:
+        """
+        self.connections.setdefault(server_address, set()).add(source_address)
+
+    def is_alive(self, address):
+        """
+        :return: Whether a live Peer has the address.
+        :rtype: bool
+        """
+        return address in self.alive
+
+    def send(self, source_address, destination_address, data):
+        """
+        Deliver the data to the destination after the link latency.
+
+        :type source_address: Address
+        :type destination_address: Address
+        :type data: bytes
+
+        :return:
+        """
+        now = self.clock.time()
+        arrival = now + self.latency
+        if self.jitter:
+            arrival += self.random.uniform(0, self.jitter)
+        link = (source_address, destination_address)
+        arrival = max(arrival, self.link_times.get(link, now))
+        self.link_times[link] = arrival
+        self.call_at(arrival, self.__deliver, source_address, destination_address, data)
+
+    def __deliver(self, source_address, destination_address, data):
+        if destination_address not in self.alive:
+            self.dropped_packets += 1
+            return
+        self.delivered_packets += 1
+        # It goes through the ingress limit of the stream, so it may only arrive when the stream drains its backlog.
+        self.streams[destination_address].receive_from(source_address, [data])
+        self.wake(self.peers[destination_address])
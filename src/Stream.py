@@ -1,31 +1,127 @@
 from src.tools.simpletcp.tcpserver import TCPServer
 from src.tools.Node import Node
+from src.tools.Address import Address
+from src.tools.Metrics import MetricsRegistry
+from src.tools.Link import LinkReceiver
+from src.tools.TokenBucket import TokenBucket
+from src.tools.Clock import Clock
+from src.Packet import Packet
+from collections import OrderedDict, deque
+import logging
 import threading
+import time
+
+logger = logging.getLogger('p2p.stream')
 
 
 class Stream:
-    def __init__(self, ip, port, root_address=None):
+    # Seconds connecting to a node or sending a message may block the main loop; A message not acknowledged in this
+    # time fails its node.
+    CONNECTION_TIMEOUT = 2
+    # Longest the main loop sleeps while a node holds back data for its full window; Its ACKs do not wake the loop up.
+    WINDOW_POLL_INTERVAL = 0.01
+    # TCP keepalive for node connections: (idle seconds, interval seconds, probe count).
+    KEEPALIVE = (5, 1, 3)
+    HEALTH_CHECK_INTERVAL = 1
+    # Listen backlog of our TCPServer; Every peer of the overlay connects to the root, often in a burst.
+    LISTEN_BACKLOG = 128
+    # The messages a removed node may not have received are kept for 'take_unsent_messages', for this many nodes and
+    # up to this many messages each; The oldest are dropped first.
+    UNSENT_NODES = 64
+    UNSENT_MESSAGES = 256
+
+    def __init__(self, ip, port, root_address=None, metrics=None, is_root=None, socket_loop=None, clock=None):
         """
         The Stream object constructor.
 
         Code design suggestion:
             1. Make a separate Thread for your TCPServer and start immediately.
 
+        A second daemon thread checks every node connection without blocking; A node that has closed its connection is
+        marked unhealthy and removed by the main loop in 'send_out_buf_messages' before anything is sent to it.
+
+        Node connections carry numbered frames (see src/tools/Link.py): We pass every frame to 'receive' once, in order,
+        and ACK them cumulatively. The messages a removed node may not have received are kept, so a Peer can send them
+        again over another connection.
+
 
         :param ip: 15 characters
         :param port: 5 characters
+        :param root_address: The root our register_connection goes to.
+        :param metrics: The registry for the Stream metrics; A private one is made if it is None.
+        :param is_root: Whether we accept register_connections of other peers; By default only when there is no
+                        'root_address'. A replicated root has both.
+        :param socket_loop: If given, our TCPServer is served by this shared SocketLoop and neither of our threads is
+                            started; The owner of the loop should call 'check_health' periodically.
+        :param clock: The time source of the receive times and the ingress limits, usually the Clock of our Peer; The
+                      system clocks by default.
+        :type metrics: MetricsRegistry
+        :type is_root: bool
+        :type socket_loop: SocketLoop
+        :type clock: Clock
         """
+        self.clock = Clock() if clock is None else clock
         self.nodes = dict()
         self.root_register_nodes = dict()
         self.register_node = None
-        self.root_address = root_address
+        self.root_address = None if root_address is None else Address.parse(root_address)
 
         ip = Node.parse_ip(ip)
         port = Node.parse_port(port)
 
-        self.is_root = True if root_address is None else False
+        self.is_root = root_address is None if is_root is None else is_root
+
+        # Our TCPServer thread appends while the main loop takes entries from the left; Both are atomic on a deque.
+        self._server_in_buf = deque()
+        # Only these nodes are visited by 'send_out_buf_messages', so a root with thousands of register_connections
+        # does not scan all of them in every iteration; A dict keeps the insertion order.
+        self.pending_nodes = dict()
+        self.window_full = False
+        self.flagged_nodes = []
+        self.links = dict()
+        self.unsent_messages = OrderedDict()
+        # Weights of the data flows in the out_buff of every node; A flow that is not here has weight 1.
+        self.flow_weights = dict()
+        # (packets per second, bytes per second, burst seconds) of every incoming connection; See 'set_ingress_limit'.
+        self.ingress_limit = None
+        self.ingress_buckets = dict()
+        # The packets of every incoming connection its bucket has not let through yet; They are not acknowledged.
+        self.ingress_backlogs = dict()
+
+        self.metrics = MetricsRegistry() if metrics is None else metrics
+        self.bytes_received = self.metrics.counter('stream_bytes_received_total', 'Bytes read by our TCPServer.')
+        self.ack_latency = self.metrics.histogram('stream_ack_latency_seconds',
+                                                  'Time between sending a packet and receiving its ACK.')
+        self.packets_sent = {packet_type: self.metrics.counter('packets_sent_total', 'Packets sent by type.',
+                                                               type=type_name)
+                             for packet_type, type_name in Packet.TYPE_NAMES.items()}
+        self.unhealthy_nodes = self.metrics.counter('stream_unhealthy_nodes_total',
+                                                    'Node connections found dead and removed.')
+        self.dropped_messages = self.metrics.counter('stream_dropped_messages_total',
+                                                     'Messages dropped because their node has no connection.')
+        self.duplicate_frames = self.metrics.counter('stream_duplicate_frames_total',
+                                                     'Frames received again on a connection and dropped.')
+        self.deferred_packets = self.metrics.counter('stream_ingress_deferred_total',
+                                                     'Packets over the ingress limit that paused their connection.')
+        self.paused_seconds = self.metrics.counter('stream_ingress_paused_seconds_total',
+                                                   'Seconds incoming connections were paused by the ingress limit.')
+
+        self.start_server(ip, port, socket_loop)
+
+    def start_server(self, ip, port, socket_loop):
+        """
+        Start our TCPServer, and the health monitor unless a shared SocketLoop serves us.
+
+        :param ip: Our parsed IP.
+        :param port: Our parsed Port.
+        :param socket_loop: The shared SocketLoop or None.
+
+        :type ip: str
+        :type port: str
+        :type socket_loop: SocketLoop
 
-        self._server_in_buf = []
+        :return:
+        """
 
         def callback(address, queue, data):
             """
@@ -36,14 +132,201 @@ class Stream:
             :param data: The data received from the socket.
             :return:
             """
-            queue.put(bytes('ACK', 'utf8'))
-            self._server_in_buf.append(data)
-
-        self.tcp_server = TCPServer(mode=ip, port=int(port), read_callback=callback)
+            link = self.links.get(address)
+            if link is None:
+                link = self.links[address] = LinkReceiver()
+            try:
+                payloads, ack = link.feed(data)
+            except ValueError as error:
+                # The connection does not speak our link protocol; Ignore it, the sender times out waiting for ACKs.
+                logger.warning('invalid frame from %s: %s', address, error)
+                link.buffer.clear()
+                return
+            self.duplicate_frames.inc(link.duplicates)
+            link.duplicates = 0
+            if ack is not None:
+                queue.put(link.make_ack(self.receive_from(address, payloads)))
+
+        def close_callback(address):
+            self.links.pop(address, None)
+            self.ingress_buckets.pop(address, None)
+            # The sender has not got an ACK for them, so it still has them.
+            self.ingress_backlogs.pop(address, None)
+
+        self.tcp_server = TCPServer(mode=Node.get_socket_ip(ip), port=int(port), read_callback=callback,
+                                    maximum_connections=self.LISTEN_BACKLOG, close_callback=close_callback)
+
+        if socket_loop is not None:
+            self.tcp_server.attach(socket_loop)
+            return
 
         server_thread = threading.Thread(target=self.tcp_server.run)
+        server_thread.daemon = True
         server_thread.start()
 
+        health_thread = threading.Thread(target=self.run_health_monitor)
+        health_thread.daemon = True
+        health_thread.start()
+
+    def set_ingress_limit(self, packets_per_second=None, bytes_per_second=None, burst_seconds=1.0):
+        """
+        Limit the packets/s and bytes/s every incoming connection may send us; None for no limit of that kind.
+
+        Every connection has a TokenBucket that is charged before its packets reach our input buffer. The packets
+        over its limit wait in the backlog of the connection, in their order, and the connection is not read until
+        its bucket recovers. They are only acknowledged once they are let through, so the window of the sender
+        holds back the rest of its traffic and nothing is dropped. The limits should let a full window of the sender
+        (Node.WINDOW packets) through within Stream.CONNECTION_TIMEOUT, or the sender gives up on the connection.
+
+        :param packets_per_second: Packet rate of a connection.
+        :param bytes_per_second: Byte rate of a connection.
+        :param burst_seconds: Seconds of traffic at those rates a connection may send at once.
+
+        :type packets_per_second: float
+        :type bytes_per_second: float
+        :type burst_seconds: float
+
+        :return:
+        """
+        if packets_per_second is None and bytes_per_second is None:
+            self.ingress_limit = None
+        else:
+            self.ingress_limit = (packets_per_second, bytes_per_second, burst_seconds)
+        self.ingress_buckets = dict()
+
+    def receive_from(self, address, payloads):
+        """
+        Put the new packets of an incoming connection in our input buffer, as far as its ingress limit allows; The
+        others wait in the backlog of the connection (see 'set_ingress_limit').
+
+        :param address: Address of the connection.
+        :param payloads: Its new packets, in order.
+
+        :type address: tuple
+        :type payloads: list
+
+        :return: Number of packets the backlog of the connection holds; They must not be acknowledged yet.
+        :rtype: int
+        """
+        if self.ingress_limit is None and address not in self.ingress_backlogs:
+            receive_time = self.clock.time()
+            for payload in payloads:
+                self.receive(payload, receive_time)
+            return 0
+
+        backlog = self.ingress_backlogs.get(address)
+        if backlog is None:
+            backlog = self.ingress_backlogs[address] = deque()
+        backlog.extend(payloads)
+        held_back = self.drain_ingress(address)
+        self.deferred_packets.inc(min(len(payloads), held_back))
+        return held_back
+
+    def drain_ingress(self, address):
+        """
+        Pass the packets of the backlog of a connection on while its TokenBucket has tokens; If some are left, the
+        connection is paused until the bucket recovers.
+
+        :param address: Address of the connection.
+        :type address: tuple
+
+        :return: Number of packets left in the backlog.
+        :rtype: int
+        """
+        backlog = self.ingress_backlogs.get(address)
+        if backlog is None:
+            return 0
+
+        admitted = []
+        if self.ingress_limit is None:
+            admitted.extend(backlog)
+            backlog.clear()
+        else:
+            now = self.clock.monotonic()
+            bucket = self.ingress_buckets.get(address)
+            if bucket is None:
+                bucket = self.ingress_buckets[address] = TokenBucket(*self.ingress_limit, now=now)
+            while backlog and bucket.get_delay(now) <= 0:
+                payload = backlog.popleft()
+                bucket.consume(len(payload), now)
+                admitted.append(payload)
+
+        receive_time = self.clock.time()
+        for payload in admitted:
+            self.receive(payload, receive_time)
+
+        if not backlog:
+            del self.ingress_backlogs[address]
+            return 0
+        self.pause_connection(address, bucket.get_delay(now))
+        return len(backlog)
+
+    def pause_connection(self, address, seconds):
+        """
+        Stop reading an incoming connection for a while; Then its backlog is drained and acknowledged.
+
+        :param address: Address of the connection.
+        :param seconds: Seconds to pause it.
+
+        :type address: tuple
+        :type seconds: float
+
+        :return:
+        """
+        self.paused_seconds.inc(seconds)
+        self.tcp_server.pause(address, seconds, self.__resume_connection)
+
+    def __resume_connection(self, address, queue):
+        link = self.links.get(address)
+        if link is not None:
+            queue.put(link.make_ack(self.drain_ingress(address)))
+
+    def get_nodes(self):
+        """
+        :return: Every node connection, register connections included.
+        :rtype: list
+        """
+        nodes = list(self.nodes.values()) + list(self.root_register_nodes.values())
+        if self.register_node is not None:
+            nodes.append(self.register_node)
+        return nodes
+
+    def run_health_monitor(self):
+        """
+        Run 'check_health' every Stream.HEALTH_CHECK_INTERVAL seconds.
+
+        :return:
+        """
+        while True:
+            self.check_health()
+            time.sleep(self.HEALTH_CHECK_INTERVAL)
+
+    def check_health(self):
+        """
+        Mark the nodes whose connection is closed as unhealthy; It only flags them, so it never races the main loop.
+
+        :return:
+        """
+        for node in self.get_nodes():
+            if node.healthy and not node.check_health():
+                logger.warning('connection to %s is dead', node.get_server_address())
+                self.flagged_nodes.append(node)
+
+    def receive(self, data, receive_time=None):
+        """
+        Put the data our TCPServer has read in our input buffer.
+
+        :param data: The data received from the socket.
+        :param receive_time: The time it arrived; Now by default.
+
+        :type data: bytes
+        :type receive_time: float
+
+        :return:
+        """
+        self.bytes_received.inc(len(data))
+        self._server_in_buf.append((data, self.clock.time() if receive_time is None else receive_time))
+
     def get_server_address(self):
         """
 
@@ -52,13 +335,24 @@ class Stream:
         """
         return self.tcp_server.ip, self.tcp_server.port
 
-    def clear_in_buff(self, snapshot_size):
+    def clear_in_buff(self, snapshot_size, deferred=()):
         """
         Discard any data in TCPServer input buffer.
 
+        The buffer is changed in place, so the entries our TCPServer appends meanwhile are kept.
+
+        :param snapshot_size: Number of entries to discard from the start of the buffer.
+        :param deferred: Entries to put back at the start of the buffer, in their order, for the next 'read_in_buf'.
+
+        :type snapshot_size: int
+        :type deferred: list
+
         :return:
         """
-        self._server_in_buf = self._server_in_buf[snapshot_size:]
+        in_buf = self._server_in_buf
+        for _ in range(snapshot_size):
+            in_buf.popleft()
+        in_buf.extendleft(reversed(deferred))
 
     def add_node(self, server_address, set_register_connection=False):
         """
@@ -73,17 +367,61 @@ class Stream:
         :return:
         """
 
-        new_node = Node(server_address, set_register=set_register_connection)
+        if not set_register_connection:
+            # A peer can be both a tree neighbour and a shortcut; They share one connection.
+            node = self.nodes.get(Address.parse(server_address))
+            if node is not None and node.healthy:
+                return
+
+        new_node = self.make_node(server_address, set_register_connection)
+        # Looked up once here, so sending does not lock the registry; 'remove_node' stops exposing them.
+        neighbour = '%s:%s' % new_node.server_address
+        new_node.out_buff_depth = self.metrics.gauge('stream_out_buff_depth',
+                                                     'Messages in the out_buff of a node when it was last sent.',
+                                                     neighbour=neighbour)
+        new_node.bytes_sent = self.metrics.counter('stream_bytes_sent_total', 'Bytes sent to every neighbour.',
+                                                   neighbour=neighbour)
 
         if set_register_connection:
-            if self.is_root:
-                self.root_register_nodes[str(new_node.get_server_address())] = new_node
+            if self.is_root and new_node.server_address != self.root_address:
+                self.root_register_nodes[new_node.server_address] = new_node
             else:
-                print('register node set')
+                logger.debug('register node set to %s', new_node.get_server_address())
                 self.register_node = new_node
             return
 
-        self.nodes[str((new_node.server_ip, new_node.server_port))] = new_node
+        self.nodes[new_node.server_address] = new_node
+
+    def make_node(self, server_address, set_register_connection):
+        """
+        Connect to the TCPServer of a node.
+
+        :param server_address: The node TCPServer address.
+        :param set_register_connection: Whether it is a register_connection.
+
+        :type server_address: tuple
+        :type set_register_connection: bool
+
+        :return: The connected node.
+        :rtype: Node
+
+        :raises ConnectionError: If we can not connect.
+        """
+        return Node(server_address, set_register=set_register_connection, timeout=self.CONNECTION_TIMEOUT,
+                    keepalive=self.KEEPALIVE, flow_weights=self.flow_weights)
+
+    def set_root_address(self, root_address):
+        """
+        Move our register_connection to another root.
+
+        :param root_address: The new root.
+        :type root_address: tuple
+
+        :return:
+        """
+        self.remove_node(self.register_node)
+        self.root_address = Address.parse(root_address)
+        self.add_node(self.root_address, set_register_connection=True)
 
     def remove_node(self, node):
         """
@@ -92,22 +430,74 @@ class Stream:
         Warnings:
             1. Close the node after deletion.
 
+        The messages it may not have received are kept for 'take_unsent_messages', unless it is a register_connection.
+
         :param node: The node we want to remove.
         :type node: Node
 
         :return:
         """
+        if node is None:
+            return
+        self.pending_nodes.pop(node, None)
+        # 'add_node' may have replaced an unhealthy node by a new connection already; The replacement stays.
         try:
-            if node.is_register_node:
-                self.register_node.close()
+            if not node.is_register_node:
+                if self.nodes.get(node.server_address) is node:
+                    del self.nodes[node.server_address]
+                self.keep_unsent_messages(node.server_address, node.take_unsent())
+            elif node is self.register_node:
                 self.register_node = None
-                return
-
-            node = self.nodes[str((node.server_ip, node.server_port))]
+            elif self.root_register_nodes.get(node.server_address) is node:
+                del self.root_register_nodes[node.server_address]
             node.close()
-            self.nodes.pop(str((node.server_ip, node.server_port)))
-        except KeyError or IOError:
-            print('could not remover node')
+        except IOError:
+            logger.warning('could not remove node %s', node.get_server_address())
+        # A register_connection or a replacement to the same address shares the metrics; They go with the last one.
+        if not self.__has_node(node.server_address):
+            neighbour = '%s:%s' % node.server_address
+            self.metrics.remove('stream_out_buff_depth', neighbour=neighbour)
+            self.metrics.remove('stream_bytes_sent_total', neighbour=neighbour)
+
+    def __has_node(self, address):
+        """
+        :return: Whether we have a connection to the address.
+        :rtype: bool
+        """
+        return address in self.nodes or address in self.root_register_nodes or \
+            (self.register_node is not None and self.register_node.server_address == address)
+
+    def keep_unsent_messages(self, address, messages):
+        """
+        :param address: The node the messages were sent to.
+        :param messages: The messages it may not have received, oldest first.
+
+        :type address: Address
+        :type messages: list
+
+        :return:
+        """
+        if not messages:
+            return
+        kept = self.unsent_messages.pop(address, []) + messages
+        self.dropped_messages.inc(max(0, len(kept) - self.UNSENT_MESSAGES))
+        self.unsent_messages[address] = kept[-self.UNSENT_MESSAGES:]
+        while len(self.unsent_messages) > self.UNSENT_NODES:
+            _, dropped = self.unsent_messages.popitem(last=False)
+            self.dropped_messages.inc(len(dropped))
+
+    def take_unsent_messages(self, address):
+        """
+        The messages that may not have reached a removed node; The node that receives them again should ignore
+        duplicates.
+
+        :param address: The removed node.
+        :type address: tuple
+
+        :return: The messages, oldest first.
+        :rtype: list
+        """
+        return self.unsent_messages.pop(Address.parse(address), [])
 
     def get_node_by_server(self, ip, port):
         """
@@ -124,13 +514,13 @@ class Stream:
         :rtype: Node
         """
         try:
-            return self.nodes[str((Node.parse_ip(ip), Node.parse_port(port)))]
+            return self.nodes[Address.parse((ip, port))]
         except KeyError:
-            print('get node by server, could not find node')
+            logger.warning('could not find node for %s', (ip, port))
 
         return None
 
-    def add_message_to_out_buff(self, address, message, is_register_node=False):
+    def add_message_to_out_buff(self, address, message, is_register_node=False, flow=None):
         """
         In this function, we will add the message to the output buffer of the node that has the input address.
         Later we should use send_out_buf_messages to send these buffers into their sockets.
@@ -138,6 +528,8 @@ class Stream:
         :param is_register_node:
         :param address: Node address that we want to send the message
         :param message: Message we want to send
+        :param flow: The data flow of a Message packet, like the neighbour it came from; Flows get fair shares of
+                     every node connection, weighted by 'flow_weights'.
 
         Warnings:
             1. Check whether the node address is in our nodes or not.
@@ -146,27 +538,30 @@ class Stream:
         """
 
         if is_register_node:
-            if self.is_root:
-                node = self.root_register_nodes[str(address)]
-                node.add_message_to_out_buff(message)
+            if self.is_root and Address.parse(address) != self.root_address:
+                node = self.root_register_nodes.get(Address.parse(address))
             else:
-                self.register_node.add_message_to_out_buff(message)
+                node = self.register_node
         else:
-            node = self.nodes[str((Node.parse_ip(address[0]), Node.parse_port(address[1])))]
-            node.add_message_to_out_buff(message)
+            node = self.nodes.get(Address.parse(address))
 
-        # print('message added to out buff successfully')
+        if node is None:
+            logger.warning('no connection to %s; message dropped', address)
+            self.dropped_messages.inc()
+            return
+        node.add_message_to_out_buff(message, flow)
+        self.pending_nodes[node] = None
 
     def read_in_buf(self):
         """
         Only returns the input buffer of our TCPServer.
 
-        :return: TCPServer input buffer.
-        :rtype: list
+        :return: TCPServer input buffer; deque([(data, receive time), ...])
+        :rtype: deque
         """
         return self._server_in_buf
 
-    def send_messages_to_node(self, node):
+    def send_messages_to_node(self, node, only_control=False):
         """
         Send buffered messages to the 'node'
 
@@ -175,32 +570,98 @@ class Stream:
             you need to remove this node from stream nodes.
 
         :param node:
+        :param only_control: Send only the control packets of its out_buff.
         :type node Node
+        :type only_control: bool
 
         :return:
         """
+        if node is None:
+            return
+        if not node.healthy:
+            logger.warning('removing unhealthy node %s', node.get_server_address())
+            self.unhealthy_nodes.inc()
+            self.remove_node(node)
+            return
+
+        if only_control:
+            if not node.out_buff.has_control():
+                return
+        elif not node.out_buff and not node.has_unacked():
+            return
+        if not only_control:
+            node.out_buff_depth.set(len(node.out_buff))
+
+        messages = self.__send_to_node(node, only_control)
+        if not messages:
+            return
+        sent_bytes = 0
+        for data in messages:
+            sent_bytes += len(data)
+            packet_type = Packet.get_buffer_type(data)
+            if packet_type in self.packets_sent:
+                self.packets_sent[packet_type].inc()
+        node.bytes_sent.inc(sent_bytes)
+
+    def __send_to_node(self, node, only_control):
+        """
+        Send the out_buff of the node and read its ACKs; A node that fails is removed.
+
+        :type node: Node
+        :type only_control: bool
+
+        :return: The messages sent.
+        :rtype: list
+        """
         try:
-            node.send_message()
+            messages = node.send_message(self.ack_latency, only_control)
         except IOError:
-            print('send message to node, could not send message')
+            logger.warning('could not send messages to %s; removing the node', node.get_server_address())
+            self.unhealthy_nodes.inc()
+            node.healthy = False
             self.remove_node(node)
+            return []
+        # Visit it again until every message is sent and acknowledged, so a missing ACK is noticed.
+        if node.out_buff or node.has_unacked():
+            self.pending_nodes[node] = None
+        return messages
 
-    def send_out_buf_messages(self, only_register=False):
+    def send_out_buf_messages(self, only_register=False, only_control=False):
         """
         In this function, we will send hole out buffers to their own clients.
 
+        :param only_register: Send only the out_buff of our register_connection.
+        :param only_control: Send only the control packets of every healthy node (see OutBuffer), so a Peer can
+                             pass Reunion packets on before it handles a flood of data packets; The rest stays queued.
+
         :return:
         """
+        if only_control:
+            for node in list(self.pending_nodes):
+                if node.healthy:
+                    self.send_messages_to_node(node, only_control=True)
+            return
+
         if only_register:
+            self.pending_nodes.pop(self.register_node, None)
             self.send_messages_to_node(self.register_node)
             return
 
-        for node in list(self.nodes.values()):
-            self.send_messages_to_node(node)
+        # The health monitor only flags dead nodes; They are removed here, even if nothing is sent to them.
+        flagged_nodes, self.flagged_nodes = self.flagged_nodes, []
+        for node in flagged_nodes:
+            self.pending_nodes[node] = None
 
-        for node in list(self.root_register_nodes.values()):
+        for node in list(self.pending_nodes):
+            # Unmark it before sending; A message queued by the reunion daemon meanwhile marks it again.
+            self.pending_nodes.pop(node, None)
             self.send_messages_to_node(node)
+        self.window_full = any(node.out_buff and node.is_window_full() for node in self.pending_nodes)
 
-        if self.register_node is not None:
-            # print('register node message sent')
-            self.send_messages_to_node(self.register_node)
+    def is_window_full(self):
+        """
+        :return: Whether a node held back data for its full window in the last 'send_out_buf_messages'; It is sent
+                 by a later call, once the ACKs have been read.
+        :rtype: bool
+        """
+        return self.window_full
@@ -1,9 +1,41 @@
+from collections import namedtuple
 import threading
-import time
+
+# A command for the Peer main loop; 'future' is resolved when the main loop has handled it (it can be None).
+Command = namedtuple('Command', ['name', 'arguments', 'future'])
 
 
 class UserInterface(threading.Thread):
-    buffer = []
+    def __init__(self, submit):
+        """
+        Reads the user commands and hands them to the Peer.
+
+        :param submit: Function that takes a Command and queues it for the Peer main loop; It must be thread-safe.
+        :type submit: function
+        """
+        super().__init__()
+        self.submit = submit
+
+    @staticmethod
+    def parse_command(line):
+        """
+        The first word is the command name. Everything after 'sendMessage ' is one argument, so messages keep their
+        spaces; The other commands take whitespace separated arguments.
+
+        :param line: A line the user typed.
+        :type line: str
+
+        :return: The command, or None for an empty line.
+        :rtype: Command
+        """
+        name, _, rest = line.strip().partition(' ')
+        if not name:
+            return None
+        if name == 'sendMessage':
+            arguments = (rest,) if rest else ()
+        else:
+            arguments = tuple(rest.split())
+        return Command(name, arguments, None)
 
     def run(self):
         """
@@ -11,7 +43,6 @@ class UserInterface(threading.Thread):
         This method runs every time to see whether there are new messages or not.
         """
         while True:
-            message = input("Write your command:\n")
-            message = message.split(' ')
-            for msg in message:
-                self.buffer.append(msg)
+            command = self.parse_command(input("Write your command:\n"))
+            if command is not None:
+                self.submit(command)
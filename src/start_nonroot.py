@@ -1,5 +1,7 @@
 from src.Peer import Peer
+from src.tools import Log
 
+Log.configure()
 root_address = ('127.0.0.5', 3536)
 
 peer_address = ("127.0.0.4", 8014)
@@ -1,7 +1,9 @@
 from src.Peer import Peer
+from src.tools import Log
 
 
 if __name__ == "__main__":
+    Log.configure()
     root_address = ('127.0.0.5', 3536)
 
     server = Peer(root_address[0],
@@ -0,0 +1,47 @@
+class Address(tuple):
+    """
+    Canonical IP/Port address of a peer like ('192.168.001.001', '05335').
+
+    It is a tuple, so it packs into packets, logs and compares like the plain address tuples; But it is parsed only
+    once (where an address enters from the wire or the user) and the same interned object is returned every time, so
+    it is used directly as the key of every address dict without re-parsing or re-stringifying.
+    """
+    __slots__ = ()
+
+    # Raw and canonical address tuples -> interned Address; Cleared when it grows past INTERN_LIMIT, which is safe
+    # because Addresses compare by value and interning is only a shortcut.
+    INTERN_LIMIT = 65536
+    __interned = dict()
+
+    @staticmethod
+    def parse(address):
+        """
+        :param address: Input Address like ('192.168.1.1', 421) or ('192.168.001.001', '00421').
+        :type address: tuple
+
+        :return: The interned Address; The format is like ('192.168.001.001', '00421').
+        :rtype: Address
+        """
+        if type(address) is Address:
+            return address
+        key = tuple(address)
+        interned = Address.__interned.get(key)
+        if interned is not None:
+            return interned
+
+        ip, port = key
+        canonical = Address(('.'.join(str(int(part)).zfill(3) for part in ip.split('.')), str(int(port)).zfill(5)))
+        interned = Address.__interned.get(canonical, canonical)
+        if len(Address.__interned) >= Address.INTERN_LIMIT:
+            Address.__interned.clear()
+        Address.__interned[canonical] = interned
+        Address.__interned[key] = interned
+        return interned
+
+    @property
+    def ip(self):
+        return self[0]
+
+    @property
+    def port(self):
+        return self[1]
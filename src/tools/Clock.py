@@ -0,0 +1,69 @@
+import time
+
+
+class Clock:
+    def __init__(self):
+        """
+        The time source of a Peer.
+
+        Timers and deadlines use 'monotonic', so a step of the wall clock (e.g. by NTP) can not expire or delay them;
+        Only the timestamps that other peers read, like the trace entries of a packet, use the wall clock 'time'.
+        """
+
+    def time(self):
+        """
+        :return: The wall clock time in seconds since the epoch.
+        :rtype: float
+        """
+        return time.time()
+
+    def monotonic(self):
+        """
+        :return: Seconds since an arbitrary point that never goes back; Only differences of it are meaningful.
+        :rtype: float
+        """
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        """
+        Block the calling thread for 'seconds'.
+
+        :param seconds: Seconds to sleep.
+        :type seconds: float
+
+        :return:
+        """
+        time.sleep(seconds)
+
+
+class VirtualClock(Clock):
+    def __init__(self, start=0.0):
+        """
+        A Clock that only moves when it is told to, e.g. by the event loop of a Simulator.
+
+        :param start: The initial time.
+        :type start: float
+        """
+        super().__init__()
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        # Nobody else can move the clock while we wait, so sleeping just skips ahead.
+        self.advance_to(self.now + seconds)
+
+    def advance_to(self, now):
+        """
+        Move the clock forward; It never goes back.
+
+        :param now: The new time.
+        :type now: float
+
+        :return:
+        """
+        self.now = max(self.now, now)
@@ -0,0 +1,89 @@
+import heapq
+import itertools
+import threading
+
+
+class DeadlineHeap:
+    def __init__(self):
+        """
+        Deadlines keyed by peer address, kept in a binary heap.
+
+        Rescheduling a key only pushes a new entry; the old one stays in the heap and is skipped when it reaches the
+        top, so every schedule is O(log n) and 'pop_expired' costs O(expired log n) instead of a scan of every key.
+        The heap is rebuilt when stale entries outnumber the live ones.
+        """
+        self.heap = []
+        self.entries = dict()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def schedule(self, key, deadline):
+        """
+        Set (or move) the deadline of the key.
+
+        :param key: Peer address.
+        :param deadline: The time the key expires.
+
+        :type key: tuple
+        :type deadline: float
+
+        :return:
+        """
+        entry = (deadline, next(self.counter), key)
+        with self.lock:
+            self.entries[key] = entry
+            heapq.heappush(self.heap, entry)
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                self.heap = list(self.entries.values())
+                heapq.heapify(self.heap)
+
+    def cancel(self, key):
+        """
+        Forget the key; Nothing happens if it is not scheduled.
+
+        :param key: Peer address.
+        :type key: tuple
+
+        :return:
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def get_next_deadline(self):
+        """
+        :return: The earliest deadline, or None if nothing is scheduled.
+        :rtype: float
+        """
+        with self.lock:
+            self.__drop_stale_entries()
+            return self.heap[0][0] if self.heap else None
+
+    def pop_expired(self, now):
+        """
+        Remove and return every key whose deadline is not after 'now'.
+
+        :param now: Current time.
+        :type now: float
+
+        :return: Expired keys, earliest first.
+        :rtype: list
+        """
+        expired = []
+        with self.lock:
+            self.__drop_stale_entries()
+            while self.heap and self.heap[0][0] <= now:
+                entry = heapq.heappop(self.heap)
+                del self.entries[entry[2]]
+                expired.append(entry[2])
+                self.__drop_stale_entries()
+        return expired
+
+    def __drop_stale_entries(self):
+        while self.heap and self.entries.get(self.heap[0][2]) is not self.heap[0]:
+            heapq.heappop(self.heap)
@@ -0,0 +1,161 @@
+from collections import deque
+import struct
+
+"""
+    The link layer of a node connection.
+
+    Every packet is sent in a frame with a per-connection sequence number, so the sender can pipeline packets
+    without waiting for each ACK and still knows exactly which of them arrived:
+
+                                ** Frame Format **
+                 ________________________________________________
+                |           Sequence Number (4 Bytes)            |
+                |------------------------------------------------|
+                |            Payload Length (4 Bytes)            |
+                |------------------------------------------------|
+                |          Payload (the encoded packet)          |
+                |________________________________________________|
+
+    The receiver answers with cumulative ACKs: b'ACK' and the 4 Bytes sequence number of the next frame it expects,
+    which acknowledges every frame before it. Sequence numbers start at 0 on every new connection.
+
+"""
+
+FRAME_HEADER = struct.Struct('!II')
+ACK = struct.Struct('!3sI')
+ACK_PREFIX = b'ACK'
+# Larger frames are a protocol error; It stops a broken sender from making us buffer without limit.
+MAXIMUM_PAYLOAD_SIZE = 1 << 24
+
+
+class LinkSender:
+    def __init__(self):
+        """
+        The sending side of a link: It numbers the frames and keeps the unacknowledged ones for retransmission.
+        """
+        self.next_sequence = 0
+        self.unacked = deque()
+        self.ack_buffer = bytearray()
+
+    def frame(self, payload, send_time):
+        """
+        Number the payload and keep it until it is acknowledged.
+
+        :param payload: The encoded packet.
+        :param send_time: The time it is sent; It is given back by 'acknowledge'.
+
+        :type payload: bytes
+        :type send_time: float
+
+        :return: The frame.
+        :rtype: bytes
+        """
+        sequence = self.next_sequence
+        self.next_sequence = (sequence + 1) & 0xFFFFFFFF
+        self.unacked.append((sequence, payload, send_time))
+        return FRAME_HEADER.pack(sequence, len(payload)) + payload
+
+    def acknowledge(self, data):
+        """
+        Read the ACKs the receiver has sent; They can arrive split or merged.
+
+        :param data: The bytes read from the connection.
+        :type data: bytes
+
+        :return: Send times of the newly acknowledged frames.
+        :rtype: list
+
+        :raises ValueError: If the data is not an ACK.
+        """
+        buffer = self.ack_buffer
+        buffer += data
+        next_expected = None
+        offset = 0
+        while len(buffer) - offset >= ACK.size:
+            prefix, next_expected = ACK.unpack_from(buffer, offset)
+            if prefix != ACK_PREFIX:
+                raise ValueError('invalid ACK')
+            offset += ACK.size
+        del buffer[:offset]
+
+        if next_expected is None or not self.unacked:
+            return []
+        # Everything before 'next_expected' has arrived; The masked subtraction keeps working when the numbers wrap.
+        count = (next_expected - self.unacked[0][0]) & 0xFFFFFFFF
+        if count > len(self.unacked):
+            return []
+        return [self.unacked.popleft()[2] for _ in range(count)]
+
+    def get_oldest_send_time(self):
+        """
+        :return: Send time of the oldest unacknowledged frame, or None.
+        :rtype: float
+        """
+        return self.unacked[0][2] if self.unacked else None
+
+    def take_unacked(self):
+        """
+        Forget the unacknowledged frames; The receiver may or may not have them.
+
+        :return: Their payloads, oldest first.
+        :rtype: list
+        """
+        payloads = [payload for _, payload, _ in self.unacked]
+        self.unacked.clear()
+        return payloads
+
+
+class LinkReceiver:
+    def __init__(self):
+        """
+        The receiving side of a link: It cuts the byte stream of a connection into frames and drops the duplicates.
+        """
+        self.buffer = bytearray()
+        self.next_sequence = 0
+        self.duplicates = 0
+
+    def feed(self, data):
+        """
+        :param data: The bytes read from the connection; Frames can arrive split or merged.
+        :type data: bytes
+
+        :return: The payloads of the new complete frames, and the ACK to send back (None if no frame is complete).
+        :rtype: tuple
+
+        :raises ValueError: If the stream is not made of frames.
+        """
+        buffer = self.buffer
+        buffer += data
+        payloads = []
+        offset = 0
+        completed = False
+        while len(buffer) - offset >= FRAME_HEADER.size:
+            sequence, length = FRAME_HEADER.unpack_from(buffer, offset)
+            if length > MAXIMUM_PAYLOAD_SIZE:
+                raise ValueError('frame of %d bytes' % length)
+            end = offset + FRAME_HEADER.size + length
+            if len(buffer) < end:
+                break
+            if sequence == self.next_sequence:
+                payloads.append(bytes(buffer[offset + FRAME_HEADER.size:end]))
+                self.next_sequence = (sequence + 1) & 0xFFFFFFFF
+            else:
+                self.duplicates += 1
+            completed = True
+            offset = end
+        del buffer[:offset]
+
+        if not completed:
+            return payloads, None
+        return payloads, self.make_ack()
+
+    def make_ack(self, held_back=0):
+        """
+        :param held_back: Number of the last new frames the receiver has not passed on yet; They are not acknowledged,
+                          so the sender keeps them in its window.
+        :type held_back: int
+
+        :return: The cumulative ACK of every other frame received so far.
+        :rtype: bytes
+        """
+        return ACK.pack(ACK_PREFIX, (self.next_sequence - held_back) & 0xFFFFFFFF)
@@ -0,0 +1,93 @@
+"""
+    Leveled logging for the whole project.
+
+    Modules log through the 'p2p.###' loggers with lazy %-formatting, so a disabled level costs only a level check:
+
+        logger = logging.getLogger('p2p.peer')
+        logger.debug('neighbour for %s is %s', sender, neighbour)
+
+    Per-packet events use the PACKET_LOGGER and are sampled: only one of every 'packet_sample_rate' records below
+    WARNING is kept. Records are handed to a queue and written by a background thread, so a slow terminal or pipe
+    never blocks the main loop.
+"""
+import atexit
+import itertools
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOGGER_NAME = 'p2p'
+PACKET_LOGGER_NAME = 'p2p.packet'
+FORMAT = '%(asctime)s %(levelname)s %(name)s %(message)s'
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate):
+        """
+        Keep one of every 'rate' records; WARNING and higher records are always kept.
+
+        :param rate: Sampling rate; 1 keeps every record.
+        :type rate: int
+        """
+        super().__init__()
+        self.rate = rate
+        self.counter = itertools.count()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate <= 1:
+            return True
+        return next(self.counter) % self.rate == 0
+
+
+_listener = None
+
+
+def configure(level=logging.INFO, stream=None, packet_level=None, packet_sample_rate=1):
+    """
+    Configure the 'p2p' loggers with an asynchronous sink; Calling it again replaces the previous configuration.
+
+    :param level: Level of the 'p2p' loggers.
+    :param stream: Output stream; sys.stdout if it is None.
+    :param packet_level: Level of the per-packet logger; The same as 'level' if it is None.
+    :param packet_sample_rate: Keep one of every 'packet_sample_rate' per-packet records.
+
+    :type level: int
+    :type stream: file
+    :type packet_level: int
+    :type packet_sample_rate: int
+
+    :return:
+    """
+    global _listener
+    shutdown()
+
+    handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    records = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.handlers = [logging.handlers.QueueHandler(records)]
+    logger.setLevel(level)
+    logger.propagate = False
+
+    packet_logger = logging.getLogger(PACKET_LOGGER_NAME)
+    packet_logger.setLevel(level if packet_level is None else packet_level)
+    packet_logger.filters = [SamplingFilter(packet_sample_rate)]
+
+
+def shutdown():
+    """
+    Write the queued records and stop the background writer.
+
+    :return:
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,221 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+
+class Counter:
+    def __init__(self):
+        """
+        A value that only goes up; like the number of received packets.
+        """
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def get(self):
+        return self.value
+
+
+class Gauge:
+    def __init__(self):
+        """
+        A value that can go up and down; like the out_buff depth of a node.
+        If a function is set with 'set_function', it will be called every time the value is read, so values that are
+        expensive to keep up to date (like NetworkGraph size) cost nothing on the hot path.
+        """
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Counts observations (like latencies in seconds) in cumulative buckets.
+
+        :param buckets: Sorted upper bounds of the buckets.
+        :type buckets: tuple
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def get_cumulative_counts(self):
+        """
+        :return: [(upper bound, count of observations <= upper bound), ...] ending with ('+Inf', count).
+        :rtype: list
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class MetricsRegistry:
+    TYPES = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}
+
+    def __init__(self):
+        """
+        Keeps every metric of a Peer by name and labels and renders them in the Prometheus text format.
+        """
+        self.families = dict()
+        self.lock = threading.Lock()
+
+    def __get(self, metric_class, name, help_text, labels):
+        label_items = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = (metric_class, help_text, dict())
+                self.families[name] = family
+            elif family[0] is not metric_class:
+                raise ValueError('metric %s is already registered as a %s' % (name, self.TYPES[family[0]]))
+            metric = family[2].get(label_items)
+            if metric is None:
+                metric = metric_class()
+                family[2][label_items] = metric
+        return metric
+
+    def counter(self, name, help_text='', **labels):
+        """
+        :return: The Counter with this name and labels; It will be created on the first call.
+        :rtype: Counter
+        """
+        return self.__get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text='', **labels):
+        """
+        :return: The Gauge with this name and labels; It will be created on the first call.
+        :rtype: Gauge
+        """
+        return self.__get(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text='', **labels):
+        """
+        :return: The Histogram with this name and labels; It will be created on the first call.
+        :rtype: Histogram
+        """
+        return self.__get(Histogram, name, help_text, labels)
+
+    def remove(self, name, **labels):
+        """
+        Stop exposing the metric with this name and labels, e.g. of a neighbour that is gone; Nothing happens if there
+        is none. A later call of 'counter', 'gauge' or 'histogram' creates it again from zero.
+
+        :return:
+        """
+        label_items = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.get(name)
+            if family is not None:
+                family[2].pop(label_items, None)
+
+    @staticmethod
+    def __format_labels(label_items, extra=()):
+        items = tuple(label_items) + tuple(extra)
+        if not items:
+            return ''
+        return '{' + ','.join('%s="%s"' % (key, value) for key, value in items) + '}'
+
+    def expose(self):
+        """
+        :return: All of the metrics in the Prometheus text exposition format.
+        :rtype: str
+        """
+        lines = []
+        with self.lock:
+            families = [(name, family[0], family[1], list(family[2].items()))
+                        for name, family in sorted(self.families.items())]
+
+        for name, metric_class, help_text, metrics in families:
+            if help_text:
+                lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, self.TYPES[metric_class]))
+            for label_items, metric in metrics:
+                if metric_class is Histogram:
+                    for bound, count in metric.get_cumulative_counts():
+                        lines.append('%s_bucket%s %s' % (name, self.__format_labels(label_items, [('le', bound)]),
+                                                         count))
+                    lines.append('%s_sum%s %s' % (name, self.__format_labels(label_items), metric.sum))
+                    lines.append('%s_count%s %s' % (name, self.__format_labels(label_items), metric.count))
+                else:
+                    lines.append('%s%s %s' % (name, self.__format_labels(label_items), metric.get()))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """
+        Write the exposition text to the file; The file is replaced on every call.
+
+        :param path: Output file path.
+        :type path: str
+
+        :return:
+        """
+        with open(path, 'w') as file:
+            file.write(self.expose())
+
+
+class MetricsServer:
+    def __init__(self, registry, ip, port):
+        """
+        Serve the registry exposition text over HTTP (GET /metrics) on a daemon thread.
+
+        :param registry: The registry we want to expose.
+        :param ip: Local IP address to bind, like '127.0.0.1'.
+        :param port: Local port to bind.
+
+        :type registry: MetricsRegistry
+        :type ip: str
+        :type port: int
+        """
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.expose().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http_server = ThreadingHTTPServer((ip, port), Handler)
+        self.thread = threading.Thread(target=self.http_server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
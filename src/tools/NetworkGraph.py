@@ -1,7 +1,13 @@
-import time
+from src.tools.Address import Address
+import heapq
+import itertools
+import random
 
 
 class GraphNode:
+    # A root may hold a node for every peer of the overlay; Slots keep each node small and cheap for the GC.
+    __slots__ = ('address', 'parent', 'right', 'left', 'alive', 'depth', 'path', 'index')
+
     def __init__(self, address):
         """
 
@@ -15,11 +21,15 @@ class GraphNode:
         self.left = None
         self.alive = False
         self.depth = None
+        # Child slots (0 for left, 1 for right) from the root; Sorting by (depth, path) gives the BFS order.
+        self.path = ()
+        # Position in the NetworkGraph list of its branch; None for the root.
+        self.index = None
 
     def set_parent(self, parent):
         self.parent = parent
 
-    def __reset(self):
+    def reset(self):
         self.parent = None
         self.right = None
         self.left = None
@@ -48,10 +58,22 @@ class GraphNode:
 
 
 class NetworkGraph:
+    # Branches up to this size are scanned for shortcuts; Larger ones are sampled.
+    SHORTCUT_SCAN_SIZE = 64
+    # Random draws per shortcut before giving up on a large branch with few live candidates.
+    SHORTCUT_SAMPLE_TRIES = 8
+
     def __init__(self, root):
         self.root = root
         root.alive = True
-        self.nodes = [root]
+        self.nodes = {root.address: root}
+        # The nodes under the left and the right child of the root, for sampling shortcuts.
+        self.branches = ([], [])
+        self.reserved = set()
+        # Nodes that may have a free child slot, in BFS order; Entries are checked when they reach the top.
+        self.open_nodes = []
+        self.counter = itertools.count()
+        self.__push_open_node(root)
 
     def find_live_node(self, sender):
         """
@@ -74,56 +96,124 @@ class NetworkGraph:
         """
 
         node = self.find_node(sender[0], sender[1])
-        if node is None:
+        if node is not None and node.alive:
+            return None
 
-            root = self.root
-            to_visit = [root]
+        # The top of the heap is the first node of a BFS that can be a neighbour, without visiting the others.
+        open_nodes = self.open_nodes
+        while open_nodes:
+            current = open_nodes[0][-1]
+            if self.nodes.get(current.address) is not current or self.__is_reserved(current):
+                heapq.heappop(open_nodes)
+                continue
+            if current.can_be_neighbour():
+                return current
+            heapq.heappop(open_nodes)
+        return None
 
-            while to_visit:
-                current = to_visit.pop(0)
-                if current.can_be_neighbour():
-                    return current
+    def __push_open_node(self, node):
+        heapq.heappush(self.open_nodes, (node.depth, node.path, next(self.counter), node))
+        if len(self.open_nodes) > 2 * len(self.nodes) + 64:
+            self.open_nodes = [entry for entry in self.open_nodes if self.nodes.get(entry[-1].address) is entry[-1]]
+            heapq.heapify(self.open_nodes)
 
-                if current.left:
-                    to_visit.append(current.left)
-                if current.right:
-                    to_visit.append(current.right)
-            return None
+    def __is_reserved(self, node):
+        """
+        :return: Whether the node is in a reserved sub-tree; A BFS never visits those.
+        :rtype: bool
+        """
+        if not self.reserved:
+            return False
+        while node is not None:
+            if node.address in self.reserved:
+                return True
+            node = node.parent
+        return False
 
-        elif node is not None:
-            if not node.alive:
-                root = self.root
-                to_visit = [root]
+    def reserve_subtree(self, node_address):
+        """
+        Never place new nodes in the sub-tree of this address, e.g. because a replicated root places the peers there.
 
-                while to_visit:
-                    current = to_visit.pop(0)
-                    if current.can_be_neighbour():
-                        return current
+        :param node_address: Address of the node; It can be added to our NetworkGraph later.
+        :type node_address: tuple
 
-                    if current.left:
-                        to_visit.append(current.left)
-                    if current.right:
-                        to_visit.append(current.right)
-                return None
+        :return:
+        """
+        self.reserved.add(node_address)
 
-    def find_node(self, ip, port):
-        address = (ip, port)
+    def find_shortcuts(self, node_address, count):
+        """
+        Pick live nodes for the long-range shortcut links of a node.
+        Nodes under another child of the root are preferred, because their tree path to the node is the longest.
 
-        root = self.root
-        to_visit = [root]
+        :param node_address: Address of the node.
+        :param count: Maximum number of shortcuts.
 
-        while to_visit:
-            current = to_visit.pop(0)
+        :type node_address: tuple
+        :type count: int
 
-            if current.address == address:
-                return current
+        :return: Addresses of the picked nodes; Never the node itself, its tree neighbours or the root.
+                 Large branches are sampled, so a few live nodes among many dead ones may be missed.
+        :rtype: list
+        """
+        node = self.nodes.get(tuple(node_address))
+        if node is None or node is self.root or count <= 0:
+            return []
+
+        excluded = {node, node.parent, node.left, node.right}
+        # The first child slot on the path from the root is the branch of the node.
+        branch = node.path[0]
+        picked = self.__sample_branch(self.branches[1 - branch], count, excluded)
+        picked += self.__sample_branch(self.branches[branch], count - len(picked), excluded)
+        return [candidate.address for candidate in picked]
+
+    def __sample_branch(self, candidates, count, excluded):
+        """
+        Pick live nodes of a branch at random, in time that does not grow with the size of the branch.
 
-            if current.left:
-                to_visit.append(current.left)
-            if current.right:
-                to_visit.append(current.right)
+        :param candidates: The nodes of the branch.
+        :param count: Maximum number of nodes.
+        :param excluded: Nodes that must not be picked.
 
-        return None
+        :type candidates: list
+        :type count: int
+        :type excluded: set
+
+        :return: The picked nodes.
+        :rtype: list
+        """
+        if count <= 0:
+            return []
+        if len(candidates) <= self.SHORTCUT_SCAN_SIZE:
+            eligible = [candidate for candidate in candidates if candidate.alive and candidate not in excluded]
+            return random.sample(eligible, min(count, len(eligible)))
+
+        picked = []
+        for _ in range(count * self.SHORTCUT_SAMPLE_TRIES):
+            candidate = random.choice(candidates)
+            if candidate.alive and candidate not in excluded and candidate not in picked:
+                picked.append(candidate)
+                if len(picked) == count:
+                    break
+        return picked
+
+    def __index_node(self, node):
+        branch = self.branches[node.path[0]]
+        node.index = len(branch)
+        branch.append(node)
+
+    def __unindex_node(self, node):
+        if node.index is None:
+            return
+        branch = self.branches[node.path[0]]
+        last = branch.pop()
+        if last is not node:
+            branch[node.index] = last
+            last.index = node.index
+        node.index = None
+
+    def find_node(self, ip, port):
+        return self.nodes.get((ip, port))
 
     def turn_on_node(self, node_address):
         node = self.find_node(node_address[0], node_address[1])
@@ -131,6 +221,7 @@ class NetworkGraph:
             return
 
         node.alive = True
+        self.__push_open_node(node)
 
     def turn_off_node(self, node_address):
         node = self.find_node(node_address[0], node_address[1])
@@ -140,36 +231,81 @@ class NetworkGraph:
         node.alive = False
 
     def remove_node(self, node_address):
-        node = self.find_node(node_address[0], node_address[1])
-        if node is None:
-            return
+        """
+        Detach the node from its parent and remove it with its whole sub-tree from our NetworkGraph.
 
-        parent = node.parent
+        :param node_address: Address of the node; The root is never removed.
+        :type node_address: tuple
 
-        if node == parent.right:
-            parent.right = None
-        elif node == parent.left:
-            parent.left = None
+        :return: Number of removed nodes.
+        :rtype: int
+        """
+        return self.remove_nodes([node_address])
+
+    def remove_nodes(self, node_addresses):
+        """
+        Remove many nodes (e.g. every peer expired in one reunion scan) with their sub-trees in a single traversal.
 
-        if node.right:
-            self.turn_off_subtree(node.right.address)
-        if node.left:
-            self.turn_off_subtree(node.left.address)
-        return
+        Every removed node is turned off, unlinked and deleted from 'nodes', so the cost is O(removed nodes) and
+        nothing keeps the removed GraphNodes alive.
+
+        :param node_addresses: Addresses of the nodes; Unknown addresses and the root are ignored.
+        :type node_addresses: list
+
+        :return: Number of removed nodes.
+        :rtype: int
+        """
+        to_visit = []
+        for node_address in node_addresses:
+            node = self.nodes.get(tuple(node_address))
+            if node is None or node is self.root:
+                continue
+
+            parent = node.parent
+            if parent is not None:
+                if node is parent.right:
+                    parent.right = None
+                elif node is parent.left:
+                    parent.left = None
+                # It has a free child slot again.
+                self.__push_open_node(parent)
+            to_visit.append(node)
+
+        removed = 0
+        while to_visit:
+            current = to_visit.pop()
+            if self.nodes.pop(current.address, None) is None:
+                continue
+            removed += 1
+            self.__unindex_node(current)
+            if current.left:
+                to_visit.append(current.left)
+            if current.right:
+                to_visit.append(current.right)
+            current.reset()
+        return removed
 
     def turn_off_subtree(self, node_address):
+        """
+        Turn off the node and every node in its sub-tree; They stay in our NetworkGraph.
+
+        :param node_address: Address of the sub-tree root.
+        :type node_address: tuple
+
+        :return:
+        """
         graph_node = self.find_node(node_address[0], node_address[1])
         if graph_node is None:
             return
 
-        graph_node.alive = False
-
-        if graph_node.right:
-            self.turn_off_subtree(graph_node.right.address)
-        if graph_node.left:
-            self.turn_off_subtree(graph_node.left.address)
-
-        return
+        to_visit = [graph_node]
+        while to_visit:
+            current = to_visit.pop()
+            current.alive = False
+            if current.right:
+                to_visit.append(current.right)
+            if current.left:
+                to_visit.append(current.left)
 
     def add_node(self, ip, port, father_address):
         """
@@ -195,11 +331,41 @@ class NetworkGraph:
             return
 
 
-        new_node = GraphNode((ip, port))
+        new_node = GraphNode(Address.parse((ip, port)))
         new_node.set_parent(father)
         new_node.depth = father.depth + 1
 
         father.add_child(new_node)
+        new_node.path = father.path + ((0,) if father.left is new_node else (1,))
+        replaced = self.nodes.get(new_node.address)
+        if replaced is not None:
+            self.__unindex_node(replaced)
+        self.nodes[new_node.address] = new_node
+        self.__index_node(new_node)
+        self.__push_open_node(new_node)
+
+    def get_size(self):
+        """
+        :return: Number of nodes in our NetworkGraph, the root included.
+        :rtype: int
+        """
+        return len(self.nodes)
+
+    def get_depth(self):
+        """
+        :return: Maximum depth of the nodes reachable from the root; The root depth is 0.
+        :rtype: int
+        """
+        depth = 0
+        to_visit = [self.root]
+        while to_visit:
+            current = to_visit.pop()
+            depth = max(depth, current.depth)
+            if current.left:
+                to_visit.append(current.left)
+            if current.right:
+                to_visit.append(current.right)
+        return depth
 
     def show(self):
         print('traversal')
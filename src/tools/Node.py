@@ -1,8 +1,19 @@
 from src.tools.simpletcp.clientsocket import ClientSocket
+from src.tools.Address import Address
+from src.tools.Link import LinkSender
+from src.tools.OutBuffer import OutBuffer
+from src.Packet import Packet
+import logging
+import time
+
+logger = logging.getLogger('p2p.node')
 
 
 class Node:
-    def __init__(self, server_address, set_register=False):
+    # Maximum number of sent messages waiting for their ACK; The data stays in the out_buff while it is full.
+    WINDOW = 64
+
+    def __init__(self, server_address, set_register=False, timeout=None, keepalive=None, flow_weights=None):
         """
         The Node object constructor.
 
@@ -15,41 +26,136 @@ class Node:
 
         :param server_address:
         :param set_register:
+        :param timeout: Seconds connecting or sending a message may block; None blocks forever. A message not
+                        acknowledged in this time fails the connection too.
+        :param keepalive: TCP keepalive (idle seconds, interval seconds, probe count); None leaves it off.
+        :param flow_weights: Weights of the data flows in our out_buff (see OutBuffer).
+
+        :type timeout: float
+        :type keepalive: tuple
+        :type flow_weights: dict
         """
 
-        self.server_ip = Node.parse_ip(server_address[0])
-        self.server_port = Node.parse_port(server_address[1])
+        self.server_address = Address.parse(server_address)
+        self.server_ip, self.server_port = self.server_address
         self.is_register_node = set_register
-        self.out_buff = []
+        self.out_buff = OutBuffer(flow_weights)
+        self.healthy = True
+        self.timeout = timeout
+        self.link = LinkSender()
+        # Our metrics (a Gauge and a Counter); They are set by the Stream that owns us.
+        self.out_buff_depth = None
+        self.bytes_sent = None
 
         try:
-            self.client = ClientSocket(mode=self.server_ip, port=int(self.server_port), single_use=False)
+            self.client = ClientSocket(mode=Node.get_socket_ip(self.server_ip), port=int(self.server_port),
+                                       single_use=False, timeout=timeout, keepalive=keepalive)
         except Exception:
             self.out_buff.clear()
             raise ConnectionError('Client socket cannot be initialized')
 
-        print("Server Address: ", server_address)
+        logger.debug('connected to %s', server_address)
 
-    def send_message(self):
+    def send_message(self, ack_latency=None, only_control=False):
         """
         Final function to send buffer to the client's socket.
 
+        Control packets go first, then the data flows take turns (see OutBuffer); Packets queued while we send, like
+        a Reunion Hello of the reunion daemon, take their place in that order.
+        The messages are sent in numbered frames without waiting for every ACK; They stay in the link until the
+        cumulative ACK of the receiver covers them, and the ACKs that have arrived are read here without blocking.
+        Once Node.WINDOW messages wait for their ACK, the data stops and stays in the out_buff for the next call
+        (see 'is_window_full'); Control packets are always sent, so a busy link can not hold up a Reunion Hello.
+        A closed connection, an invalid ACK or a message not acknowledged within the timeout raises an IOError; The
+        messages that may not have arrived are kept for 'take_unsent'.
+
+        :param ack_latency: If given, the time between sending every message and receiving its ACK is observed here.
+        :param only_control: Send only the control packets; The data packets stay in the out_buff.
+
+        :type ack_latency: Histogram
+        :type only_control: bool
+
+        :return: The messages sent.
+        :rtype: list
+        """
+        self.__read_acks(ack_latency)
+
+        sent = []
+        while self.out_buff.has_control() or (not only_control and self.out_buff and not self.is_window_full()):
+            data = Packet.stamp_forward_time(self.out_buff.popleft(), time.time())
+            # The frame is kept by the link before it is written, so a failed write does not lose the message.
+            self.client.write(self.link.frame(data, time.perf_counter()))
+            sent.append(data)
+
+        oldest_send_time = self.link.get_oldest_send_time()
+        if self.timeout is not None and oldest_send_time is not None and \
+                time.perf_counter() - oldest_send_time > self.timeout:
+            raise ConnectionError('no ACK from %s' % (self.get_server_address(),))
+        return sent
+
+    def __read_acks(self, ack_latency):
+        """
+        :param ack_latency: The ACK latency Histogram or None.
+        :type ack_latency: Histogram
+
         :return:
         """
-        for data in self.out_buff:
-            self.client.send(data)
+        while True:
+            data = self.client.read(False)
+            if not data:
+                return
+            try:
+                send_times = self.link.acknowledge(data)
+            except ValueError:
+                raise ConnectionError('invalid ACK from %s' % (self.get_server_address(),))
+            if ack_latency is not None:
+                now = time.perf_counter()
+                for send_time in send_times:
+                    ack_latency.observe(now - send_time)
 
-        self.out_buff.clear()
+    def is_window_full(self):
+        """
+        :return: Whether Node.WINDOW messages wait for their ACK, so 'send_message' holds back the data.
+        :rtype: bool
+        """
+        return len(self.link.unacked) >= self.WINDOW
 
-    def add_message_to_out_buff(self, message):
+    def has_unacked(self):
+        """
+        :return: Whether a sent message is still waiting for its ACK.
+        :rtype: bool
+        """
+        return bool(self.link.unacked)
+
+    def take_unsent(self):
+        """
+        Empty the node: The messages that may not have reached it, oldest first; Sent ones without an ACK come first.
+
+        :return: The messages.
+        :rtype: list
+        """
+        return self.link.take_unacked() + self.out_buff.take_all()
+
+    def add_message_to_out_buff(self, message, flow=None):
         """
         Here we will add a new message to the server out_buff, then in 'send_message' will send them.
 
         :param message: The message we want to add to out_buff
+        :param flow: The data flow of the message (see OutBuffer).
         :return:
         """
-        self.out_buff.append(message)
+        self.out_buff.append(message, flow)
+
+    def check_health(self):
+        """
+        Check the connection without blocking; An unhealthy node stays unhealthy.
 
+        :return: Whether the connection is still healthy.
+        :rtype: bool
+        """
+        if self.healthy and not self.client.is_alive():
+            self.healthy = False
+        return self.healthy
 
     def close(self):
         """
@@ -61,9 +167,9 @@ class Node:
     def get_server_address(self):
         """
         :return: Server address in a pretty format.
-        :rtype: tuple
+        :rtype: Address
         """
-        return self.server_ip, self.server_port
+        return self.server_address
 
     @staticmethod
     def parse_ip(ip):
@@ -77,6 +183,18 @@ class Node:
         """
         return '.'.join(str(int(part)).zfill(3) for part in ip.split('.'))
 
+    @staticmethod
+    def get_socket_ip(ip):
+        """
+        Remove the zero padding of the IP; Socket functions read padded parts like '010' as octal numbers.
+        :param ip: Input IP like '192.168.001.010'
+        :type ip: str
+
+        :return: IP like '192.168.1.10'
+        :rtype: str
+        """
+        return '.'.join(str(int(part)) for part in ip.split('.'))
+
     @staticmethod
     def parse_port(port):
         """
@@ -96,6 +214,6 @@ class Node:
         :type address: tuple ('192.168.1.1', 421)
 
         :return: Formatted Address
-        :rtype: tuple ('192.168.001.001', '00421')
+        :rtype: Address ('192.168.001.001', '00421')
         """
-        return Node.parse_ip(address[0]), Node.parse_port(str(address[1]))
+        return Address.parse(address)
@@ -0,0 +1,146 @@
+from collections import deque
+from src.Packet import Packet
+import threading
+
+
+class OutBuffer:
+    # Bytes a data flow may send in one round, multiplied by its weight.
+    QUANTUM = 2048
+
+    def __init__(self, weights=None):
+        """
+        The out_buff of a node: A queue of control packets that always goes first, then the data packets.
+
+        Control packets (Reunion, Join, Advertise, Register, ...; everything but Packet.DATA_TYPES) keep their FIFO
+        order and are sent before any data, so heartbeats are never stuck behind a broadcast storm. The data packets
+        (Message, Message Chunk) are queued per flow and share what is left by deficit round robin: In every round, a
+        flow may send QUANTUM bytes times its weight, so a chatty flow can not starve the others.
+
+        Messages can be appended from another thread (e.g. the reunion daemon) while the main loop pops.
+
+        :param weights: Positive weight of every flow; Flows that are not in it have weight 1. It is read, never
+                        copied, so changes apply at once.
+        :type weights: dict
+        """
+        self.weights = dict() if weights is None else weights
+        self.control = deque()
+        self.flows = dict()
+        self.deficits = dict()
+        # Flows with queued data; The first one has the turn.
+        self.active_flows = deque()
+        self.turn_started = False
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        """
+        :return: An iterator over a snapshot of the queued messages: The control ones, then the data of every flow.
+        """
+        with self.lock:
+            return iter(self.__get_messages())
+
+    def __get_messages(self):
+        messages = list(self.control)
+        for flow in self.active_flows:
+            messages += self.flows[flow]
+        return messages
+
+    def has_control(self):
+        return bool(self.control)
+
+    def get_control(self):
+        """
+        :return: A snapshot of the queued control messages.
+        :rtype: list
+        """
+        with self.lock:
+            return list(self.control)
+
+    def append(self, message, flow=None):
+        """
+        Queue the message.
+
+        :param message: The encoded packet.
+        :param flow: The data flow of the message, e.g. the neighbour it came from; Ignored for control packets.
+
+        :type message: bytes
+        :type flow: tuple
+
+        :return:
+        """
+        with self.lock:
+            self.size += 1
+            if Packet.get_buffer_type(message) not in Packet.DATA_TYPES:
+                self.control.append(message)
+                return
+            queue = self.flows.get(flow)
+            if queue is None:
+                queue = self.flows[flow] = deque()
+                self.deficits[flow] = 0
+                self.active_flows.append(flow)
+            queue.append(message)
+
+    def popleft(self):
+        """
+        :return: The next message to send.
+        :rtype: bytes
+
+        :raises IndexError: If the buffer is empty.
+        """
+        with self.lock:
+            if self.control:
+                self.size -= 1
+                return self.control.popleft()
+            if not self.active_flows:
+                raise IndexError('pop from an empty OutBuffer')
+
+            while True:
+                flow = self.active_flows[0]
+                queue = self.flows[flow]
+                if self.deficits[flow] >= len(queue[0]):
+                    break
+                if self.turn_started:
+                    # Its quantum is spent; The next flow has the turn.
+                    self.active_flows.rotate(-1)
+                    self.turn_started = False
+                else:
+                    self.deficits[flow] += self.QUANTUM * self.weights.get(flow, 1)
+                    self.turn_started = True
+
+            message = queue.popleft()
+            self.deficits[flow] -= len(message)
+            self.size -= 1
+            if not queue:
+                # An idle flow keeps no credit.
+                self.active_flows.popleft()
+                del self.flows[flow]
+                del self.deficits[flow]
+                self.turn_started = False
+            return message
+
+    def clear(self):
+        with self.lock:
+            self.__reset()
+
+    def __reset(self):
+        self.control.clear()
+        self.flows.clear()
+        self.deficits.clear()
+        self.active_flows.clear()
+        self.turn_started = False
+        self.size = 0
+
+    def take_all(self):
+        """
+        Empty the buffer.
+
+        :return: The messages in the order of '__iter__'.
+        :rtype: list
+        """
+        with self.lock:
+            messages = self.__get_messages()
+            self.__reset()
+        return messages
@@ -0,0 +1,100 @@
+import cProfile
+import io
+import logging
+import pstats
+
+logger = logging.getLogger('p2p.profiler')
+
+
+class LoopProfiler:
+    PHASES = ('handle_commands', 'parse_buffer', 'handle_packet', 'send_out_buf_messages', 'iteration')
+
+    def __init__(self, metrics):
+        """
+        Times the phases of every main loop iteration of a Peer and captures cProfile stats on demand.
+
+        Phase times are observed in the 'peer_loop_phase_seconds' histogram (handle_packet is labeled by packet type)
+        and the latest iteration is kept in 'last_iteration', so a live Peer can be inspected without restarting it.
+
+        :param metrics: Registry for the phase histograms.
+        :type metrics: MetricsRegistry
+        """
+        self.metrics = metrics
+        self.phases = {phase: metrics.histogram('peer_loop_phase_seconds', 'Wall time of main loop phases.',
+                                                phase=phase)
+                       for phase in self.PHASES}
+        self.packet_phases = dict()
+        self.last_iteration = dict()
+
+        self.profile = None
+        self.remaining_iterations = 0
+        self.output_path = None
+
+    def observe(self, phase, seconds):
+        """
+        :param phase: One of the LoopProfiler.PHASES.
+        :param seconds: Wall time of the phase.
+
+        :type phase: str
+        :type seconds: float
+
+        :return:
+        """
+        self.phases[phase].observe(seconds)
+        self.last_iteration[phase] = seconds
+
+    def observe_packet(self, type_name, seconds):
+        """
+        :param type_name: Name of the handled packet type.
+        :param seconds: Wall time of handle_packet for this packet.
+
+        :type type_name: str
+        :type seconds: float
+
+        :return:
+        """
+        histogram = self.packet_phases.get(type_name)
+        if histogram is None:
+            histogram = self.metrics.histogram('peer_loop_phase_seconds', 'Wall time of main loop phases.',
+                                               phase='handle_packet', type=type_name)
+            self.packet_phases[type_name] = histogram
+        histogram.observe(seconds)
+
+    def start_capture(self, iterations, output_path=None):
+        """
+        Profile the next 'iterations' main loop iterations with cProfile.
+
+        :param iterations: Number of iterations to profile.
+        :param output_path: If given, the stats are saved there (for pstats or snakeviz); otherwise the top functions
+                            are logged.
+
+        :type iterations: int
+        :type output_path: str
+
+        :return:
+        """
+        self.profile = cProfile.Profile()
+        self.remaining_iterations = iterations
+        self.output_path = output_path
+        logger.info('profiling the next %d iterations', iterations)
+
+    def begin_iteration(self):
+        if self.profile is not None:
+            self.profile.enable()
+
+    def end_iteration(self):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        self.remaining_iterations -= 1
+        if self.remaining_iterations > 0:
+            return
+
+        profile, self.profile = self.profile, None
+        if self.output_path is not None:
+            profile.dump_stats(self.output_path)
+            logger.info('profile saved to %s', self.output_path)
+        else:
+            output = io.StringIO()
+            pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(20)
+            logger.info('profile:\n%s', output.getvalue())
@@ -0,0 +1,247 @@
+"""
+    Sharded control plane for the root Peer.
+
+    The registration table and the Reunion Hellos of the root are split between worker processes by a hash of the
+    peer address, so they scale with the number of cores and do not compete with the root main loop for the GIL. The
+    root process stays the coordinator: it owns the NetworkGraph and the sockets. Of a Reunion packet it only checks
+    the header; The shard that owns the sender parses it, renews the Hello deadline of the sender and makes the Hello
+    Back, which is the per-packet work of the root for a settled overlay.
+
+    Calls of ShardedRegistry are queued and sent by 'flush', one batch per shard, once per iteration of the root main
+    loop. The shards batch their results the same way; A thread of the coordinator collects them and calls
+    'on_results', so the main loop wakes up and takes them with 'get_results':
+
+        ('registered', address, is_new)   Answer of 'register'; is_new is False if the address was registered before.
+        ('advertise', address, accepted)  Answer of 'advertise'; accepted is False if the address is not registered.
+        ('expired', address)              The shard has not received a Reunion Hello from the address in time.
+        ('send', address, message)        A Hello Back for the coordinator to send to the address.
+        ('dropped', reason)               A Reunion packet was invalid; The reason is 'encoding' or 'length'.
+"""
+from src.Packet import Packet, PacketFactory
+from src.tools.DeadlineHeap import DeadlineHeap
+from struct import Struct
+import multiprocessing
+import queue
+import threading
+import time
+import zlib
+
+REGISTER = 'register'
+ADVERTISE = 'advertise'
+HELLO = 'hello'
+STOP = 'stop'
+
+# An address like in the Source Server IP/Port fields of a packet header, so both hash to the same shard.
+ADDRESS_STRUCT = Struct('!4HL')
+SOURCE_ADDRESS_OFFSET = 8
+
+
+def make_hello_back(buffer, receive_time, root_address):
+    """
+    Handle a Reunion packet that has arrived at the root, like Peer.__handle_reunion_packet does.
+
+    :param buffer: The encoded packet; Its header is valid.
+    :param receive_time: The time the root received it.
+    :param root_address: Server address of the root.
+
+    :type buffer: bytes
+    :type receive_time: float
+    :type root_address: tuple
+
+    :return: The address of the sender (None if it is not a valid Reunion Hello) and the result for the coordinator,
+             if there is one.
+    :rtype: tuple
+    """
+    try:
+        packet = PacketFactory.parse_buffer(buffer)
+    except UnicodeDecodeError:
+        return None, ('dropped', 'encoding')
+    body_str = packet.get_body()
+    if packet.get_length() != len(body_str):
+        return None, ('dropped', 'length')
+
+    # A Hello Back that arrives at the root has nothing to do with it.
+    if body_str[:3] != Packet.BODY_REQ:
+        return None, None
+    entry_size = Packet.IP_SIZE + Packet.PORT_SIZE
+    path_peers_str = body_str[5:]
+    try:
+        number_of_entries = int(body_str[3:5])
+    except ValueError:
+        return None, None
+    if number_of_entries == 0 or number_of_entries != len(path_peers_str) // entry_size:
+        return None, None
+    path_peers = [(path_peers_str[i:i + Packet.IP_SIZE], path_peers_str[i + Packet.IP_SIZE:i + entry_size])
+                  for i in range(0, len(path_peers_str), entry_size)]
+
+    path_peers.reverse()
+    hello_back_packet = PacketFactory.new_reunion_packet(Packet.BODY_RES, root_address, path_peers)
+    if packet.get_trace() is not None:
+        hello_back_packet.set_trace(list(packet.get_trace()))
+        hello_back_packet.add_trace_entry(root_address, receive_time)
+    return packet.get_source_server_address(), ('send', path_peers[0], hello_back_packet.get_buf())
+
+
+def run_shard(commands, results, root_address, maximum_wait_time, scan_interval):
+    """
+    Main loop of a shard process.
+    Deadlines are stamped with our own time.monotonic() when a batch arrives, so they never depend on the clock of
+    the coordinator; The queue delay only makes a peer expire that much later.
+
+    :param commands: Queue of command batches from the coordinator: [(REGISTER, address), (ADVERTISE, address),
+                     (HELLO, buffer, receive time), ...].
+    :param results: Queue for the result batches to the coordinator.
+    :param root_address: Server address of the root.
+    :param maximum_wait_time: Seconds without a Reunion Hello before a peer expires.
+    :param scan_interval: Maximum seconds between two expiry checks.
+
+    :return:
+    """
+    registered = set()
+    hello_deadlines = DeadlineHeap()
+
+    while True:
+        wait_time = scan_interval
+        next_deadline = hello_deadlines.get_next_deadline()
+        if next_deadline is not None:
+            wait_time = max(0, min(wait_time, next_deadline - time.monotonic()))
+        try:
+            batch = commands.get(timeout=wait_time)
+        except queue.Empty:
+            batch = ()
+
+        now = time.monotonic()
+        answers = []
+        for command in batch:
+            if command[0] == STOP:
+                return
+            elif command[0] == REGISTER:
+                address = command[1]
+                answers.append(('registered', address, address not in registered))
+                registered.add(address)
+            elif command[0] == ADVERTISE:
+                address = command[1]
+                accepted = address in registered
+                if accepted:
+                    hello_deadlines.schedule(address, now + maximum_wait_time)
+                answers.append(('advertise', address, accepted))
+            elif command[0] == HELLO:
+                address, answer = make_hello_back(command[1], command[2], root_address)
+                if address in hello_deadlines:
+                    hello_deadlines.schedule(address, now + maximum_wait_time)
+                if answer is not None:
+                    answers.append(answer)
+
+        for peer_address in hello_deadlines.pop_expired(time.monotonic()):
+            answers.append(('expired', peer_address))
+        if answers:
+            results.put(answers)
+
+
+class ShardedRegistry:
+    def __init__(self, shards, root_address, maximum_wait_time, scan_interval, on_results=None):
+        """
+        Start the shard processes.
+
+        :param shards: Number of worker processes.
+        :param root_address: Server address of the root; The Hello Backs are sent from it.
+        :param maximum_wait_time: Seconds without a Reunion Hello before a peer expires.
+        :param scan_interval: Maximum seconds between two expiry checks in every shard.
+        :param on_results: Called from our reader thread when results arrive, e.g. to wake up the root main loop.
+
+        :type shards: int
+        :type root_address: tuple
+        :type maximum_wait_time: float
+        :type scan_interval: float
+        :type on_results: function
+        """
+        context = multiprocessing.get_context('spawn')
+        self.results = context.Queue()
+        self.commands = []
+        self.processes = []
+        self.batches = [[] for _ in range(shards)]
+        self.received = []
+        self.lock = threading.Lock()
+        self.on_results = on_results
+        for _ in range(shards):
+            commands = context.Queue()
+            process = context.Process(target=run_shard,
+                                      args=(commands, self.results, tuple(root_address), maximum_wait_time,
+                                            scan_interval))
+            process.daemon = True
+            process.start()
+            self.commands.append(commands)
+            self.processes.append(process)
+        self.reader = threading.Thread(target=self.__read_results)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def __read_results(self):
+        while True:
+            answers = self.results.get()
+            if answers is None:
+                return
+            with self.lock:
+                self.received.extend(answers)
+            if self.on_results is not None:
+                self.on_results()
+
+    def get_shard(self, address):
+        """
+        :param address: Peer address like ('192.168.001.001', '05335').
+        :type address: tuple
+
+        :return: Index of the shard that owns the address.
+        :rtype: int
+        """
+        ip_parts = [int(part) for part in address[0].split('.')]
+        return zlib.crc32(ADDRESS_STRUCT.pack(*ip_parts, int(address[1]))) % len(self.commands)
+
+    def register(self, address):
+        self.batches[self.get_shard(address)].append((REGISTER, tuple(address)))
+
+    def advertise(self, address):
+        self.batches[self.get_shard(address)].append((ADVERTISE, tuple(address)))
+
+    def hello(self, buffer, receive_time):
+        """
+        Give a Reunion packet to the shard of its sender, which answers a Hello with a Hello Back.
+
+        :param buffer: The encoded packet; Its header must be valid (see Packet.validate_buffer).
+        :param receive_time: The time our Stream received it.
+
+        :type buffer: bytes
+        :type receive_time: float
+
+        :return:
+        """
+        source_address = memoryview(buffer)[SOURCE_ADDRESS_OFFSET:SOURCE_ADDRESS_OFFSET + ADDRESS_STRUCT.size]
+        self.batches[zlib.crc32(source_address) % len(self.commands)].append((HELLO, bytes(buffer), receive_time))
+
+    def flush(self):
+        """
+        Send the queued calls to the shards; One message per shard that has any.
+
+        :return:
+        """
+        for index, batch in enumerate(self.batches):
+            if batch:
+                self.commands[index].put(batch)
+                self.batches[index] = []
+
+    def get_results(self):
+        """
+        :return: Every result the shards have sent since the last call; It never blocks.
+        :rtype: list
+        """
+        with self.lock:
+            results, self.received = self.received, []
+        return results
+
+    def close(self):
+        for commands in self.commands:
+            commands.put([(STOP,)])
+        for process in self.processes:
+            process.join(timeout=1)
+        self.results.put(None)
+        self.reader.join(timeout=1)
@@ -0,0 +1,110 @@
+import asyncio
+import queue
+import threading
+
+
+class Subscription:
+    # Put in the queues by 'close' to end every waiting iteration.
+    CLOSED = object()
+
+    def __init__(self, on_close=None):
+        """
+        Buffer of the broadcast messages delivered to a Peer, for consuming them outside of the Peer main loop.
+
+        Iterate it in a thread (for source_address, message in subscription) or in asyncio code
+        (async for source_address, message in subscription); Both block until the next message and stop after
+        'close'. Use one style per subscription; After the first async iteration messages only go to its event loop.
+        Messages are queued without limit, so a slow consumer only costs memory.
+
+        :param on_close: Called once by 'close'; The Peer removes the subscription from its listeners here.
+        :type on_close: function
+        """
+        self.queue = queue.SimpleQueue()
+        self.on_close = on_close
+        self.loop = None
+        self.async_queue = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def deliver(self, source_address, message):
+        """
+        Message listener of the Peer; It runs on the Peer main loop and never blocks.
+
+        :param source_address: Address of the neighbour that sent us the message.
+        :param message: The delivered message.
+
+        :type source_address: tuple
+        :type message: str
+
+        :return:
+        """
+        self.__put((source_address, message))
+
+    def get(self, timeout=None):
+        """
+        :param timeout: Seconds to wait for a message; None waits forever.
+        :type timeout: float
+
+        :return: The next (source_address, message); None if the subscription is closed.
+        :rtype: tuple
+
+        :raises queue.Empty: If no message arrives in 'timeout' seconds.
+        """
+        item = self.queue.get(timeout=timeout)
+        if item is Subscription.CLOSED:
+            self.queue.put(item)
+            return None
+        return item
+
+    def close(self):
+        """
+        Stop receiving messages; The messages already queued can still be read.
+
+        :return:
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.on_close is not None:
+            self.on_close(self)
+        self.__put(Subscription.CLOSED)
+
+    def __put(self, item):
+        with self.lock:
+            if self.loop is None:
+                self.queue.put(item)
+                return
+            loop, async_queue = self.loop, self.async_queue
+        try:
+            loop.call_soon_threadsafe(async_queue.put_nowait, item)
+        except RuntimeError:
+            # The event loop is closed; Nobody is left to read the message.
+            pass
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            yield item
+
+    def __aiter__(self):
+        with self.lock:
+            if self.loop is None:
+                # From now on messages go straight to the event loop; The ones already queued are moved there first.
+                self.loop = asyncio.get_running_loop()
+                self.async_queue = asyncio.Queue()
+                while True:
+                    try:
+                        self.async_queue.put_nowait(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+        return self
+
+    async def __anext__(self):
+        item = await self.async_queue.get()
+        if item is Subscription.CLOSED:
+            self.async_queue.put_nowait(item)
+            raise StopAsyncIteration
+        return item
@@ -0,0 +1,71 @@
+class TokenBucket:
+    # Shorter delays are rounding errors of the refill; Waiting for them could wait for ever on a VirtualClock, where
+    # 'now + delay' can be 'now'.
+    MINIMUM_DELAY = 1e-9
+
+    def __init__(self, packets_per_second, bytes_per_second, burst_seconds, now):
+        """
+        A token bucket that limits packets/s and bytes/s at once.
+
+        It holds up to 'burst_seconds' of tokens of each rate. Charging a packet may take it into debt; 'get_delay'
+        tells how long the source should wait until the debt is paid back, so a caller can defer the traffic (stop
+        reading) instead of dropping it.
+
+        :param packets_per_second: Packet rate; None for no packet limit.
+        :param bytes_per_second: Byte rate; None for no byte limit.
+        :param burst_seconds: Seconds of tokens the bucket holds.
+        :param now: The current monotonic time.
+
+        :type packets_per_second: float
+        :type bytes_per_second: float
+        :type burst_seconds: float
+        :type now: float
+        """
+        self.packets_per_second = packets_per_second
+        self.bytes_per_second = bytes_per_second
+        self.burst_seconds = burst_seconds
+        self.packet_tokens = 0 if packets_per_second is None else packets_per_second * burst_seconds
+        self.byte_tokens = 0 if bytes_per_second is None else bytes_per_second * burst_seconds
+        self.last_time = now
+
+    def __refill(self, now):
+        elapsed = max(0, now - self.last_time)
+        self.last_time = now
+        if self.packets_per_second is not None:
+            self.packet_tokens = min(self.packets_per_second * self.burst_seconds,
+                                     self.packet_tokens + elapsed * self.packets_per_second)
+        if self.bytes_per_second is not None:
+            self.byte_tokens = min(self.bytes_per_second * self.burst_seconds,
+                                   self.byte_tokens + elapsed * self.bytes_per_second)
+
+    def get_delay(self, now):
+        """
+        :param now: The current monotonic time.
+        :type now: float
+
+        :return: Seconds until the bucket is out of debt; 0 if it is not in debt.
+        :rtype: float
+        """
+        self.__refill(now)
+        delay = 0
+        if self.packets_per_second is not None and self.packet_tokens < 0:
+            delay = -self.packet_tokens / self.packets_per_second
+        if self.bytes_per_second is not None and self.byte_tokens < 0:
+            delay = max(delay, -self.byte_tokens / self.bytes_per_second)
+        return delay if delay >= self.MINIMUM_DELAY else 0
+
+    def consume(self, size, now):
+        """
+        Charge one packet; The bucket may go into debt.
+
+        :param size: Bytes of the packet.
+        :param now: The current monotonic time.
+
+        :type size: int
+        :type now: float
+
+        :return:
+        """
+        self.__refill(now)
+        self.packet_tokens -= 1
+        self.byte_tokens -= size
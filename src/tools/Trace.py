@@ -0,0 +1,98 @@
+from collections import deque
+import threading
+
+
+class TraceRecorder:
+    def __init__(self, metrics=None, max_traces=1000):
+        """
+        Keeps the traces of the traced packets delivered to our Peer and splits every hop time into queueing time
+        (inside a peer, from its Stream receiving the packet to sending it on) and wire time (from a peer sending the
+        packet to the next peer's Stream receiving it).
+
+        :param metrics: If given, hop times are observed in its 'trace_hop_###_seconds' histograms.
+        :param max_traces: Number of latest traces we keep.
+
+        :type metrics: MetricsRegistry
+        :type max_traces: int
+        """
+        self.metrics = metrics
+        self.traces = deque(maxlen=max_traces)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_hops(trace, address, receive_time):
+        """
+        :param trace: Packet trace; [((ip, port), receive time, forward time), ...]
+        :param address: Our address; The last peer of the path.
+        :param receive_time: The time our Stream received the packet.
+
+        :type trace: list
+        :type address: tuple
+        :type receive_time: float
+
+        :return: [{'peer': (ip, port), 'queueing': seconds, 'wire': seconds}, ...] for every peer that forwarded
+                 the packet; Times are None when the peer did not stamp them.
+        :rtype: list
+        """
+        hops = []
+        next_receive_times = [entry[1] for entry in trace[1:]] + [receive_time]
+        for (peer, peer_receive_time, forward_time), next_receive_time in zip(trace, next_receive_times):
+            queueing = None if forward_time is None else forward_time - peer_receive_time
+            wire = None if forward_time is None or next_receive_time is None else next_receive_time - forward_time
+            hops.append({'peer': peer, 'queueing': queueing, 'wire': wire})
+        return hops
+
+    def record(self, packet_type, trace, address, receive_time):
+        """
+        Save the trace of a delivered packet.
+
+        :param packet_type: Type of the packet.
+        :param trace: Packet trace.
+        :param address: Our address.
+        :param receive_time: The time our Stream received the packet.
+
+        :type packet_type: int
+        :type trace: list
+        :type address: tuple
+        :type receive_time: float
+
+        :return:
+        """
+        if not trace:
+            return
+        hops = self.get_hops(trace, address, receive_time)
+        with self.lock:
+            self.traces.append({'type': packet_type, 'origin': trace[0][0], 'hops': hops,
+                                'end_to_end': None if receive_time is None else receive_time - trace[0][1]})
+
+        if self.metrics is None:
+            return
+        for hop in hops:
+            if hop['queueing'] is not None:
+                self.metrics.histogram('trace_hop_queueing_seconds',
+                                       'Time a traced packet waited inside a forwarding peer.').observe(hop['queueing'])
+            if hop['wire'] is not None:
+                self.metrics.histogram('trace_hop_wire_seconds',
+                                       'Time a traced packet spent between two peers.').observe(hop['wire'])
+
+    def get_traces(self):
+        """
+        :return: The latest recorded traces; The oldest is first.
+        :rtype: list
+        """
+        with self.lock:
+            return list(self.traces)
+
+    def summary(self):
+        """
+        :return: {(ip, port): (mean queueing seconds, mean wire seconds, number of hops)} for every forwarding peer.
+        :rtype: dict
+        """
+        totals = dict()
+        for trace in self.get_traces():
+            for hop in trace['hops']:
+                if hop['queueing'] is None or hop['wire'] is None:
+                    continue
+                queueing, wire, count = totals.get(hop['peer'], (0, 0, 0))
+                totals[hop['peer']] = (queueing + hop['queueing'], wire + hop['wire'], count + 1)
+        return {peer: (queueing / count, wire / count, count) for peer, (queueing, wire, count) in totals.items()}
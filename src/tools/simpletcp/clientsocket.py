@@ -1,9 +1,10 @@
+import select
 import sys
 import socket
 
 
 class ClientSocket:
-    def __init__(self, mode, port, received_bytes=2048, single_use=True):
+    def __init__(self, mode, port, received_bytes=2048, single_use=True, timeout=None, keepalive=None):
         """
 
         Handle the socket's mode.
@@ -12,6 +13,11 @@ class ClientSocket:
         localhost -> (127.0.0.1)
         public ->    (0.0.0.0)
         otherwise, mode is interpreted as an IP address.
+
+        timeout is the number of seconds connect, send and recv may block
+        before they raise socket.timeout; None blocks forever.
+        keepalive is an (idle, interval, count) tuple of seconds and probes
+        for TCP keepalive; None leaves keepalive off.
         """
 
         if mode == "localhost":
@@ -27,6 +33,9 @@ class ClientSocket:
             raise ValueError
         # Actually create an INET, STREAMing socket.socket.
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        if keepalive is not None:
+            self.set_keepalive(*keepalive)
         # Save the number of bytes to be read in response
         self.received_bytes = received_bytes
         # Save whether this socket is single-use or not.
@@ -40,6 +49,61 @@ class ClientSocket:
         # warn single-use sockets not to send data twice.
         self.used = False
 
+    def set_keepalive(self, idle, interval, count):
+        # Let the kernel probe an idle connection, so a dead peer is
+        # noticed even when we have nothing to send to it.
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # The tuning options are not available on every platform.
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        if hasattr(socket, "TCP_KEEPINTVL"):
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        if hasattr(socket, "TCP_KEEPCNT"):
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+
+    def is_alive(self):
+        """
+
+        Check the connection without blocking.
+        A connected socket is readable only when the server has sent data
+        or closed the connection; peeking tells the two apart without
+        consuming anything.
+
+        """
+        # Single-use sockets are only connected inside send.
+        if self.single_use:
+            return True
+        if self.closed:
+            return False
+        try:
+            readable, errored = self._poll()
+            if errored:
+                return False
+            if readable:
+                # An orderly shutdown reads as an empty peek.
+                return self._socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b""
+        except BlockingIOError:
+            return True
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def _poll(self):
+        # Return whether the socket is readable and whether it has failed,
+        # without waiting. poll is preferred, because select can not watch
+        # file descriptors above 1024 and a process that hosts many peers
+        # has more than that.
+        if not hasattr(select, "poll"):
+            readable, _, errored = select.select([self._socket], [], [self._socket], 0)
+            return bool(readable), bool(errored)
+        poller = select.poll()
+        poller.register(self._socket, select.POLLIN)
+        events = poller.poll(0)
+        if not events:
+            return False, False
+        mask = events[0][1]
+        return bool(mask & (select.POLLIN | select.POLLHUP)), bool(mask & (select.POLLERR | select.POLLNVAL))
+
     def get_port(self):
         return self.connect_port
 
@@ -98,6 +162,39 @@ class ClientSocket:
         # Return the response
         return response
 
+    def write(self, data):
+        """
+
+        Send all of data (bytes) to the server without waiting for a
+        response; read the responses later with read.
+        Only for sockets that are not single-use.
+
+        """
+        self._socket.sendall(data)
+        self.used = True
+
+    def read(self, wait):
+        """
+
+        Return the bytes the server has sent us so far, at most
+        received_bytes of them.
+        If wait is False and nothing has arrived, return b"" at once;
+        otherwise block until something arrives, or raise socket.timeout
+        when the timeout expires.
+        A connection closed by the server raises ConnectionError.
+
+        """
+        if not wait:
+            readable, errored = self._poll()
+            if errored:
+                raise ConnectionError("connection failed")
+            if not readable:
+                return b""
+        data = self._socket.recv(self.received_bytes)
+        if not data:
+            raise ConnectionError("connection closed by the server")
+        return data
+
     def close(self):
         # If the connection isn't already closed, close it.
         if not self.closed:
@@ -1,13 +1,14 @@
-import errno
 import queue
-import select
+import selectors
 import socket
 import sys
 
+from src.tools.simpletcp.socketloop import SocketLoop
+
 
 class ServerSocket:
 
-    def __init__(self, mode, port, read_callback, max_connections, received_bytes):
+    def __init__(self, mode, port, read_callback, max_connections, received_bytes, close_callback=None):
         """
         Handle the socket's mode.
         The socket's mode determines the IP address it binds to.
@@ -33,10 +34,14 @@ class ServerSocket:
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Make it non-blocking.
         self._socket.setblocking(0)
+        # Allow restarting on the same address while old connections are in TIME_WAIT.
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # Bind the socket, so it can listen.
         self._socket.bind((self.ip, self.port))
         # Save the callback
         self.callback = read_callback
+        # Called with the client address when one of its connections closes.
+        self.close_callback = close_callback
         # Save the number of maximum connections.
         self._max_connections = max_connections
         if type(self._max_connections) != int:
@@ -45,85 +50,143 @@ class ServerSocket:
         # Save the number of bytes to be received each time we read from
         # a socket
         self.received_bytes = received_bytes
+        # The accepted connections that are still open, by client address.
+        self._connections = dict()
 
     def run(self):
+        # Serve this socket with a loop of its own.
+        loop = SocketLoop()
+        self.attach(loop)
+        loop.run()
+
+    def attach(self, loop):
         # Start listening
         self._socket.listen(self._max_connections)
-        # Create a list of readers (sockets that will be read from) and a list
-        # of writers (sockets that will be written to).
-        readers = [self._socket]
-        writers = []
-        # Create a dictionary of queue.Queues for data to be sent.
-        # This dictionary maps sockets to queue.Queue objects
-        queues = dict()
-        # Create a similar dictionary that stores IP addresses.
-        # This dictionary maps sockets to IP addresses
-        IPs = dict()
-        # Now, the main loop.
-        while readers:
-            # Block until a socket is ready for processing.
-            read, write, err = select.select(readers, writers, readers)
-            # Deal with sockets that need to be read from.
-            for sock in read:
-                if sock is self._socket:
-                    # We have a viable connection!
-                    client_socket, client_ip = self._socket.accept()
-                    # Make it a non-blocking connection.
-                    client_socket.setblocking(0)
-                    # Add it to our readers.
-                    readers.append(client_socket)
-                    # Make a queue for it.
-                    queues[client_socket] = queue.Queue()
-                    # Store its IP address.
-                    IPs[client_socket] = client_ip
-                else:
-                    # Someone sent us something! Let's receive it.
-                    try:
-                        data = sock.recv(self.received_bytes)
-                    except socket.error as e:
-                        if e.errno is errno.ECONNRESET:
-                            # Consider 'Connection reset by peer'
-                            # the same as reading zero bytes
-                            data = None
-                        else:
-                            raise e
-                    if data:
-                        # Call the callback
-                        self.callback(IPs[sock], queues[sock], data)
-                        # Put the client socket in writers so we can write to it
-                        # later.
-                        if sock not in writers:
-                            writers.append(sock)
-                    else:
-                        # We received zero bytes, so we should close the stream
-                        # Stop writing to it.
-                        if sock in writers:
-                            writers.remove(sock)
-                        # Stop reading from it.
-                        readers.remove(sock)
-                        # Close the connection.
-                        sock.close()
-                        # Destroy is queue
-                        del queues[sock]
-            # Deal with sockets that need to be written to.
-            for sock in write:
+        # From now on the loop calls us when a new connection arrives.
+        self._loop = loop
+        loop.register(self._socket, selectors.EVENT_READ, self._accept)
+
+    def _accept(self, mask):
+        # Accept every pending connection; the backlog is small, so a burst
+        # of connections would overflow it while we wait for the next event.
+        while True:
+            try:
+                # We have a viable connection!
+                client_socket, client_ip = self._socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            # Make it a non-blocking connection.
+            client_socket.setblocking(0)
+            self._register_connection(client_socket, client_ip)
+
+    def _register_connection(self, client_socket, client_ip):
+        connection = _Connection(client_socket, client_ip)
+
+        def handle(mask):
+            self._handle_connection(connection, mask)
+
+        connection.handle = handle
+        self._connections[client_ip] = connection
+        # Read from it whenever it is ready.
+        self._update_events(connection)
+
+    def _update_events(self, connection):
+        # Read unless the connection is paused, and write while responses
+        # are waiting; a socket that needs neither is left out of the loop.
+        events = 0 if connection.paused else selectors.EVENT_READ
+        if not connection.responses.empty():
+            events |= selectors.EVENT_WRITE
+        if events == connection.events:
+            return
+        if connection.events == 0:
+            self._loop.register(connection.sock, events, connection.handle)
+        elif events == 0:
+            self._loop.unregister(connection.sock)
+        else:
+            self._loop.modify(connection.sock, events, connection.handle)
+        connection.events = events
+
+    def _handle_connection(self, connection, mask):
+        sock = connection.sock
+        if mask & selectors.EVENT_READ:
+            # Someone sent us something! Let's receive it.
+            try:
+                data = sock.recv(self.received_bytes)
+            except socket.error:
+                # Consider 'Connection reset by peer' and the other errors
+                # the same as reading zero bytes; one broken connection
+                # must not stop a loop that serves other sockets.
+                data = None
+            if not data:
+                # We received zero bytes, so we should close the stream.
+                self._close_connection(connection)
+                return
+            # Call the callback
+            self.callback(connection.ip, connection.responses, data)
+        if mask & selectors.EVENT_WRITE:
+            try:
+                # Get the next chunk of data in the queue, but don't wait.
+                data = connection.responses.get_nowait()
+            except queue.Empty:
+                # The queue is empty -> nothing needs to be written.
+                pass
+            else:
+                # The queue wasn't empty; we did, in fact, get something.
+                # So send it.
                 try:
-                    # Get the next chunk of data in the queue, but don't wait.
-                    data = queues[sock].get_nowait()
-                except queue.Empty:
-                    # The queue is empty -> nothing needs to be written.
-                    writers.remove(sock)
-                else:
-                    # The queue wasn't empty; we did, in fact, get something.
-                    # So send it.
                     sock.send(data)
-            # Deal with errors in sockets.
-            for sock in err:
-                # Remove the socket from every list.
-                readers.remove(sock)
-                if sock in writers:
-                    writers.remove(sock)
-                # Close the connection.
-                sock.close()
-                # Destroy its queue.
-                del queues[sock]
+                except socket.error:
+                    # The client is gone; the next read will close it.
+                    pass
+        self._update_events(connection)
+
+    def _close_connection(self, connection):
+        if connection.events:
+            self._loop.unregister(connection.sock)
+            connection.events = 0
+        connection.sock.close()
+        if self._connections.get(connection.ip) is connection:
+            del self._connections[connection.ip]
+        if self.close_callback is not None:
+            self.close_callback(connection.ip)
+
+    def pause(self, ip, seconds, resume_callback=None):
+        """
+        Stop reading from the connection of ip for seconds; the data it
+        sends meanwhile waits in the kernel, so TCP slows the sender down.
+        Responses are still written. Only call it from the loop thread,
+        e.g. in the read callback.
+        resume_callback, if given, is called like the read callback, but
+        without data, when reading resumes; it may pause again.
+        """
+        connection = self._connections.get(ip)
+        if connection is None or connection.paused:
+            return
+        connection.paused = True
+        self._update_events(connection)
+        self._loop.call_later(seconds, self._resume, connection, resume_callback)
+
+    def _resume(self, connection, resume_callback):
+        # The connection may have been closed in the meantime.
+        if self._connections.get(connection.ip) is not connection:
+            return
+        connection.paused = False
+        if resume_callback is not None:
+            resume_callback(connection.ip, connection.responses)
+        self._update_events(connection)
+
+
+class _Connection:
+    """
+    The state of one accepted connection.
+    """
+
+    def __init__(self, sock, ip):
+        self.sock = sock
+        self.ip = ip
+        # A queue for the data to be sent to it.
+        self.responses = queue.Queue()
+        self.handle = None
+        # The events it is registered for in the loop; 0 if it is not.
+        self.events = 0
+        self.paused = False
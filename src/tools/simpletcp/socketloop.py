@@ -0,0 +1,59 @@
+import heapq
+import itertools
+import selectors
+import threading
+import time
+
+
+class SocketLoop:
+    """
+    One thread that serves the sockets of any number of ServerSockets.
+    It uses the best selector of the platform (epoll on Linux), so unlike
+    select it is not limited to 1024 file descriptors per process.
+    Sockets are registered with a handler that is called with the ready
+    events mask. Functions can be scheduled with call_later.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.running = False
+        self.thread = None
+        self.timers = []
+        self.counter = itertools.count()
+
+    def register(self, sock, events, handler):
+        self.selector.register(sock, events, handler)
+
+    def modify(self, sock, events, handler):
+        self.selector.modify(sock, events, handler)
+
+    def unregister(self, sock):
+        self.selector.unregister(sock)
+
+    def call_later(self, delay, function, *args):
+        # Call function(*args) in the loop thread after delay seconds.
+        # Only call it from the loop thread, e.g. in a handler.
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.counter), function, args))
+
+    def run(self):
+        self.running = True
+        while self.running:
+            # Wake up now and then, so 'stop' is noticed even when idle.
+            timeout = 1
+            if self.timers:
+                timeout = min(timeout, max(0, self.timers[0][0] - time.monotonic()))
+            for key, mask in self.selector.select(timeout=timeout):
+                key.data(mask)
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, function, args = heapq.heappop(self.timers)
+                function(*args)
+
+    def start(self):
+        # Run the loop in a daemon thread.
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
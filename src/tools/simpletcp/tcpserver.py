@@ -17,17 +17,34 @@ class TCPServer:
      is a tunnel of data to send to the socket that it received from.
      The third argument must be data, which is a string of bytes
      that the server received.
+     close_callback, if given, is called with the IP address of a
+     connection when it closes.
     """
 
     def __init__(self, mode, port, read_callback,
-                 maximum_connections=5, receive_bytes=2048):
+                 maximum_connections=5, receive_bytes=2048, close_callback=None):
         self.server_socket = ServerSocket(
-            mode, port, read_callback, maximum_connections, receive_bytes
+            mode, port, read_callback, maximum_connections, receive_bytes,
+            close_callback
         )
 
     def run(self):
         self.server_socket.run()
 
+    def attach(self, loop):
+        """
+        Serve the server socket on a shared SocketLoop instead of 'run'.
+        """
+        self.server_socket.attach(loop)
+
+    def pause(self, ip, seconds, resume_callback=None):
+        """
+        Stop reading from the connection of ip for seconds; only from the
+        loop thread, e.g. in read_callback. resume_callback(ip, queue) is
+        called when reading resumes.
+        """
+        self.server_socket.pause(ip, seconds, resume_callback)
+
     @property
     def ip(self):
         return self.server_socket.ip
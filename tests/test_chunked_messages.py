@@ -0,0 +1,54 @@
+import unittest
+
+from src.Packet import Packet
+from src.Simulator import Simulator
+
+
+class ChunkedMessageTest(unittest.TestCase):
+    def setUp(self):
+        self.simulator = Simulator(latency=0.001)
+        root = self.simulator.add_peer('10.0.0.1', 5000, is_root=True)
+        self.sender = self.simulator.add_peer('10.0.0.2', 5000, root_address=root.address)
+        self.receiver = self.simulator.add_peer('10.0.0.3', 5000, root_address=root.address)
+        for peer in (self.sender, self.receiver):
+            self.simulator.call_at(1.0, peer.join_network)
+        self.simulator.run(until=5)
+
+        self.delivered = []
+        self.receiver.add_message_listener(lambda source, message: self.delivered.append(message))
+
+    def test_long_message_is_queued_over_several_iterations(self):
+        message = ''.join(chr(ord('a') + index % 26) for index in range(100 * Packet.CHUNK_SIZE))
+        future = self.sender.send(message)
+        self.sender.run_iteration()
+
+        queued = sum(len(node.out_buff) for node in self.sender.stream.nodes.values())
+        self.assertLessEqual(queued, len(self.sender.stream.nodes) * self.sender.BROADCAST_PACKETS_PER_ITERATION)
+        self.assertFalse(future.done())
+        self.simulator.run(until=10)
+
+        self.assertIsNone(future.result(timeout=0))
+        self.assertEqual(self.delivered, [message])
+        self.assertFalse(self.sender.outgoing_messages)
+        self.assertEqual(self.receiver.pending_chunk_chars, 0)
+
+    def test_short_message_does_not_wait_behind_a_long_one(self):
+        self.sender.send('x' * (50 * Packet.CHUNK_SIZE))
+        self.sender.send('short')
+        self.simulator.run(until=10)
+
+        self.assertEqual(self.delivered, ['short', 'x' * (50 * Packet.CHUNK_SIZE)])
+
+    def test_pending_chars_are_capped(self):
+        self.receiver.MAX_PENDING_CHUNK_CHARS = 4 * Packet.CHUNK_SIZE
+        self.sender.send('x' * (5 * Packet.CHUNK_SIZE))
+        self.sender.send('y' * (3 * Packet.CHUNK_SIZE))
+        self.simulator.run(until=10)
+
+        self.assertEqual(self.delivered, ['y' * (3 * Packet.CHUNK_SIZE)])
+        self.assertEqual(self.receiver.pending_chunk_chars, 0)
+        self.assertFalse(self.receiver.pending_chunked_messages)
+
+
+if __name__ == '__main__':
+    unittest.main()
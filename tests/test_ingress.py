@@ -0,0 +1,46 @@
+import unittest
+
+from src.Simulator import Simulator
+
+
+class IngressLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.simulator = Simulator(latency=0.001)
+        root = self.simulator.add_peer('10.0.0.1', 5000, is_root=True)
+        self.sender = self.simulator.add_peer('10.0.0.2', 5000, root_address=root.address)
+        self.receiver = self.simulator.add_peer('10.0.0.3', 5000, root_address=root.address)
+        for peer in (self.sender, self.receiver):
+            self.simulator.call_at(1.0, peer.join_network)
+        self.simulator.run(until=5)
+
+        self.delivered = []
+        self.receiver.add_message_listener(
+            lambda source, message: self.delivered.append((self.simulator.clock.time(), message)))
+
+    def test_limit_defers_packets_in_order_without_loss(self):
+        self.receiver.stream.set_ingress_limit(packets_per_second=10, burst_seconds=1)
+        messages = ['m%d' % index for index in range(30)]
+        for message in messages:
+            self.simulator.call_at(6.0, self.sender.send, message)
+        self.simulator.run(until=20)
+
+        self.assertEqual([message for _, message in self.delivered], messages)
+        # The burst and one packet on credit pass at once, the rest at 10 packets per second.
+        self.assertLess(self.delivered[10][0], 6.1)
+        self.assertGreater(self.delivered[11][0], 6.1)
+        self.assertAlmostEqual(self.delivered[-1][0], 7.9, delta=0.05)
+        self.assertEqual(self.receiver.stream.deferred_packets.get(), 19)
+        self.assertFalse(self.receiver.stream.ingress_backlogs)
+
+    def test_without_limit_nothing_waits(self):
+        for index in range(30):
+            self.simulator.call_at(6.0, self.sender.send, 'm%d' % index)
+        self.simulator.run(until=20)
+
+        self.assertEqual(len(self.delivered), 30)
+        self.assertLess(self.delivered[-1][0], 6.1)
+        self.assertEqual(self.receiver.stream.deferred_packets.get(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
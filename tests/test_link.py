@@ -0,0 +1,89 @@
+import unittest
+
+from src.tools.Link import ACK, ACK_PREFIX, FRAME_HEADER, MAXIMUM_PAYLOAD_SIZE, LinkReceiver, LinkSender
+
+
+def feed_in_pieces(receiver, data, size):
+    payloads, acks = [], []
+    for offset in range(0, len(data), size):
+        new_payloads, ack = receiver.feed(data[offset:offset + size])
+        payloads += new_payloads
+        if ack is not None:
+            acks.append(ack)
+    return payloads, acks
+
+
+class LinkTest(unittest.TestCase):
+    def setUp(self):
+        self.sender = LinkSender()
+        self.receiver = LinkReceiver()
+        self.payloads = [bytes([index]) * index for index in range(20)]
+
+    def test_split_frames_are_reassembled_in_order(self):
+        data = b''.join(self.sender.frame(payload, index) for index, payload in enumerate(self.payloads))
+
+        payloads, acks = feed_in_pieces(self.receiver, data, 7)
+        self.assertEqual(payloads, self.payloads)
+        self.assertEqual(ACK.unpack(acks[-1]), (ACK_PREFIX, len(self.payloads)))
+
+    def test_merged_acks_acknowledge_every_frame_before_them(self):
+        data = b''.join(self.sender.frame(payload, index) for index, payload in enumerate(self.payloads))
+        _, acks = feed_in_pieces(self.receiver, data, len(data))
+
+        self.assertEqual(self.sender.acknowledge(b''.join(acks)), list(range(len(self.payloads))))
+        self.assertIsNone(self.sender.get_oldest_send_time())
+
+    def test_ack_split_between_reads(self):
+        for index, payload in enumerate(self.payloads[:3]):
+            self.receiver.feed(self.sender.frame(payload, index))
+        ack = self.receiver.make_ack()
+
+        self.assertEqual(self.sender.acknowledge(ack[:2]), [])
+        self.assertEqual(self.sender.acknowledge(ack[2:]), [0, 1, 2])
+
+    def test_duplicate_frame_is_dropped(self):
+        frame = self.sender.frame(b'once', 0)
+
+        self.assertEqual(self.receiver.feed(frame)[0], [b'once'])
+        payloads, ack = self.receiver.feed(frame)
+        self.assertEqual(payloads, [])
+        self.assertEqual(self.receiver.duplicates, 1)
+        self.assertEqual(ACK.unpack(ack), (ACK_PREFIX, 1))
+
+    def test_sequence_numbers_wrap_around(self):
+        self.sender.next_sequence = self.receiver.next_sequence = 0xFFFFFFFE
+        data = b''.join(self.sender.frame(payload, index) for index, payload in enumerate(self.payloads[:4]))
+
+        payloads, acks = feed_in_pieces(self.receiver, data, len(data))
+        self.assertEqual(payloads, self.payloads[:4])
+        self.assertEqual(self.sender.acknowledge(acks[-1]), [0, 1, 2, 3])
+        self.assertEqual(self.sender.next_sequence, 2)
+
+    def test_held_back_frames_are_not_acknowledged(self):
+        for index, payload in enumerate(self.payloads[:5]):
+            self.receiver.feed(self.sender.frame(payload, index))
+
+        self.assertEqual(self.sender.acknowledge(self.receiver.make_ack(held_back=2)), [0, 1, 2])
+        self.assertEqual(self.sender.get_oldest_send_time(), 3)
+        self.assertEqual(self.sender.take_unacked(), self.payloads[3:5])
+        self.assertFalse(self.sender.unacked)
+
+    def test_stale_ack_acknowledges_nothing(self):
+        for index, payload in enumerate(self.payloads[:3]):
+            self.sender.frame(payload, index)
+
+        self.assertEqual(self.sender.acknowledge(ACK.pack(ACK_PREFIX, 0)), [])
+        self.assertEqual(self.sender.acknowledge(ACK.pack(ACK_PREFIX, 100)), [])
+        self.assertEqual(len(self.sender.unacked), 3)
+
+    def test_invalid_ack_raises(self):
+        with self.assertRaises(ValueError):
+            self.sender.acknowledge(b'NAK\x00\x00\x00\x00')
+
+    def test_oversized_frame_raises(self):
+        with self.assertRaises(ValueError):
+            self.receiver.feed(FRAME_HEADER.pack(0, MAXIMUM_PAYLOAD_SIZE + 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from src.Simulator import Simulator
+from src.tools.Metrics import MetricsRegistry
+
+
+class MetricsRegistryTest(unittest.TestCase):
+    def test_remove_stops_exposing_only_that_series(self):
+        registry = MetricsRegistry()
+        registry.counter('bytes_total', 'Bytes.', neighbour='a').inc(3)
+        registry.counter('bytes_total', 'Bytes.', neighbour='b').inc(5)
+
+        registry.remove('bytes_total', neighbour='a')
+        text = registry.expose()
+        self.assertNotIn('neighbour="a"', text)
+        self.assertIn('bytes_total{neighbour="b"} 5', text)
+
+    def test_removed_series_starts_again_from_zero(self):
+        registry = MetricsRegistry()
+        registry.counter('bytes_total', neighbour='a').inc(3)
+        registry.remove('bytes_total', neighbour='a')
+
+        self.assertEqual(registry.counter('bytes_total', neighbour='a').get(), 0)
+
+    def test_remove_unknown_series_does_nothing(self):
+        registry = MetricsRegistry()
+        registry.remove('missing_total', neighbour='a')
+        registry.gauge('depth', neighbour='a').set(1)
+        registry.remove('depth', neighbour='b')
+
+        self.assertIn('depth{neighbour="a"} 1', registry.expose())
+
+
+class NeighbourMetricsTest(unittest.TestCase):
+    def test_series_of_a_removed_neighbour_are_removed(self):
+        simulator = Simulator(latency=0.001)
+        root = simulator.add_peer('10.0.0.1', 5000, is_root=True)
+        peer = simulator.add_peer('10.0.0.2', 5000, root_address=root.address)
+        simulator.call_at(1.0, peer.join_network)
+        simulator.run(until=5)
+        neighbour = 'neighbour="%s:%s"' % peer.address
+        self.assertIn(neighbour, root.metrics.expose())
+
+        simulator.fail_peer(peer)
+        simulator.run(until=10)
+        self.assertNotIn(neighbour, root.metrics.expose())
+
+
+if __name__ == '__main__':
+    unittest.main()
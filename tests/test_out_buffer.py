@@ -0,0 +1,98 @@
+import unittest
+
+from src.Packet import Packet, PacketFactory
+from src.tools.OutBuffer import OutBuffer
+
+SOURCE_ADDRESS = ('192.168.001.001', '05335')
+# Two of these fit in OutBuffer.QUANTUM.
+DATA_SIZE = OutBuffer.QUANTUM // 2 - Packet.HEADER_SIZE
+
+
+def data(tag):
+    return PacketFactory.new_message_packet(tag * DATA_SIZE, SOURCE_ADDRESS).get_buf()
+
+
+def control():
+    return PacketFactory.new_reunion_packet(Packet.BODY_REQ, SOURCE_ADDRESS, [SOURCE_ADDRESS]).get_buf()
+
+
+def pop_all(out_buff):
+    messages = []
+    while out_buff:
+        messages.append(out_buff.popleft())
+    return messages
+
+
+class OutBufferTest(unittest.TestCase):
+    def test_control_packets_go_first_in_order(self):
+        out_buff = OutBuffer()
+        first_control = control()
+        second_control = PacketFactory.new_join_packet(SOURCE_ADDRESS).get_buf()
+        out_buff.append(data('a'), 'a')
+        out_buff.append(first_control)
+        out_buff.append(data('b'), 'b')
+        out_buff.append(second_control)
+
+        self.assertTrue(out_buff.has_control())
+        self.assertEqual(len(out_buff), 4)
+        self.assertEqual(out_buff.popleft(), first_control)
+        self.assertEqual(out_buff.popleft(), second_control)
+        self.assertFalse(out_buff.has_control())
+        self.assertEqual(len(out_buff), 2)
+
+    def test_control_packet_appended_later_overtakes_data(self):
+        out_buff = OutBuffer()
+        for _ in range(3):
+            out_buff.append(data('a'), 'a')
+        out_buff.popleft()
+        heartbeat = control()
+        out_buff.append(heartbeat)
+
+        self.assertEqual(out_buff.popleft(), heartbeat)
+
+    def test_flows_take_turns_by_quantum(self):
+        out_buff = OutBuffer()
+        for _ in range(6):
+            out_buff.append(data('a'), 'a')
+        for _ in range(2):
+            out_buff.append(data('b'), 'b')
+
+        order = [bytes(message[-1:]).decode() for message in pop_all(out_buff)]
+        self.assertEqual(order, ['a', 'a', 'b', 'b', 'a', 'a', 'a', 'a'])
+
+    def test_weights_scale_the_share_of_a_flow(self):
+        out_buff = OutBuffer({'a': 2})
+        for _ in range(6):
+            out_buff.append(data('a'), 'a')
+            out_buff.append(data('b'), 'b')
+
+        order = [bytes(message[-1:]).decode() for message in pop_all(out_buff)]
+        self.assertEqual(order, ['a'] * 4 + ['b'] * 2 + ['a'] * 2 + ['b'] * 4)
+
+    def test_idle_flow_keeps_no_credit(self):
+        out_buff = OutBuffer()
+        out_buff.append(data('a'), 'a')
+        out_buff.popleft()
+        for _ in range(3):
+            out_buff.append(data('a'), 'a')
+        out_buff.append(data('b'), 'b')
+
+        order = [bytes(message[-1:]).decode() for message in pop_all(out_buff)]
+        self.assertEqual(order, ['a', 'a', 'b', 'a'])
+
+    def test_take_all_empties_the_buffer(self):
+        out_buff = OutBuffer()
+        heartbeat = control()
+        out_buff.append(data('a'), 'a')
+        out_buff.append(heartbeat)
+        out_buff.append(data('b'), 'b')
+
+        messages = out_buff.take_all()
+        self.assertEqual(messages, [heartbeat, data('a'), data('b')])
+        self.assertEqual(len(out_buff), 0)
+        with self.assertRaises(IndexError):
+            out_buff.popleft()
+
+
+if __name__ == '__main__':
+    unittest.main()
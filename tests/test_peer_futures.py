@@ -0,0 +1,40 @@
+import itertools
+import os
+import unittest
+
+from src.Peer import Peer
+
+# Our TCPServer is never closed, so every test takes a new port.
+PORTS = itertools.count(30000 + os.getpid() % 1000 * 20)
+
+class CancelledFutureTest(unittest.TestCase):
+    def setUp(self):
+        self.peer = Peer('127.0.0.1', next(PORTS), is_root=True, interactive=False)
+
+    def tearDown(self):
+        self.peer.stop()
+        self.peer.join(timeout=5)
+
+    def test_cancelled_send_keeps_main_loop_running(self):
+        cancelled = self.peer.send(b'cancelled')
+        self.assertTrue(cancelled.cancel())
+        sent = self.peer.send(b'sent')
+
+        self.peer.start()
+        self.assertIsNone(sent.result(timeout=5))
+        self.assertTrue(cancelled.cancelled())
+        self.assertTrue(self.peer.is_running())
+
+    def test_cancelled_command_is_skipped_when_peer_stops(self):
+        cancelled = self.peer.submit_command('trace', 'on')
+        self.assertTrue(cancelled.cancel())
+        pending = self.peer.submit_command('trace', 'on')
+
+        self.peer.stop()
+        self.peer.run()
+        self.assertTrue(cancelled.cancelled())
+        self.assertIsInstance(pending.exception(timeout=5), RuntimeError)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+
+from src.Peer import Peer
+from src.Simulator import Simulator
+from src.Stream import Stream
+
+
+class SimulatorTest(unittest.TestCase):
+    def setUp(self):
+        self.simulator = Simulator(latency=0.001)
+        self.root = self.simulator.add_peer('10.0.0.1', 5000, is_root=True)
+        self.peers = [self.simulator.add_peer('10.0.1.%d' % (index + 1), 5000, root_address=self.root.address)
+                      for index in range(6)]
+        for index, peer in enumerate(self.peers):
+            self.simulator.call_at(1.0 + index, peer.join_network)
+        self.simulator.run(until=10)
+        self.graph = self.root.network_graph
+
+    def test_peers_are_placed_nearest_the_root(self):
+        first, second = self.peers[0].address, self.peers[1].address
+        parents = [peer.parent_address for peer in self.peers]
+
+        self.assertEqual(parents, [self.root.address, self.root.address, first, first, second, second])
+        self.assertEqual(self.graph.get_size(), 7)
+        self.assertEqual(sorted(node.depth for node in self.graph.nodes.values()), [0, 1, 1, 2, 2, 2, 2])
+
+    def test_only_neighbours_of_a_failed_peer_check_their_health(self):
+        checked = []
+        for address, stream in self.simulator.streams.items():
+            stream.check_health = (lambda address, check: lambda: (checked.append(address), check()))(
+                address, stream.check_health)
+        failed = self.peers[0]
+
+        self.simulator.fail_peer(failed)
+        self.simulator.run(until=self.simulator.clock.time() + Stream.HEALTH_CHECK_INTERVAL + 0.5)
+        neighbours = [self.root.address, self.peers[2].address, self.peers[3].address]
+        self.assertEqual(sorted(checked), sorted(neighbours))
+        for address in neighbours:
+            self.assertNotIn(failed.address, self.simulator.streams[address].nodes)
+        self.assertNotIn(failed.address, self.simulator.connections)
+
+    def test_failed_sub_tree_is_removed_after_the_reunion_timeout(self):
+        failed = self.peers[0]
+        sub_tree = [failed] + self.peers[2:4]
+        crash_time = self.simulator.clock.time()
+        self.simulator.fail_peer(failed)
+
+        self.simulator.run(until=crash_time + Peer.MAXIMUM_WAIT_TIME - Peer.DAEMON_THREAD_WAIT_TIME - 1)
+        self.assertEqual(self.graph.get_size(), 7)
+        self.simulator.run(until=crash_time + Peer.MAXIMUM_WAIT_TIME + Peer.DAEMON_THREAD_WAIT_TIME)
+        for peer in sub_tree:
+            self.assertIsNone(self.graph.find_node(*peer.address))
+        self.assertEqual(self.graph.get_size(), 4)
+
+    def test_orphans_join_again_under_live_peers(self):
+        failed = self.peers[0]
+        self.simulator.fail_peer(failed)
+
+        recovered = self.simulator.run_until(
+            lambda: self.graph.find_node(*failed.address) is None and self.graph.get_size() == 6, step=0.5, timeout=60)
+        self.assertIsNotNone(recovered)
+        for peer in self.peers[1:]:
+            self.assertNotEqual(peer.parent_address, failed.address)
+            self.assertIsNotNone(self.graph.find_node(*peer.parent_address))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+
+from src.tools.TokenBucket import TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_is_free(self):
+        bucket = TokenBucket(10, None, burst_seconds=0.5, now=0)
+        for _ in range(5):
+            self.assertEqual(bucket.get_delay(0), 0)
+            bucket.consume(100, 0)
+
+        self.assertEqual(bucket.get_delay(0), 0)
+        bucket.consume(100, 0)
+        self.assertAlmostEqual(bucket.get_delay(0), 0.1)
+
+    def test_packet_rate_refills_over_time(self):
+        bucket = TokenBucket(10, None, burst_seconds=1, now=0)
+        for _ in range(12):
+            bucket.consume(1, 0)
+
+        self.assertAlmostEqual(bucket.get_delay(0), 0.2)
+        self.assertAlmostEqual(bucket.get_delay(0.15), 0.05)
+        self.assertEqual(bucket.get_delay(0.2), 0)
+
+    def test_byte_rate_limits_large_packets(self):
+        bucket = TokenBucket(None, 1000, burst_seconds=1, now=0)
+        bucket.consume(1500, 0)
+
+        self.assertAlmostEqual(bucket.get_delay(0), 0.5)
+        self.assertEqual(bucket.get_delay(0.5), 0)
+
+    def test_longest_delay_of_both_rates_wins(self):
+        bucket = TokenBucket(1, 1000, burst_seconds=1, now=0)
+        bucket.consume(100, 0)
+        bucket.consume(100, 0)
+
+        self.assertAlmostEqual(bucket.get_delay(0), 1)
+        bucket.consume(3000, 1)
+        self.assertAlmostEqual(bucket.get_delay(1), 2)
+
+    def test_idle_time_refills_at_most_the_burst(self):
+        bucket = TokenBucket(10, None, burst_seconds=1, now=0)
+        for _ in range(20):
+            bucket.consume(1, 100)
+
+        self.assertAlmostEqual(bucket.get_delay(100), 1)
+
+    def test_clock_going_back_adds_no_tokens(self):
+        bucket = TokenBucket(10, None, burst_seconds=1, now=10)
+        for _ in range(11):
+            bucket.consume(1, 10)
+
+        self.assertAlmostEqual(bucket.get_delay(5), 0.1)
+
+    def test_rounding_error_is_no_delay(self):
+        bucket = TokenBucket(None, 3, burst_seconds=1, now=0)
+        bucket.consume(4, 0)
+        delay = bucket.get_delay(0)
+
+        self.assertGreater(delay, 0)
+        self.assertEqual(bucket.get_delay(delay), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()